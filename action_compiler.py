@@ -0,0 +1,232 @@
+"""ルールベースのアクションコンパイラ
+
+「com.android.chrome を起動する」「「www.google.com」を入力してEnterを押す」のような定型の計画ステップを、
+ReActエージェント（LLM）を通さずに直接ツール呼び出しに変換して実行する。
+
+ルールは (名前, 正規表現, ハンドラ) の表で、ActionCompiler.rule() で追加できる。
+ハンドラは一致結果と CompileContext を受け取り、ツールを呼び出して結果のテキストを返す。
+どのルールにも一致しない・要素を一意に特定できない場合は CompileMiss を送出し、
+呼び出し元はエージェントで実行する。ツールが失敗した場合もエージェントに任せる。
+"""
+import re
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from colorama import Fore
+from langchain_core.tools import BaseTool
+
+from locator_compactor import LocatorElement, parse_locators
+from macro_library import UUID_PATTERN
+from tool_hooks import call_tool_coroutine, tool_content
+from tool_registry import ToolRegistry
+
+# アプリ名 → パッケージ名（「Chromeを起動」のように名前で書かれたステップ用）
+APP_PACKAGES = {
+    "chrome": "com.android.chrome",
+    "クローム": "com.android.chrome",
+    "設定": "com.android.settings",
+    "settings": "com.android.settings",
+    "youtube": "com.google.android.youtube",
+    "gmail": "com.google.android.gm",
+    "マップ": "com.google.android.apps.maps",
+    "maps": "com.google.android.apps.maps",
+    "play ストア": "com.android.vending",
+    "play store": "com.android.vending",
+}
+
+# パッケージ名（URLの「www.google.com」「yahoo.co.jp」と区別するため、逆ドメインの先頭で判定する）
+# \w は日本語にも一致して続く「を起動」などを取り込むため、ASCIIの文字だけを使う
+_PACKAGE = r"(?<![A-Za-z0-9_./])(?P<package>(?:com|org|net|io|jp|de|tv|me|app|android)\.[A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*)"
+_APP_NAME = r"(?P<name>" + "|".join(re.escape(name) for name in sorted(APP_PACKAGES, key=len, reverse=True)) + r")"
+_QUOTED = r"[「『\"'`](?P<text>[^」』\"'`]+)[」』\"'`]"
+_URL = re.compile(r"https?://|www\.|URL|ページ|サイト", re.IGNORECASE)
+_ENTER = re.compile(r"エンター|Enter|確定|送信|改行|\\n", re.IGNORECASE)
+# 一致した部分以外に別の操作が書かれていたら、1つのルールでは実行しきれないステップとみなす
+_OTHER_ACTION = re.compile(
+    r"開|起動|入力|タップ|クリック|押|選択|スクロール|スワイプ|検索|確認|戻|閉じ|終了|待"
+    r"|\b(?:open|launch|tap|click|press|type|enter|scroll|swipe|search|select|verify|check|wait)\b",
+    re.IGNORECASE,
+)
+# type_text がまとめて実行する「Enterキーを押す」の部分
+_ENTER_PHRASE = re.compile(r"(?:して|し|、)?\s*(?:エンター|Enter|確定|送信)(?:キー)?\s*(?:を)?\s*(?:押す|押して|押下|する)?|and\s+press\s+enter",
+                           re.IGNORECASE)
+
+
+class CompileMiss(Exception):
+    """ステップをツール呼び出しに変換できない（エージェントで実行する）"""
+
+
+class CompileContext:
+    """ハンドラからツールを呼び出すための文脈
+
+    ツールの引数名はサーバーによって 'id' / 'args.text' のように異なるため、
+    arg() で引数スキーマから末尾が一致する名前を探して使う。
+    """
+
+    def __init__(self, registry: ToolRegistry):
+        self.registry = registry
+        self.calls: list[tuple[str, dict]] = []
+
+    def tool(self, name: str) -> BaseTool:
+        tool = self.registry.get(name)
+        if tool is None:
+            raise CompileMiss(f"ツール '{name}' がありません")
+        return tool
+
+    def arg(self, tool_name: str, suffix: str) -> str:
+        """ツールの引数名のうち、suffix で終わるもの（例: 'args.elementUUID'）"""
+        names = list(self.tool(tool_name).args)
+        for name in names:
+            if name == suffix or name.endswith("." + suffix) or name.lower() == suffix.lower():
+                return name
+        raise CompileMiss(f"{tool_name} に引数 '{suffix}' がありません: {names}")
+
+    async def call(self, tool_name: str, **args) -> str:
+        """引数を実際の名前に合わせてツールを呼び出し、テキスト出力を返す"""
+        tool = self.tool(tool_name)
+        kwargs = {self.arg(tool_name, key): value for key, value in args.items()}
+        result = str(tool_content(tool, await call_tool_coroutine(tool, kwargs)))
+        self.calls.append((tool_name, kwargs))
+        return result
+
+    async def elements(self) -> list[LocatorElement]:
+        elements = parse_locators(await self.call("generate_locators"))
+        if elements is None:
+            raise CompileMiss("ロケーター情報を解析できません")
+        return [e for e in elements if e.displayed and e.enabled]
+
+    async def find(self, element: LocatorElement, elements: list[LocatorElement]) -> str:
+        """要素を appium_find_element で取得し、UUIDを返す"""
+        if element.resource_id and sum(e.resource_id == element.resource_id for e in elements) == 1:
+            strategy, selector = "id", element.resource_id
+        elif element.text and '"' not in element.text:
+            strategy, selector = "xpath", f'//*[@text="{element.text}"]'
+        elif element.desc:
+            strategy, selector = "accessibility id", element.desc
+        else:
+            raise CompileMiss("要素を指定するセレクターを作れません")
+        result = await self.call("appium_find_element", strategy=strategy, selector=selector)
+        match = UUID_PATTERN.search(result)
+        if match is None:
+            raise RuntimeError(f"要素が見つかりません: {result[:200]}")
+        return match.group(0)
+
+
+Handler = Callable[[re.Match, str, CompileContext], Awaitable[str]]
+
+
+@dataclass
+class Rule:
+    name: str
+    pattern: re.Pattern
+    handler: Handler
+    consumes: re.Pattern | None = None  # 一致した部分以外でハンドラが合わせて実行する表現
+
+
+def _single(candidates: list[LocatorElement], what: str) -> LocatorElement:
+    if len(candidates) != 1:
+        raise CompileMiss(f"{what}を一意に特定できません（候補{len(candidates)}件）")
+    return candidates[0]
+
+
+async def _activate_app(match: re.Match, step: str, ctx: CompileContext) -> str:
+    if _URL.search(step):
+        raise CompileMiss("URLを開くステップです")
+    package = match.groupdict().get("package") or APP_PACKAGES[match.group("name").lower()]
+    return await ctx.call("appium_activate_app", id=package)
+
+
+async def _terminate_app(match: re.Match, step: str, ctx: CompileContext) -> str:
+    package = match.groupdict().get("package") or APP_PACKAGES[match.group("name").lower()]
+    return await ctx.call("appium_terminate_app", id=package)
+
+
+async def _type_text(match: re.Match, step: str, ctx: CompileContext) -> str:
+    text = match.group("text")
+    if _ENTER.search(step[match.end():]) and not text.endswith("\n"):
+        text += "\n"
+    elements = await ctx.elements()
+    field = _single([e for e in elements if e.cls in ("Edit", "Secret")], "入力欄")
+    uuid = await ctx.find(field, elements)
+    return await ctx.call("appium_set_value", elementUUID=uuid, text=text)
+
+
+async def _tap(match: re.Match, step: str, ctx: CompileContext) -> str:
+    label = match.group("text").strip()
+    elements = await ctx.elements()
+    candidates = [e for e in elements if label in (e.text, e.desc)]
+    if not candidates:
+        candidates = [e for e in elements if label.lower() in (e.text.lower(), e.desc.lower())]
+    element = _single(candidates, f"要素 '{label}' ")
+    uuid = await ctx.find(element, elements)
+    return await ctx.call("appium_click", elementUUID=uuid)
+
+
+DEFAULT_RULES = [
+    Rule("activate_app", re.compile(_PACKAGE + r"\s*(?:を|アプリを)?\s*(?:起動|開|アクティブ)", re.IGNORECASE), _activate_app),
+    Rule("activate_app", re.compile(r"(?:activate|launch|open)\s+(?:the\s+)?" + _PACKAGE, re.IGNORECASE), _activate_app),
+    Rule("activate_app", re.compile(r"^\s*" + _APP_NAME + r"\s*(?:アプリ)?\s*を\s*(?:起動|開)", re.IGNORECASE), _activate_app),
+    Rule("terminate_app", re.compile(_PACKAGE + r"\s*(?:を|アプリを)?\s*(?:終了|停止|閉じ)", re.IGNORECASE), _terminate_app),
+    Rule("type_text", re.compile(_QUOTED + r"\s*(?:と|を)\s*(?:入力|タイプ)"), _type_text, _ENTER_PHRASE),
+    Rule("type_text", re.compile(r"(?:type|enter)\s+" + _QUOTED, re.IGNORECASE), _type_text, _ENTER_PHRASE),
+    Rule("tap", re.compile(_QUOTED + r"\s*(?:ボタン|リンク|タブ|メニュー)?\s*を\s*(?:タップ|クリック|押)"), _tap),
+    Rule("tap", re.compile(r"(?:tap|click)\s+(?:on\s+)?" + _QUOTED, re.IGNORECASE), _tap),
+]
+
+
+class ActionCompiler:
+    """計画のステップを直接のツール呼び出しに変換して実行する
+
+    Args:
+        tools: 呼び出しに使うツール（マクロ記録・先読み観測のフックを通すため、エージェントと同じものを渡す）
+        rules: ルールの表（省略時は DEFAULT_RULES）。先に一致したルールを使う
+    """
+
+    def __init__(self, tools: list[BaseTool], rules: list[Rule] | None = None):
+        self.registry = ToolRegistry(tools)
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self.stats = {"compiled": 0, "missed": 0, "failed": 0}
+
+    def rule(self, name: str, pattern: str | re.Pattern, consumes: str | re.Pattern | None = None):
+        """ルールを追加するデコレーター（既定のルールより先に試す）"""
+        def decorator(handler: Handler) -> Handler:
+            self.rules.insert(0, Rule(name, re.compile(pattern), handler,
+                                      re.compile(consumes) if consumes is not None else None))
+            return handler
+        return decorator
+
+    def match(self, step: str) -> tuple[Rule, re.Match] | None:
+        """ステップに一致するルールを探す（一致した部分以外に別の操作が書かれたステップには使わない）"""
+        for rule in self.rules:
+            match = rule.pattern.search(step)
+            if not match:
+                continue
+            rest = step[:match.start()] + " " + step[match.end():]
+            if rule.consumes is not None:
+                rest = rule.consumes.sub(" ", rest)
+            if not _OTHER_ACTION.search(rest):
+                return rule, match
+        return None
+
+    async def run(self, step: str) -> str | None:
+        """ステップを実行して結果を返す。変換できない・失敗した場合はNone（エージェントで実行する）"""
+        found = self.match(step)
+        if found is None:
+            self.stats["missed"] += 1
+            return None
+        rule, match = found
+        ctx = CompileContext(self.registry)
+        try:
+            result = await rule.handler(match, step, ctx)
+        except CompileMiss as e:
+            print(Fore.YELLOW + f"アクションコンパイラ: '{step}' は {rule.name} に一致しましたが変換できません: {e}")
+            self.stats["missed"] += 1
+            return None
+        except Exception as e:
+            print(Fore.YELLOW + f"アクションコンパイラ: '{step}' の実行に失敗しました。エージェントで実行します: {e}")
+            self.stats["failed"] += 1
+            return None
+        self.stats["compiled"] += 1
+        calls = ", ".join(name for name, _ in ctx.calls)
+        print(Fore.GREEN + f"アクションコンパイラ: '{step}' を {rule.name} として実行しました（{calls}）")
+        return result
@@ -0,0 +1,294 @@
+"""エージェントのローカル処理のマイクロベンチマーク
+
+毎サイクル実行されるローカル処理（LLMやデバイスを除く部分）のスループットとメモリ割り当てを計測する。
+
+- screen/*     : process_screenshot（base64デコード・ハッシュ計算・リサイズ・JPEGエンコード）、
+                 prepare_images（変化領域の切り出しと縮小画像のエンコード）
+- logger/*     : EventLogger.dispatch（イベント種別ごと）
+- planner/*    : SimplePlanner のプロンプト組み立て（create_plan / replan）
+- past_steps/* : past_steps の蓄積（グラフのreducer）と文字列化、StepHistory による要約
+
+入力には --trace で指定した記録済みトレース（trace_replay.py）のスクリーンショットと
+ロケーター情報を使う。指定がなければ決まった乱数シードで生成したデータを使う。
+
+使い方:
+    uv run python bench_agent.py --json bench/main.json
+    uv run python bench_agent.py --compare bench/main.json --trace traces/yahoo
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import operator
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from typing import Callable
+
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_openai import ChatOpenAI
+from PIL import Image, ImageDraw
+
+from event_logger import EventLogger
+from screen_diff import MINOR, ScreenChange
+from screen_observation import ScreenObservation, process_screenshot
+from step_history import StepHistory
+from test_plan_and_execute_agent import KNOWHOW, SimplePlanner
+from trace_replay import TracePlayer, unblobify
+from vision_images import prepare_images
+
+SCREEN_SIZES = [(720, 1280), (1080, 2400), (1440, 3200)]
+LOCATOR_COUNTS = [20, 100, 400]
+PAST_STEP_COUNTS = [10, 50, 200]
+
+
+# --- 入力データ ---
+def synthetic_screenshot(width: int, height: int, seed: int = 0) -> str:
+    """それらしい画面（ツールバー・リスト行・テキスト）のPNGをbase64で返す"""
+    rng = random.Random(seed)
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, width, height // 12), fill=(33, 150, 243))
+    row_height = height // 14
+    for top in range(height // 12, height, row_height):
+        draw.rectangle((0, top, width, top + row_height - 2), fill=(rng.randrange(220, 256),) * 3)
+        for _ in range(6):
+            left = rng.randrange(0, width - 60)
+            draw.text((left, top + row_height // 3), "Lorem ipsum", fill=(rng.randrange(0, 80),) * 3)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def synthetic_locators(count: int, seed: int = 0) -> str:
+    """generate_locators 形式のロケーター情報（JSON）を返す"""
+    rng = random.Random(seed)
+    classes = ["android.widget.TextView", "android.widget.Button", "android.widget.EditText",
+               "android.widget.ImageView", "android.view.ViewGroup"]
+    elements = []
+    for i in range(count):
+        cls = rng.choice(classes)
+        top = 100 + i * 40
+        elements.append({
+            "tagName": cls,
+            "text": f"項目 {i}" if cls != "android.view.ViewGroup" else "",
+            "contentDesc": "",
+            "resourceId": f"com.android.chrome:id/item_{i % 30}",
+            "clickable": cls in ("android.widget.Button", "android.widget.EditText") or rng.random() < 0.2,
+            "bounds": f"[0,{top}][1080,{top + 40}]",
+            "locators": {"id": f"com.android.chrome:id/item_{i % 30}",
+                         "xpath": f"//{cls}[@resource-id='com.android.chrome:id/item_{i % 30}']"},
+        })
+    return json.dumps(elements, ensure_ascii=False)
+
+
+def load_inputs(trace_dir: str | None) -> tuple[dict[str, str], dict[str, str]]:
+    """ベンチマーク用のスクリーンショットとロケーター情報（ラベル → データ）"""
+    if trace_dir:
+        player = TracePlayer(trace_dir)
+
+        def recorded(tool_name: str) -> list[str]:
+            results = {unblobify(r.get("result"), player.blobs) for r in player.tool_results[tool_name] if "error" not in r}
+            results = sorted((r for r in results if isinstance(r, str) and r), key=len)
+            # 小・中・大の3つを選ぶ
+            return list(dict.fromkeys(results[i * (len(results) - 1) // 2] for i in range(3))) if results else []
+
+        screenshots = {f"trace{i}-{len(s) // 1024}KiB": s for i, s in enumerate(recorded("appium_screenshot"))}
+        locators = {f"trace{i}-{len(s) // 1024}KiB": s for i, s in enumerate(recorded("generate_locators"))}
+        if screenshots and locators:
+            return screenshots, locators
+        print(f"トレース {trace_dir} にスクリーンショットまたはロケーター情報がないため、生成データを使います")
+
+    screenshots = {f"{w}x{h}": synthetic_screenshot(w, h) for w, h in SCREEN_SIZES}
+    locators = {f"{n}el": synthetic_locators(n) for n in LOCATOR_COUNTS}
+    return screenshots, locators
+
+
+def logger_events() -> dict[str, dict]:
+    """EventLogger.dispatch に渡す代表的なイベント（種別 → イベント）"""
+    return {
+        "chain_start": {"event": "on_chain_start", "name": "agent", "data": {}},
+        "chain_end": {"event": "on_chain_end", "name": "should_continue", "data": {"output": "agent"}},
+        "tool_start": {"event": "on_tool_start", "name": "appium_click",
+                       "data": {"input": {"elementUUID": "00000000-0000-0000-0000-000000000001"}}},
+        "tool_end": {"event": "on_tool_end", "name": "generate_locators",
+                     "data": {"output": ToolMessage(content=synthetic_locators(50), tool_call_id="call_1")}},
+        "chat_model_end": {"event": "on_chat_model_end", "name": "ChatOpenAI",
+                           "data": {"output": AIMessage(content="Chromeを起動しました。" * 20)}},
+        "chat_model_stream": {"event": "on_chat_model_stream", "name": "ChatOpenAI", "data": {}},
+    }
+
+
+# --- 計測 ---
+def measure(fn: Callable[[], object], min_time: float, repeat: int) -> dict:
+    """fn の1回あたりの時間（中央値）とメモリ割り当てを計測する"""
+    fn()  # ウォームアップ
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / repeat or loops >= 1 << 20:
+            break
+        loops *= 2
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        timings.append((time.perf_counter() - started) / loops)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    result = fn()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    per_op = statistics.median(timings)
+    return {
+        "us_per_op": round(per_op * 1e6, 2),
+        "ops_per_sec": round(1 / per_op, 1) if per_op else None,
+        "stdev_pct": round(statistics.pstdev(timings) / per_op * 100, 1) if per_op else 0.0,
+        "peak_kib": round((peak - before) / 1024, 1),
+        "retained_kib": round((after - before) / 1024, 1),
+        "loops": loops,
+    }
+
+
+def build_benchmarks(screenshots: dict[str, str], locators: dict[str, str]) -> dict[str, Callable[[], object]]:
+    benchmarks: dict[str, Callable[[], object]] = {}
+
+    # 画面観測の画像処理
+    for label, screenshot in screenshots.items():
+        def screen(screenshot=screenshot):
+            observation = ScreenObservation(locator="")
+            process_screenshot(screenshot, observation)
+            return observation
+        benchmarks[f"screen/process_screenshot[{label}]"] = screen
+
+        # 変化領域（画面中央のダイアログ程度）の切り出しと縮小画像のエンコード
+        observation = screen()
+        change = ScreenChange(kind=MINOR, regions=[(0.1, 0.4, 0.9, 0.6)])
+        benchmarks[f"screen/prepare_images[{label}]"] = (
+            lambda observation=observation, change=change: prepare_images(observation, change))
+
+    # EventLogger.dispatch（コンソール出力は捨てる）
+    logger = EventLogger(verbose=True)
+    sink = open(os.devnull, "w")
+    for kind, event in logger_events().items():
+        def dispatch(event=event):
+            with contextlib.redirect_stdout(sink):
+                logger.dispatch(event)
+        benchmarks[f"logger/dispatch[{kind}]"] = dispatch
+
+    # プロンプト組み立て（LLMは呼ばない）
+    planner = SimplePlanner(llm=ChatOpenAI(model="gpt-4.1", api_key="bench"), history=StepHistory(blob_dir=None))
+    image_url = "data:image/jpeg;base64,..."
+    query = KNOWHOW + "Androidで動作するChromeを起動して、yahoo.co.jp を開いてください"
+    for label, locator in locators.items():
+        benchmarks[f"planner/create_plan[{label}]"] = (
+            lambda locator=locator: planner.build_plan_messages(query, locator, image_url))
+        state = {"input": query, "plan": ["Chromeを起動する", "URLを入力する", "ページを確認する"],
+                 "past_steps": make_past_steps(10), "response": "", "replan_count": 1}
+        benchmarks[f"planner/replan[{label}]"] = (
+            lambda locator=locator, state=state: planner.build_replan_messages(state, locator, image_url))
+
+    # past_steps の蓄積（operator.add のreducer）と replan での文字列化
+    for count in PAST_STEP_COUNTS:
+        steps = make_past_steps(count)
+
+        def accumulate(steps=steps):
+            past_steps: list = []
+            for step in steps:
+                past_steps = operator.add(past_steps, [step])
+            return str(past_steps)
+        benchmarks[f"past_steps/accumulate[{count}]"] = accumulate
+
+        # 同じ実行の中で毎回のリプランごとに要約する（要約済みの部分は再利用される）
+        history = StepHistory(blob_dir=None)
+        benchmarks[f"past_steps/render[{count}]"] = (
+            lambda steps=steps, history=history: history.render(steps))
+    return benchmarks
+
+
+def make_past_steps(count: int) -> list[tuple]:
+    rng = random.Random(count)
+    return [(f"ステップ{i}: 要素 item_{rng.randrange(30)} をタップする",
+             "タップしました。" + "画面が更新されました。" * rng.randrange(1, 20)) for i in range(count)]
+
+
+# --- 結果の出力 ---
+def git_revision() -> str:
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results: dict[str, dict], baseline: dict[str, dict] | None = None):
+    header = f"{'benchmark':<44} {'us/op':>11} {'ops/s':>10} {'±%':>5} {'peak KiB':>9} {'kept KiB':>9}"
+    if baseline is not None:
+        header += f" {'Δtime':>8} {'Δpeak':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        line = (f"{name:<44} {r['us_per_op']:>11.2f} {r['ops_per_sec'] or 0:>10.1f} {r['stdev_pct']:>5.1f}"
+                f" {r['peak_kib']:>9.1f} {r['retained_kib']:>9.1f}")
+        base = (baseline or {}).get(name)
+        if base:
+            line += f" {_delta(r['us_per_op'], base['us_per_op']):>8} {_delta(r['peak_kib'], base['peak_kib']):>8}"
+        print(line)
+
+
+def _delta(value: float, base: float) -> str:
+    if not base:
+        return "-"
+    return f"{(value - base) / base * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="エージェントのローカル処理のマイクロベンチマーク")
+    parser.add_argument("--trace", help="入力データに使う記録済みトレースのディレクトリ")
+    parser.add_argument("--filter", default="", help="名前にこの文字列を含むベンチマークだけ実行する")
+    parser.add_argument("--min-time", type=float, default=0.5, help="1ベンチマークあたりの計測時間（秒）")
+    parser.add_argument("--repeat", type=int, default=5, help="計測の繰り返し回数")
+    parser.add_argument("--json", metavar="PATH", help="結果をJSONで保存する")
+    parser.add_argument("--compare", metavar="PATH", help="以前に保存したJSONと比較する")
+    args = parser.parse_args()
+
+    screenshots, locators = load_inputs(args.trace)
+    benchmarks = {name: fn for name, fn in build_benchmarks(screenshots, locators).items() if args.filter in name}
+
+    results = {}
+    for name, fn in benchmarks.items():
+        results[name] = measure(fn, args.min_time, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        baseline = previous["results"]
+        print(f"比較対象: {previous.get('revision')} ({args.compare})")
+    print(f"revision: {git_revision()}  python: {platform.python_version()}  input: {args.trace or 'synthetic'}")
+    print_results(results, baseline)
+
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"revision": git_revision(), "python": platform.python_version(),
+                       "input": args.trace or "synthetic", "results": results}, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""コンテンツアドレス方式のBlobストア
+
+バイト列をSHA-256ハッシュで保存し、同じ内容は1つのファイルにまとめる。
+ログの大きなペイロードやスクリーンショットを、メモリ上では短い参照だけで持つために使う。
+"""
+import hashlib
+import os
+from pathlib import Path
+
+REF_PREFIX = "blob:"
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+    """ディスク上のコンテンツアドレスストア"""
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def put(self, data: bytes | str) -> str:
+        """データを保存してハッシュを返す（既に同じ内容があれば書き込まない）"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        digest = content_hash(data)
+        path = self.path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{digest}.{os.getpid()}.tmp")
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+        return digest
+
+    def resolve(self, ref: str) -> Path | None:
+        """ハッシュ、またはref()形式の短い参照からファイルパスを求める"""
+        digest = ref.removeprefix(REF_PREFIX)
+        if len(digest) == 64:
+            path = self.path(digest)
+            return path if path.exists() else None
+        candidates = (p for p in self.root.glob(f"{digest[:2]}/{digest}*") if not p.name.endswith(".tmp"))
+        return next(candidates, None)
+
+    def get(self, ref: str) -> bytes:
+        path = self.resolve(ref)
+        if path is None:
+            raise KeyError(ref)
+        return path.read_bytes()
+
+    def get_text(self, ref: str) -> str:
+        return self.get(ref).decode("utf-8")
+
+    def __contains__(self, ref: str) -> bool:
+        return self.resolve(ref) is not None
+
+    @staticmethod
+    def ref(digest: str) -> str:
+        """ログやプロンプトに埋め込む短い参照"""
+        return f"{REF_PREFIX}{digest[:16]}"
@@ -0,0 +1,221 @@
+"""画面ごとの要素検索キャッシュ
+
+ReActエージェントは appium_click / appium_set_value の前に、変化していない画面で同じロケーターの
+appium_find_element を何度も呼ぶことが多い。1回ごとにAppiumへの往復が発生し、遅いエミュレーターでは
+execute_step の時間の大きな割合を占める。
+
+ElementCache はツールを包み、find_element の結果を（ツール名, 引数）ごとに記憶する。記憶した結果は
+次の場合に破棄する。
+- 画面を操作するツール（click / set_value / scroll など、tool_registry.is_mutating）が呼ばれた
+- セッションを作り直すツールが呼ばれた（要素UUIDの対応も忘れる）
+- スクリーンショット（輝度グリッド）または generate_locators の出力が前回から変わった
+
+キャッシュから返した要素UUIDが古くなっていた（stale element / no such element）場合は、
+同じロケーターで要素を検索し直し、新しいUUIDで呼び出しを1回だけ再試行する。
+以降、古いUUIDを使った呼び出しは新しいUUIDに置き換える。
+"""
+import asyncio
+import json
+import re
+import time
+
+from colorama import Fore
+from langchain_core.tools import BaseTool
+
+from frame_store import FRAME_REF_PATTERN, is_frame_ref, open_frame
+from macro_library import UUID_PATTERN
+from screen_diff import ScreenChangeThresholds, diff_grids, locator_hash, luminance_grid
+from screen_observation import _image_executor
+from tool_hooks import call_tool_coroutine, tool_content, wrap_tools
+from tool_registry import infer_capabilities, is_mutating
+
+# 要素UUIDが無効になったことを示すエラー
+STALE_PATTERN = re.compile(r"stale element|StaleElementReference|no such element|NoSuchElement", re.IGNORECASE)
+
+
+def _is_lookup(tool_name: str) -> bool:
+    return "find_element" in tool_name
+
+
+def _is_observation(tool_name: str) -> bool:
+    return "screenshot" in tool_name or tool_name == "generate_locators"
+
+
+def _screen_grid(screenshot: str) -> bytes:
+    """スクリーンショットの輝度グリッド（同期処理）"""
+    with open_frame(screenshot) as img:
+        return luminance_grid(img)
+
+
+def _replace_uuids(value, aliases: dict[str, str]):
+    """引数に含まれる要素UUIDを aliases で置き換える（対応のないUUIDはそのまま）"""
+    if isinstance(value, str):
+        return UUID_PATTERN.sub(lambda m: aliases.get(m.group(0), m.group(0)), value)
+    if isinstance(value, dict):
+        return {k: _replace_uuids(v, aliases) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_replace_uuids(v, aliases) for v in value]
+    return value
+
+
+class ElementCache:
+    """画面が変わるまで要素検索の結果を再利用する
+
+    Args:
+        max_entries: 記憶する検索結果の上限
+        thresholds: 画面変化判定のしきい値（変化セル比率が unchanged_ratio を超えたら画面が変わったとみなす）
+    """
+
+    def __init__(self, max_entries: int = 128, thresholds: ScreenChangeThresholds | None = None):
+        self.max_entries = max_entries
+        self.thresholds = thresholds or ScreenChangeThresholds()
+        self._entries: dict[tuple[str, str], tuple[object, float]] = {}  # (ツール名, 引数) → (結果, 検索時間)
+        self._epoch = 0  # 破棄するたびに増やす（検索中に画面が変わった結果を記憶しないため）
+        self._locators: dict[str, tuple[BaseTool, dict]] = {}  # 要素UUID → 検索したツールと引数
+        self._aliases: dict[str, str] = {}  # 古い要素UUID → 検索し直した要素UUID
+        self._frame: tuple[str | None, bytes] | None = None  # 前回のスクリーンショット（参照, 輝度グリッド）
+        self._locator_hash: str | None = None
+        self.stats = {"hits": 0, "misses": 0, "invalidated": 0, "stale_retries": 0, "saved_seconds": 0.0}
+
+    def invalidate(self):
+        """記憶した検索結果をすべて破棄する"""
+        self._epoch += 1
+        if self._entries:
+            self.stats["invalidated"] += 1
+            self._entries.clear()
+
+    def reset(self):
+        """検索結果・要素UUIDの対応・前回の観測をすべて忘れる"""
+        self.invalidate()
+        self._locators.clear()
+        self._aliases.clear()
+        self._frame = None
+        self._locator_hash = None
+
+    def wrap_tools(self, tools: list[BaseTool]) -> list[BaseTool]:
+        """要素検索の結果を再利用し、古い要素UUIDを検索し直すツールに包む"""
+        async def around(tool, kwargs, call):
+            if _is_lookup(tool.name):
+                return await self._lookup(tool, kwargs, call)
+            if _is_observation(tool.name):
+                result = await call(kwargs)
+                await self._observe(tool, result)
+                return result
+            capabilities = infer_capabilities(tool.name)
+            if "session" in capabilities:
+                # 新しいセッションでは以前の要素UUIDはすべて無効になる
+                self.reset()
+                return await call(kwargs)
+            if "element" not in capabilities and not is_mutating(tool.name):
+                return await call(kwargs)
+            if not is_mutating(tool.name):
+                return await self._call_element(tool, kwargs, call)
+            self.invalidate()
+            try:
+                return await self._call_element(tool, kwargs, call)
+            finally:
+                # 操作中に並行して検索された結果も破棄する
+                self.invalidate()
+
+        return wrap_tools(tools, around)
+
+    async def _lookup(self, tool: BaseTool, kwargs: dict, call):
+        key = (tool.name, json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str))
+        cached = self._entries.get(key)
+        if cached is not None:
+            result, elapsed = cached
+            self.stats["hits"] += 1
+            self.stats["saved_seconds"] += elapsed
+            print(Fore.CYAN + f"要素キャッシュ: {key[1]} の検索結果を再利用します")
+            return result
+
+        epoch = self._epoch
+        started = time.perf_counter()
+        result = await call(kwargs)
+        elapsed = time.perf_counter() - started
+        self.stats["misses"] += 1
+        uuids = UUID_PATTERN.findall(str(tool_content(tool, result)))
+        for uuid in uuids:
+            self._locators[uuid] = (tool, kwargs)
+        if uuids and epoch == self._epoch:
+            if len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (result, elapsed)
+        return result
+
+    async def _observe(self, tool: BaseTool, result):
+        """観測ツールの出力が前回から変わっていれば、記憶した検索結果を破棄する"""
+        content = tool_content(tool, result)
+        if not isinstance(content, str) or not content:
+            return
+        if tool.name == "generate_locators":
+            digest = locator_hash(content)
+            if self._locator_hash is not None and digest != self._locator_hash:
+                self.invalidate()
+            self._locator_hash = digest
+            return
+
+        match = FRAME_REF_PATTERN.match(content) if is_frame_ref(content) else None
+        ref = match.group(0) if match else None
+        if ref is not None and self._frame is not None and ref == self._frame[0]:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+            grid = await loop.run_in_executor(_image_executor, _screen_grid, content)
+        except Exception:
+            # 画像として読めない出力（エラーメッセージなど）は画面の判定に使わない
+            return
+        if self._frame is not None:
+            ratio, _ = diff_grids(self._frame[1], grid, self.thresholds.ignore_rows)
+            if ratio > self.thresholds.unchanged_ratio:
+                self.invalidate()
+        self._frame = (ref, grid)
+
+    async def _call_element(self, tool: BaseTool, kwargs: dict, call):
+        """要素UUIDを使うツールを呼び、UUIDが古くなっていれば検索し直して1回だけ再試行する"""
+        kwargs = _replace_uuids(kwargs, self._aliases)
+        try:
+            result = await call(kwargs)
+            error = None
+        except Exception as e:
+            result, error = None, e
+        message = str(error) if error is not None else str(tool_content(tool, result))
+        uuids = [uuid for uuid in dict.fromkeys(UUID_PATTERN.findall(json.dumps(kwargs, default=str)))
+                 if uuid in self._locators]
+        if not uuids or not STALE_PATTERN.search(message):
+            if error is not None:
+                raise error
+            return result
+
+        refreshed = {}
+        for uuid in uuids:
+            new_uuid = await self._refind(uuid)
+            if new_uuid is None:
+                if error is not None:
+                    raise error
+                return result
+            refreshed[uuid] = new_uuid
+        self._aliases = {old: refreshed.get(new, new) for old, new in self._aliases.items()} | refreshed
+        self.stats["stale_retries"] += 1
+        print(Fore.YELLOW + f"要素キャッシュ: 要素UUIDが古くなっていたため、検索し直して {tool.name} を再実行します")
+        return await call(_replace_uuids(kwargs, refreshed))
+
+    async def _refind(self, uuid: str) -> str | None:
+        """要素UUIDを得たときと同じロケーターで検索し直し、新しいUUIDを返す"""
+        tool, kwargs = self._locators[uuid]
+        result = await call_tool_coroutine(tool, kwargs)
+        match = UUID_PATTERN.search(str(tool_content(tool, result)))
+        if match is None:
+            return None
+        self._locators[match.group(0)] = (tool, kwargs)
+        key = (tool.name, json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str))
+        if key in self._entries:
+            self._entries[key] = (result, self._entries[key][1])
+        return match.group(0)
+
+    def format_stats(self) -> str:
+        s = self.stats
+        total = s["hits"] + s["misses"]
+        rate = s["hits"] / total if total else 0.0
+        return (f"要素キャッシュ: ヒット {s['hits']}/{total}（{rate:.0%}）, 破棄 {s['invalidated']}, "
+                f"再検索 {s['stale_retries']}, 省略した検索時間 約{s['saved_seconds']:.1f}秒")
@@ -1,9 +1,32 @@
+import asyncio
+import json
+import os
+import tempfile
 import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterator, TextIO
 import allure
 from colorama import Fore, init
+from blob_store import BlobStore
+from frame_store import FRAME_PREFIX, FRAME_REF_PATTERN, FrameStore, get_frame_store
+from latency_stats import LatencyTracker
 
 init(autoreset=True)
 
+
+@dataclass
+class EventRecord:
+    """イベントログの1レコード"""
+    ts: float
+    text: str
+    size: int = 0  # 切り詰め前の文字数
+    ref: str | None = None  # 退避した完全なペイロードの参照
+
+    def format(self) -> str:
+        return f"{self.ts:.3f}: {self.text}"
+
+
 class EventLogger:
     """Pretty-Logger for LangGraph astream_events.
     This class prints only observable signals (no chain-of-thought):
@@ -12,12 +35,215 @@ class EventLogger:
     - final LLM outputs when provider buffers
     - tool start/end with args and outputs
     Configuration can be passed at construction for reuse.
+
+    async_sink=True の場合、ハンドラーはレコードを有界キューに積むだけで戻り、
+    バックグラウンドタスクがまとめて書き出す。スクリーンショットの参照への置き換えとファイル出力は
+    ワーカースレッドで、コンソール出力・リングバッファへの追加・Allure添付はイベントループのスレッドで行う。
+    終了時は aclose()（途中で確認する場合は aflush()）を呼ぶこと。
+
+    イベントログはリングバッファ（max_records件）に保持する。max_payload_chars を超える
+    メッセージは切り詰め、spill_dir を指定した場合は完全な内容をディスクに退避して参照を残す。
+    log_file を指定すると全レコードを逐次ファイルに書き出し、完全なログの出力元にする。
+    メッセージ中のbase64スクリーンショットはフレームストアの参照（frame:...）に置き換え、
+    参照されたフレームは実行ごとに1回だけ画像としてAllureに添付する。
+
+    dispatch() したイベントは run_id で開始と終了を対応付け、ノード・ツール・LLM呼び出しごとの
+    レイテンシーを latency に集計する（実行終了時に attach_latency_report() で出力する）。
     """
 
     def __init__(self,
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 async_sink: bool = False,
+                 queue_size: int = 1000,
+                 batch_size: int = 100,
+                 max_records: int = 5000,
+                 max_payload_chars: int = 2000,
+                 spill_dir: str | None = None,
+                 log_file: str | None = None,
+                 frame_store: FrameStore | None = None):
         self.verbose = verbose
-        self.event_log = []  # イベントログを保持
+        self.records: deque[EventRecord] = deque(maxlen=max_records)  # イベントログを保持
+        self.evicted = 0  # リングバッファから押し出されたレコード数
+        self.max_payload_chars = max_payload_chars
+        self.spill_store = BlobStore(spill_dir) if spill_dir else None
+        self.log_file = log_file
+        self._log_fp: TextIO | None = open(log_file, "a", encoding="utf-8") if log_file else None
+        self.async_sink = async_sink
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.dropped = 0  # キューあふれで破棄したレコード数
+        self._queue: asyncio.Queue | None = None
+        self._sink_task: asyncio.Task | None = None
+        self.latency = LatencyTracker()
+        self.frame_store = frame_store or get_frame_store()
+        self._attached_frames: set[str] = set()
+
+    def _write(self, color: str, console_text: str | None, log_text: str, attach_name: str | None = None):
+        """1件のログを出力する（async_sink時はキューに積むだけ）
+
+        Args:
+            color: コンソール出力の色
+            console_text: コンソールに出力する文字列（Noneなら出力しない）
+            log_text: イベントログに記録する文字列
+            attach_name: Allure添付名（Noneなら添付しない）
+        """
+        record = (time.time(), color, console_text, log_text, attach_name)
+        if self.async_sink and self._ensure_sink():
+            if self._queue.full():
+                # 最も古いレコードを捨ててでもイベントループを止めない
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self.dropped += 1
+            self._queue.put_nowait(record)
+        else:
+            self._write_records([record])
+
+    def _make_record(self, ts: float, text: str) -> EventRecord:
+        """上限を超えるメッセージを切り詰め、必要なら完全な内容をディスクに退避する"""
+        if len(text) <= self.max_payload_chars:
+            return EventRecord(ts, text, len(text))
+        ref = None
+        note = f"...（{len(text) - self.max_payload_chars}文字省略）"
+        if self.spill_store is not None:
+            ref = BlobStore.ref(self.spill_store.put(text))
+            note = f"...（{len(text) - self.max_payload_chars}文字省略, {ref}）"
+        return EventRecord(ts, text[:self.max_payload_chars] + note, len(text), ref)
+
+    def _replace_frames(self, records: list) -> list:
+        """メッセージ中のbase64スクリーンショットをフレームストアの参照に置き換える"""
+        replaced = []
+        for ts, color, console_text, log_text, attach_name in records:
+            new_log_text = self.frame_store.replace_frames(log_text)
+            if console_text is log_text:
+                console_text = new_log_text
+            elif console_text is not None:
+                console_text = self.frame_store.replace_frames(console_text)
+            replaced.append((ts, color, console_text, new_log_text, attach_name))
+        return replaced
+
+    def _write_records(self, records: list):
+        """レコードをコンソール・イベントログ・Allureに書き出す"""
+        self._publish(*self._prepare_records(records))
+
+    def _prepare_records(self, records: list) -> tuple[list, list[EventRecord], list[tuple[str, str, bool]]]:
+        """フレームの保存・ペイロードの退避・ログファイルへの書き込みを行う（async_sink時はワーカースレッドで実行する）
+
+        Returns:
+            (参照に置き換えたレコード, イベントログのレコード, 新たに添付するフレーム（参照, パス, PNGか）)
+        """
+        records = self._replace_frames(records)
+        stored = [self._make_record(ts, log_text) for ts, _, _, log_text, _ in records]
+        if self._log_fp is not None:
+            self._log_fp.write("".join(record.format() + "\n" for record in stored))
+            self._log_fp.flush()
+        return records, stored, self._new_frames(records)
+
+    def _publish(self, records: list, stored: list[EventRecord], frames: list[tuple[str, str, bool]]):
+        """コンソール出力・リングバッファへの追加・Allure添付を行う
+
+        allure_commons の添付先はスレッドごとのため、async_sink時もイベントループのスレッドで実行する。
+        """
+        lines = [color + self._truncate(text) for _, color, text, _, _ in records if text is not None]
+        if lines:
+            print("\n".join(lines))
+
+        if self.records.maxlen is not None:
+            self.evicted += max(len(self.records) + len(stored) - self.records.maxlen, 0)
+        self.records.extend(stored)
+
+        for ref, path, is_png in frames:
+            try:
+                allure.attach.file(path, name=f"Screenshot {ref}",
+                                   attachment_type=allure.attachment_type.PNG if is_png else allure.attachment_type.JPG)
+            except Exception:
+                pass
+        attachments = [(name, self._truncate(text)) for _, _, text, _, name in records if name is not None]
+        if not attachments:
+            return
+        if len(attachments) == 1:
+            name, body = attachments[0]
+        else:
+            name = f"Agent Events ({len(attachments)})"
+            body = "\n".join(text for _, text in attachments)
+        try:
+            allure.attach(body, name=name, attachment_type=allure.attachment_type.TEXT)
+        except Exception:
+            # Allure添付失敗は無視（テスト実行は継続）
+            pass
+
+    def _new_frames(self, records: list) -> list[tuple[str, str, bool]]:
+        """レコードで参照されたフレームのうち、まだ添付していないもの（参照, パス, PNGか）"""
+        refs = {match.group(0) for _, _, _, log_text, name in records
+                if name is not None and FRAME_PREFIX in log_text for match in FRAME_REF_PATTERN.finditer(log_text)}
+        frames = []
+        for ref in sorted(refs - self._attached_frames):
+            self._attached_frames.add(ref)
+            path = self.frame_store.resolve(ref)
+            if path is None:
+                continue
+            with open(path, "rb") as f:
+                is_png = f.read(4) == b"\x89PNG"
+            frames.append((ref, str(path), is_png))
+        return frames
+
+    def _truncate(self, text: str) -> str:
+        if len(text) <= self.max_payload_chars:
+            return text
+        return text[:self.max_payload_chars] + f"...（{len(text) - self.max_payload_chars}文字省略）"
+
+    def _ensure_sink(self) -> bool:
+        """バックグラウンドのシンクタスクを起動する（イベントループ外ではFalse）"""
+        if self._sink_task is not None and not self._sink_task.done():
+            return True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._sink_task = loop.create_task(self._drain())
+        return True
+
+    async def _drain(self):
+        """キューのレコードをまとめて書き出す"""
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                # フレームの保存（デコード・ハッシュ・書き込み）とファイル出力でイベントループを止めない
+                prepared = await asyncio.to_thread(self._prepare_records, batch)
+                self._publish(*prepared)
+            except Exception as e:
+                print(Fore.RED + f"EventLogger シンクエラー: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if self.dropped:
+                print(Fore.YELLOW + f"⚠️  EventLogger: キューあふれで {self.dropped} 件のログを破棄しました")
+                self.dropped = 0
+
+    async def aflush(self):
+        """キューに残っているレコードをすべて書き出す"""
+        if self._queue is not None and self._sink_task is not None and not self._sink_task.done():
+            await self._queue.join()
+
+    async def aclose(self):
+        """残りのレコードを書き出してシンクタスクを停止する"""
+        await self.aflush()
+        if self._sink_task is not None:
+            self._sink_task.cancel()
+            try:
+                await self._sink_task
+            except asyncio.CancelledError:
+                pass
+            self._sink_task = None
+        self.close()
+
+    def close(self):
+        """ログファイルを閉じる"""
+        if self._log_fp is not None:
+            self._log_fp.close()
+            self._log_fp = None
 
     def _log_and_attach(self, message: str, event_type: str = "Event"):
         """print実行とallure.attachを両方行うラッパー関数
@@ -26,64 +252,98 @@ class EventLogger:
             message: ログメッセージ
             event_type: イベントタイプ（Allure添付時の名前に使用）
         """
-        # コンソールに出力
-        print(Fore.BLUE + message)
-        
-        # イベントログに追加
-        self.event_log.append(f"{time.time():.3f}: {message}")
-        
-        # Allureに添付（リアルタイム）
+        # スクリーンショットの参照への置き換えは書き出し時に行う（async_sink時はシンク側）
+        self._write(Fore.BLUE, message, message, f"Agent {event_type}")
+
+    @property
+    def event_log(self) -> list[str]:
+        """保持しているイベントログ（整形済み文字列）"""
+        return [record.format() for record in self.records]
+
+    def iter_complete_log(self) -> Iterator[str]:
+        """完全なイベントログを1行ずつ返す（log_file指定時はファイルから読む）
+
+        async_sink時は先に aflush() を呼ぶこと。
+        """
+        if self.log_file:
+            if self._log_fp is not None:
+                self._log_fp.flush()
+            with open(self.log_file, encoding="utf-8") as f:
+                for line in f:
+                    yield line.rstrip("\n")
+            return
+        if self.evicted:
+            yield f"...（古いイベント {self.evicted} 件はリングバッファから削除済み）"
+        for record in list(self.records):
+            yield record.format()
+
+    def write_complete_log(self, fp: TextIO):
+        """完全なイベントログをファイルオブジェクトに書き出す（文字列全体を作らない）"""
+        for line in self.iter_complete_log():
+            fp.write(line + "\n")
+
+    def get_complete_log(self) -> str:
+        """完全なイベントログを取得（大きなログには iter_complete_log / write_complete_log を使う）"""
+        return "\n".join(self.iter_complete_log())
+
+    def attach_complete_log(self):
+        """完全なイベントログをAllureに添付（一時ファイル経由でストリーム出力）"""
         try:
-            allure.attach(
-                message,
-                name=f"Agent {event_type}",
-                attachment_type=allure.attachment_type.TEXT
-            )
+            if self.log_file:
+                if self._log_fp is not None:
+                    self._log_fp.flush()
+                allure.attach.file(self.log_file, name="Complete Agent Log",
+                                   attachment_type=allure.attachment_type.TEXT)
+                return
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".log", delete=False) as tmp:
+                self.write_complete_log(tmp)
+            try:
+                allure.attach.file(tmp.name, name="Complete Agent Log",
+                                   attachment_type=allure.attachment_type.TEXT)
+            finally:
+                os.unlink(tmp.name)
         except Exception:
-            # Allure添付失敗は無視（テスト実行は継続）
             pass
 
-    def get_complete_log(self) -> str:
-        """完全なイベントログを取得"""
-        return "\n".join(self.event_log)
+    def latency_report(self) -> dict:
+        """ノード・ツール・LLM呼び出しごとのレイテンシー集計（p50/p95/p99・件数・エラー数）"""
+        return self.latency.report()
 
-    def attach_complete_log(self):
-        """完全なイベントログをAllureに添付"""
+    def write_latency_report(self, path: str):
+        """レイテンシー集計をJSONファイルに書き出す"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.latency_report(), f, ensure_ascii=False, indent=1)
+
+    def attach_latency_report(self):
+        """レイテンシー集計をコンソールに出力し、JSONと表をAllureに添付する"""
+        table = self.latency.format_table()
+        self._write(Fore.CYAN, f"⏱️  レイテンシー集計\n{table}", f"LATENCY:\n{table}")
         try:
-            complete_log = self.get_complete_log()
-            allure.attach(
-                complete_log,
-                name="Complete Agent Log",
-                attachment_type=allure.attachment_type.TEXT
-            )
+            allure.attach(json.dumps(self.latency_report(), ensure_ascii=False, indent=1),
+                          name="Latency Report", attachment_type=allure.attachment_type.JSON)
+            allure.attach(table, name="Latency Summary", attachment_type=allure.attachment_type.TEXT)
         except Exception:
             pass
 
     def info(self, message: str):
         """情報メッセージをログ出力"""
-        print(Fore.CYAN + f"ℹ️  {message}")
-        self.event_log.append(f"{time.time():.3f}: INFO: {message}")
+        self._write(Fore.CYAN, f"ℹ️  {message}", f"INFO: {message}")
 
     def success(self, message: str):
         """成功メッセージをログ出力"""
-        print(Fore.GREEN + f"✅ {message}")
-        self.event_log.append(f"{time.time():.3f}: SUCCESS: {message}")
+        self._write(Fore.GREEN, f"✅ {message}", f"SUCCESS: {message}")
 
     def error(self, message: str):
         """エラーメッセージをログ出力"""
-        print(Fore.RED + f"❌ {message}")
-        self.event_log.append(f"{time.time():.3f}: ERROR: {message}")
+        self._write(Fore.RED, f"❌ {message}", f"ERROR: {message}")
 
     def warning(self, message: str):
         """警告メッセージをログ出力"""
-        print(Fore.YELLOW + f"⚠️  {message}")
-        self.event_log.append(f"{time.time():.3f}: WARNING: {message}")
+        self._write(Fore.YELLOW, f"⚠️  {message}", f"WARNING: {message}")
 
     def debug(self, message: str):
         """デバッグメッセージをログ出力（verbose時のみ）"""
-        if self.verbose:
-            print(Fore.MAGENTA + f"🔍 {message}")
-        self.event_log.append(f"{time.time():.3f}: DEBUG: {message}")
+        self._write(Fore.MAGENTA, f"🔍 {message}" if self.verbose else None, f"DEBUG: {message}")
 
     # --- public handlers ---
     def on_node_start(self, ev):
@@ -141,6 +401,7 @@ class EventLogger:
 
     def dispatch(self, ev):
         et = ev.get("event", "")
+        self.latency.observe(ev)
         
         if et.endswith("node_start"):
             self.on_node_start(ev)
@@ -0,0 +1,294 @@
+"""複数デバイスでのPlan-and-Execute並列実行（フリートモード）
+
+複数のcapabilityプロファイル（udid / エミュレーター）ごとにMCPセッションと
+コンパイル済みPlanExecuteグラフを用意し、asyncio上でシナリオを並列に実行する。
+
+- デバイスプール: 空いているデバイスにシナリオを割り当て、同時実行数を上限で制限
+- デバイスごとのセッション: jarvis-appium（stdio）をデバイス専用のcapabilitiesで起動、
+  またはプロファイルの "mcp_url" でSSEサーバーに接続。セッションはMCPSessionPoolで保持・再利用
+- ログの分離: 各シナリオのprint出力をデバイス別のログファイルに振り分け
+
+使い方:
+    uv run python fleet_runner.py --devices fleet.json --scenario "Chromeを起動して..." --each-device
+    uv run python fleet_runner.py --udid emulator-5554 --udid emulator-5556 --scenario "..." --scenario "..."
+"""
+import argparse
+import asyncio
+import contextvars
+import copy
+import json
+import re
+import sys
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from colorama import Fore, init
+from frame_store import get_frame_store
+from llm_rate_limiter import get_limiter
+from mcp_session_pool import MCPSessionPool
+from macro_library import MacroStore
+from planner_cache import PlannerCache
+from event_logger import EventLogger
+from test_plan_and_execute_agent import KNOWHOW, SERVER_CONFIG, build_app, run_scenario
+
+init(autoreset=True)
+
+# UiAutomator2の並列実行ではデバイスごとに異なるsystemPortが必要
+BASE_SYSTEM_PORT = 8200
+
+# 現在のタスクのログ出力先（Noneならコンソール）
+_current_log = contextvars.ContextVar("fleet_log", default=None)
+
+
+class _TaskLogRouter:
+    """タスクごとにprint出力の書き込み先を切り替えるstdoutプロキシ"""
+
+    def __init__(self, console):
+        self.console = console
+
+    def write(self, text):
+        target = _current_log.get()
+        return (target or self.console).write(text)
+
+    def flush(self):
+        target = _current_log.get()
+        (target or self.console).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.console, name)
+
+
+def _install_log_router():
+    if not isinstance(sys.stdout, _TaskLogRouter):
+        sys.stdout = _TaskLogRouter(sys.stdout)
+
+
+@dataclass
+class DeviceSlot:
+    """プール内の1デバイス"""
+    name: str
+    capabilities: dict
+    connection: dict
+    platform: str = "android"
+    app: object = None
+    past_steps: list = field(default_factory=list)
+    busy: bool = False
+
+
+@dataclass
+class ScenarioResult:
+    """1シナリオの実行結果"""
+    scenario: str
+    device: str
+    response: str = ""
+    error: str = ""
+    elapsed: float = 0.0
+    log_path: str = ""
+    past_steps: list = field(default_factory=list)
+
+
+def load_device_profiles(path: str) -> dict[str, dict]:
+    """デバイスプロファイル（名前 → capabilities）を読み込む
+
+    {"devices": {"pixel-1": {...}, ...}} 形式と、capabilities.json と同じ
+    {"android": {...}, "pixel-2": {...}} 形式のどちらにも対応する。
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data.get("devices", data)
+
+
+def profiles_from_udids(udids: list[str], base_capabilities: dict) -> dict[str, dict]:
+    """udidの一覧からデバイスプロファイルを作る"""
+    profiles = {}
+    for udid in udids:
+        capabilities = copy.deepcopy(base_capabilities)
+        capabilities["appium:udid"] = udid
+        profiles[udid] = capabilities
+    return profiles
+
+
+def assign_system_ports(profiles: dict[str, dict]) -> dict[str, dict]:
+    """Androidのプロファイルに、全デバイスの中での位置から systemPort を割り当てる
+
+    プロファイルをプロセスに分けて DevicePool を作る場合も、同じホストのデバイスでポートが重ならない。
+    """
+    assigned = {}
+    for index, (name, capabilities) in enumerate(profiles.items()):
+        capabilities = dict(capabilities)
+        if not capabilities.get("mcp_url") and capabilities.get("platformName", "android").lower() == "android":
+            capabilities.setdefault("appium:systemPort", BASE_SYSTEM_PORT + index)
+        assigned[name] = capabilities
+    return assigned
+
+
+class DevicePool:
+    """デバイスごとのMCPセッションとグラフを管理するプール"""
+
+    def __init__(self, profiles: dict[str, dict], work_dir: str = "fleet_logs", max_parallel: int | None = None,
+                 max_replan_count: int = 10, planner_cache: PlannerCache | None = None,
+                 macro_store: MacroStore | None = None):
+        self.work_dir = Path(work_dir)
+        # 全デバイスで共有する
+        self.planner_cache = planner_cache
+        self.macro_store = macro_store
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.max_replan_count = max_replan_count
+        self.devices = [self._make_slot(name, caps) for name, caps in assign_system_ports(profiles).items()]
+        self.sessions = MCPSessionPool({slot.name: slot.connection for slot in self.devices})
+        self._available = asyncio.Condition()
+        self._parallel = asyncio.Semaphore(max_parallel or len(self.devices))
+
+    def _make_slot(self, name: str, capabilities: dict) -> DeviceSlot:
+        capabilities = dict(capabilities)
+        mcp_url = capabilities.pop("mcp_url", None)
+        platform = capabilities.get("platformName", "android").lower()
+        if mcp_url:
+            connection = {"url": mcp_url, "transport": "sse"}
+        else:
+            caps_path = self.work_dir / f"{_safe_name(name)}.capabilities.json"
+            caps_path.write_text(json.dumps({platform: capabilities}, indent=2, ensure_ascii=False), encoding="utf-8")
+            connection = copy.deepcopy(SERVER_CONFIG["jarvis-appium"])
+            connection["env"] = {**connection.get("env", {}), "CAPABILITIES_CONFIG": str(caps_path.resolve())}
+        return DeviceSlot(name=name, capabilities=capabilities, connection=connection, platform=platform)
+
+    async def _ensure_ready(self, slot: DeviceSlot):
+        """デバイスのウォームなセッションを取得し、初回のみグラフを構築する"""
+        pooled = await self.sessions.acquire(slot.name, slot.platform)
+        slot.past_steps = pooled.setup_steps
+        if slot.app is None:
+            slot.app = build_app(pooled.tools, max_replan_count=self.max_replan_count, planner_cache=self.planner_cache,
+                                 macro_store=self.macro_store)
+
+    def _pick(self, name: str | None) -> DeviceSlot | None:
+        return next((slot for slot in self.devices if not slot.busy and name in (None, slot.name)), None)
+
+    @asynccontextmanager
+    async def acquire(self, name: str | None = None):
+        """空いているデバイス（nameを指定した場合はそのデバイス）を1台借りる"""
+        async with self._parallel:
+            async with self._available:
+                await self._available.wait_for(lambda: self._pick(name) is not None)
+                slot = self._pick(name)
+                slot.busy = True
+            try:
+                await self._ensure_ready(slot)
+                yield slot
+            finally:
+                async with self._available:
+                    slot.busy = False
+                    self._available.notify_all()
+
+    async def aclose(self):
+        await self.sessions.aclose()
+        for slot in self.devices:
+            slot.app = None
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", name)
+
+
+async def run_on_pool(pool: DevicePool, scenario: str, index: int, device_name: str | None = None,
+                      knowhow: str = KNOWHOW, logger: EventLogger | None = None,
+                      on_acquired: Callable[[DeviceSlot], None] | None = None) -> ScenarioResult:
+    """プールのデバイスで1シナリオを実行する（print出力はデバイス別ログへ）
+
+    on_acquired はデバイスを借りて実行を始める直前に呼ぶ（デバイスの空き待ちを実行時間に含めないため）。
+    """
+    async with pool.acquire(device_name) as slot:
+        if on_acquired is not None:
+            on_acquired(slot)
+        log_dir = pool.work_dir / _safe_name(slot.name)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        log_path = log_dir / f"{index:03d}-{int(time.time())}.log"
+        result = ScenarioResult(scenario=scenario, device=slot.name, log_path=str(log_path))
+
+        print(Fore.CYAN + f"[{slot.name}] シナリオ#{index} 開始: {scenario}")
+        started = time.perf_counter()
+        with open(log_path, "w", encoding="utf-8") as log_file:
+            token = _current_log.set(log_file)
+            try:
+                final = await run_scenario(slot.app, scenario, slot.past_steps, knowhow=knowhow, logger=logger)
+                result.response = final.get("response", "")
+                result.error = final.get("error", "")
+                result.past_steps = final.get("past_steps", [])
+            except Exception as e:
+                print(f"シナリオ実行エラー: {e}")
+                result.error = str(e)
+            finally:
+                _current_log.reset(token)
+        result.elapsed = time.perf_counter() - started
+
+        color = Fore.RED if result.error else Fore.GREEN
+        print(color + f"[{slot.name}] シナリオ#{index} 終了 ({result.elapsed:.1f}s): {result.error or result.response}")
+        return result
+
+
+async def run_fleet(profiles: dict[str, dict], scenarios: list[str], each_device: bool = False,
+                    max_parallel: int | None = None, work_dir: str = "fleet_logs",
+                    use_planner_cache: bool = True, use_macros: bool = True) -> list[ScenarioResult]:
+    """シナリオをデバイスプールで並列実行する
+
+    Args:
+        each_device: Trueなら各シナリオを全デバイスで実行する。Falseなら空いているデバイスに割り当てる
+        use_planner_cache: プランナー応答キャッシュを全デバイスで共有して使う
+        use_macros: 保存済みマクロを試し、成功した実行をマクロとして保存する
+    """
+    _install_log_router()
+    planner_cache = PlannerCache() if use_planner_cache else None
+    pool = DevicePool(profiles, work_dir=work_dir, max_parallel=max_parallel, planner_cache=planner_cache,
+                      macro_store=MacroStore() if use_macros else None)
+    try:
+        if each_device:
+            jobs = [(scenario, slot.name) for scenario in scenarios for slot in pool.devices]
+        else:
+            jobs = [(scenario, None) for scenario in scenarios]
+        return await asyncio.gather(*(
+            run_on_pool(pool, scenario, i, device_name) for i, (scenario, device_name) in enumerate(jobs)
+        ))
+    finally:
+        await pool.aclose()
+        if planner_cache:
+            print(Fore.CYAN + planner_cache.format_stats())
+            planner_cache.close()
+        print(Fore.CYAN + get_limiter().format_stats())
+        print(Fore.CYAN + get_frame_store().format_stats())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="複数デバイスでPlan-and-Executeシナリオを並列実行する")
+    parser.add_argument("--devices", help="デバイスプロファイルのJSONファイル（名前 → capabilities）")
+    parser.add_argument("--udid", action="append", default=[], help="capabilities.json の android プロファイルを元にudidを差し替えて追加")
+    parser.add_argument("--capabilities", default="capabilities.json", help="--udid 指定時の元になるcapabilities")
+    parser.add_argument("--scenario", action="append", default=[], help="実行するシナリオ（複数指定可）")
+    parser.add_argument("--each-device", action="store_true", help="各シナリオを全デバイスで実行する")
+    parser.add_argument("--max-parallel", type=int, default=None, help="同時に使用するデバイス数の上限")
+    parser.add_argument("--log-dir", default="fleet_logs", help="デバイス別ログの出力先")
+    parser.add_argument("--no-planner-cache", action="store_true", help="プランナー応答キャッシュを使わない")
+    parser.add_argument("--no-macros", action="store_true", help="マクロの再実行と保存を行わない")
+    args = parser.parse_args()
+
+    profiles = load_device_profiles(args.devices) if args.devices else {}
+    if args.udid:
+        base = load_device_profiles(args.capabilities)["android"]
+        profiles.update(profiles_from_udids(args.udid, base))
+    if not profiles:
+        parser.error("--devices または --udid でデバイスを指定してください")
+    scenarios = args.scenario or ["Androidで動作するChromeを起動して、yahoo.co.jp を開いてください"]
+
+    results = await run_fleet(profiles, scenarios, each_device=args.each_device,
+                              max_parallel=args.max_parallel, work_dir=args.log_dir,
+                              use_planner_cache=not args.no_planner_cache, use_macros=not args.no_macros)
+
+    print(Fore.CYAN + "=== フリート実行結果 ===")
+    for result in results:
+        status = Fore.RED + "NG" if result.error else Fore.GREEN + "OK"
+        print(f"{status} [{result.device}] {result.elapsed:.1f}s {result.scenario} -> {result.log_path}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
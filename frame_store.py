@@ -0,0 +1,158 @@
+"""スクリーンショットのフレームストア
+
+appium_screenshot の結果（数百KBのbase64文字列）は、ReActエージェントのツールメッセージ・
+EventLogger のツールイベント・Allure添付にそのまま流れ、同じ画面が何度もメモリとログに複製される。
+
+FrameStore はデコードしたフレームをハッシュでディスクに保存し（同じ画面は1ファイル）、
+ツールの出力を「frame:<hash>」という短い参照に置き換える。画像が必要な処理（画面観測・マクロの画面照合）は
+load_frame() で参照から読み込む。合計サイズが上限を超えたら、最後に使われた時刻が古いフレームから削除する。
+"""
+import base64
+import io
+import os
+import re
+from pathlib import Path
+
+from PIL import Image
+from langchain_core.tools import BaseTool
+
+from blob_store import BlobStore, content_hash
+from tool_hooks import wrap_tools
+
+FRAME_PREFIX = "frame:"
+DEFAULT_FRAME_DIR = Path(os.environ.get("TEST_ROBOT_CACHE_DIR", Path.home() / ".cache" / "test_robot")) / "frames"
+
+FRAME_REF_PATTERN = re.compile(FRAME_PREFIX + r"([0-9a-f]{16,64})")
+# base64のPNG / JPEG（データURLを含む）。短い文字列は対象にしない
+_FRAME_BASE64 = re.compile(r"(?:data:image/(?:png|jpeg);base64,)?(?:iVBORw0KGgo|/9j/)[A-Za-z0-9+/]{1000,}={0,2}")
+
+
+class FrameStore(BlobStore):
+    """スクリーンショットをハッシュで保存するストア（サイズ上限を超えたら古いものから削除する）
+
+    Args:
+        root: 保存先のディレクトリ
+        max_bytes: フレームの合計サイズの上限
+    """
+
+    def __init__(self, root: str | Path = DEFAULT_FRAME_DIR, max_bytes: int = 512 * 1024 * 1024):
+        super().__init__(root)
+        self.max_bytes = max_bytes
+        self._total: int | None = None  # 最初の書き込みまで数えない
+        self.stats = {"frames": 0, "deduplicated": 0, "evicted": 0, "bytes_in": 0}
+
+    @staticmethod
+    def ref(digest: str) -> str:
+        return f"{FRAME_PREFIX}{digest[:16]}"
+
+    def resolve(self, ref: str) -> Path | None:
+        return super().resolve(ref.removeprefix(FRAME_PREFIX))
+
+    def get(self, ref: str) -> bytes:
+        data = super().get(ref)
+        # 最後に使われた時刻（削除の順序）を更新する
+        path = self.resolve(ref)
+        if path is not None:
+            os.utime(path)
+        return data
+
+    def put_frame(self, screenshot: str | bytes) -> str:
+        """スクリーンショット（base64文字列・データURL・バイト列）を保存して参照を返す"""
+        data = _decode(screenshot) if isinstance(screenshot, str) else screenshot
+        self.stats["bytes_in"] += len(screenshot)
+        path = self.path(content_hash(data))
+        if path.exists():
+            self.stats["deduplicated"] += 1
+            os.utime(path)
+            return self.ref(path.name)
+        digest = self.put(data)
+        self.stats["frames"] += 1
+        self._total = (self._scan() if self._total is None else self._total + len(data))
+        if self._total > self.max_bytes:
+            self.evict()
+        return self.ref(digest)
+
+    def _files(self) -> list[Path]:
+        return [p for p in self.root.glob("??/*") if not p.name.endswith(".tmp")]
+
+    def _scan(self) -> int:
+        return sum(p.stat().st_size for p in self._files())
+
+    def evict(self, target: float = 0.8):
+        """最後に使われた時刻が古いフレームから、合計が max_bytes * target 以下になるまで削除する"""
+        files = sorted(((p.stat(), p) for p in self._files()), key=lambda item: item[0].st_mtime)
+        total = sum(stat.st_size for stat, _ in files)
+        for stat, path in files:
+            if total <= self.max_bytes * target:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+            self.stats["evicted"] += 1
+        self._total = total
+
+    def describe(self, ref: str) -> str:
+        """ツール出力に使う参照と画像の概要"""
+        path = self.resolve(ref)
+        if path is None:
+            return ref
+        try:
+            with Image.open(path) as img:
+                return f"{ref} ({Image.MIME.get(img.format, img.format)}, {img.width}x{img.height}, {path.stat().st_size // 1024}KB)"
+        except OSError:
+            return ref
+
+    def replace_frames(self, text: str) -> str:
+        """文字列に含まれるbase64のスクリーンショットを参照に置き換える"""
+        if len(text) < 1000:
+            return text
+        return _FRAME_BASE64.sub(lambda m: self.describe(self.put_frame(m.group(0))), text)
+
+    def wrap_tools(self, tools: list[BaseTool]) -> list[BaseTool]:
+        """ツールの出力に含まれるスクリーンショットを参照に置き換えるツールに包む"""
+        async def around(tool, kwargs, call):
+            result = await call(kwargs)
+            if isinstance(result, str):
+                return self.replace_frames(result)
+            if isinstance(result, tuple) and result and isinstance(result[0], str):
+                return (self.replace_frames(result[0]), *result[1:])
+            return result
+
+        return wrap_tools(tools, around)
+
+    def format_stats(self) -> str:
+        s = self.stats
+        return (f"フレームストア: 保存 {s['frames']}, 重複 {s['deduplicated']}, 削除 {s['evicted']}, "
+                f"入力 {s['bytes_in'] / 1024 / 1024:.1f}MB")
+
+
+def _decode(screenshot: str) -> bytes:
+    return base64.b64decode(screenshot.split(",", 1)[1] if screenshot.startswith("data:") else screenshot)
+
+
+def is_frame_ref(text: str) -> bool:
+    return isinstance(text, str) and text.startswith(FRAME_PREFIX)
+
+
+def load_frame(screenshot: str) -> bytes:
+    """スクリーンショット（フレームの参照、またはbase64文字列）の画像データ"""
+    if is_frame_ref(screenshot):
+        return get_frame_store().get(FRAME_REF_PATTERN.match(screenshot).group(0))
+    return _decode(screenshot)
+
+
+def open_frame(screenshot: str) -> Image.Image:
+    return Image.open(io.BytesIO(load_frame(screenshot)))
+
+
+_store: FrameStore | None = None
+
+
+def get_frame_store() -> FrameStore:
+    """プロセスで共有するフレームストア（TEST_ROBOT_FRAME_DIR / TEST_ROBOT_FRAME_MAX_MB で設定）"""
+    global _store
+    if _store is None:
+        _store = FrameStore(
+            os.environ.get("TEST_ROBOT_FRAME_DIR", DEFAULT_FRAME_DIR),
+            max_bytes=int(os.environ.get("TEST_ROBOT_FRAME_MAX_MB", 512)) * 1024 * 1024,
+        )
+    return _store
@@ -0,0 +1,215 @@
+"""PlanExecuteグラフのチェックポイント（SQLite）
+
+LangGraph はノードの実行が終わるたびにチェックポイントを保存する。
+SqliteCheckpointSaver はそれをローカルのSQLiteファイルに書き込み、プロセスが異常終了しても
+同じ thread_id で最後に完了したノードの次から実行を再開できるようにする。
+
+langgraph-checkpoint-sqlite と同じ役割だが、プランナーキャッシュと同じく標準ライブラリの sqlite3 だけで実装している。
+チェックポイントの値は LangGraph のシリアライザー（self.serde）で保存する。
+"""
+from __future__ import annotations
+
+import os
+import random
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+DEFAULT_CHECKPOINT_PATH = Path(os.environ.get("TEST_ROBOT_CACHE_DIR", Path.home() / ".cache" / "test_robot")) / "checkpoints.sqlite3"
+
+
+def new_thread_id(prefix: str = "scenario") -> str:
+    """再開時に指定するスレッドID（人が入力しやすい形式）"""
+    return f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{random.randrange(16 ** 4):04x}"
+
+
+class SqliteCheckpointSaver(BaseCheckpointSaver):
+    """チェックポイントをSQLiteに保存する
+
+    Args:
+        path: SQLiteファイルのパス
+        ttl: これより長く更新されていないスレッドは開いたときに削除する（秒）
+    """
+
+    def __init__(self, path: str | Path = DEFAULT_CHECKPOINT_PATH, ttl: float = 7 * 24 * 3600, *, serde=None):
+        super().__init__(serde=serde)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " thread_id TEXT, checkpoint_ns TEXT, checkpoint_id TEXT, parent_id TEXT,"
+            " type TEXT, checkpoint BLOB, metadata_type TEXT, metadata BLOB, created_at REAL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS writes ("
+            " thread_id TEXT, checkpoint_ns TEXT, checkpoint_id TEXT, task_id TEXT, idx INTEGER,"
+            " channel TEXT, type TEXT, value BLOB, task_path TEXT,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx))"
+        )
+        self._db.commit()
+        self.prune(ttl)
+
+    # --- 読み込み ---
+    def _tuple(self, row) -> CheckpointTuple:
+        thread_id, checkpoint_ns, checkpoint_id, parent_id, type_, data, metadata_type, metadata = row
+        writes = self._db.execute(
+            "SELECT task_id, channel, type, value FROM writes"
+            " WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                     "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed((type_, data)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, v))) for task_id, channel, t, v in writes],
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+                if parent_id else None
+            ),
+        )
+
+    _COLUMNS = "thread_id, checkpoint_ns, checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata"
+
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        configurable = config["configurable"]
+        thread_id, checkpoint_ns = configurable["thread_id"], configurable.get("checkpoint_ns", "")
+        if checkpoint_id := get_checkpoint_id(config):
+            row = self._db.execute(
+                f"SELECT {self._COLUMNS} FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchone()
+        else:
+            # チェックポイントIDは時刻順に並ぶ（uuid6）ため、最大のものが最新
+            row = self._db.execute(
+                f"SELECT {self._COLUMNS} FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+                " ORDER BY checkpoint_id DESC LIMIT 1",
+                (thread_id, checkpoint_ns),
+            ).fetchone()
+        return self._tuple(row) if row else None
+
+    def list(self, config: RunnableConfig | None, *, filter: dict[str, Any] | None = None,
+             before: RunnableConfig | None = None, limit: int | None = None) -> Iterator[CheckpointTuple]:
+        query = f"SELECT {self._COLUMNS} FROM checkpoints"
+        conditions, params = [], []
+        if config:
+            conditions.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if "checkpoint_ns" in config["configurable"]:
+                conditions.append("checkpoint_ns = ?")
+                params.append(config["configurable"]["checkpoint_ns"])
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id < ?")
+            params.append(before_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY checkpoint_id DESC"
+        count = 0
+        for row in self._db.execute(query, params).fetchall():
+            item = self._tuple(row)
+            if filter and not all(item.metadata.get(k) == v for k, v in filter.items()):
+                continue
+            yield item
+            count += 1
+            if limit is not None and count >= limit:
+                break
+
+    # --- 書き込み ---
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        configurable = config["configurable"]
+        thread_id, checkpoint_ns = configurable["thread_id"], configurable.get("checkpoint_ns", "")
+        type_, data = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_data = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        self._db.execute(
+            "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (thread_id, checkpoint_ns, checkpoint["id"], configurable.get("checkpoint_id"),
+             type_, data, metadata_type, metadata_data, time.time()),
+        )
+        self._db.commit()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        configurable = config["configurable"]
+        key = (configurable["thread_id"], configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"])
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, data = self.serde.dumps_typed(value)
+            rows.append((*key, task_id, WRITES_IDX_MAP.get(channel, idx), channel, type_, data, task_path))
+        # 特殊なチャネル（エラー・中断など）は上書きし、通常の書き込みは最初のものを残す
+        self._db.executemany(
+            "INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [r for r in rows if r[4] < 0])
+        self._db.executemany(
+            "INSERT OR IGNORE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [r for r in rows if r[4] >= 0])
+        self._db.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        self._db.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+        self._db.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+        self._db.commit()
+
+    def prune(self, ttl: float):
+        """最後の更新から ttl 秒以上経ったスレッドを削除する"""
+        threads = self._db.execute(
+            "SELECT thread_id FROM checkpoints GROUP BY thread_id HAVING MAX(created_at) < ?", (time.time() - ttl,)
+        ).fetchall()
+        for (thread_id,) in threads:
+            self.delete_thread(thread_id)
+
+    def threads(self) -> list[tuple[str, float]]:
+        """保存されているスレッドIDと最終更新時刻（新しい順）"""
+        return self._db.execute(
+            "SELECT thread_id, MAX(created_at) AS updated FROM checkpoints GROUP BY thread_id ORDER BY updated DESC"
+        ).fetchall()
+
+    # --- 非同期版（SQLiteへの書き込みは短いので同期版をそのまま使う） ---
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        return self.get_tuple(config)
+
+    async def alist(self, config: RunnableConfig | None, *, filter: dict[str, Any] | None = None,
+                    before: RunnableConfig | None = None, limit: int | None = None) -> AsyncIterator[CheckpointTuple]:
+        for item in self.list(config, filter=filter, before=before, limit=limit):
+            yield item
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        self.delete_thread(thread_id)
+
+    def get_next_version(self, current: str | None, channel: None) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,177 @@
+"""レイテンシーヒストグラム
+
+astream_events（v2）の開始・終了イベントを run_id で対応付け、
+グラフノード・MCPツール・LLM呼び出しごとの所要時間をヒストグラムに集計する。
+
+astream_events はエラーイベントを出さないため、終了イベントが来ないまま
+親の実行が終了したものはエラーとして数える。
+"""
+import math
+import time
+
+NODE = "node"
+TOOL = "tool"
+LLM = "llm"
+CATEGORIES = (NODE, TOOL, LLM)
+
+_START_EVENTS = {"on_chain_start": NODE, "on_tool_start": TOOL, "on_chat_model_start": LLM, "on_llm_start": LLM}
+_END_EVENTS = {"on_chain_end", "on_tool_end", "on_chat_model_end", "on_llm_end"}
+
+
+class LatencyHistogram:
+    """対数バケットのレイテンシーヒストグラム
+
+    Args:
+        min_value: 最小バケットの上限（秒）。これより短い値は最小バケットに入る
+        growth: バケット幅の倍率（パーセンタイルの相対誤差はおよそ (growth - 1) / 2）
+    """
+
+    def __init__(self, min_value: float = 1e-4, growth: float = 1.05):
+        self.min_value = min_value
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, seconds: float, error: bool = False):
+        seconds = max(seconds, 0.0)
+        index = 0 if seconds <= self.min_value else math.ceil(math.log(seconds / self.min_value) / self._log_growth)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.errors += int(error)
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """q（0〜100）パーセンタイルの近似値（秒）"""
+        if not self.count:
+            return 0.0
+        rank = max(math.ceil(self.count * q / 100), 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                upper = self.min_value * self.growth ** index
+                # バケットの中央値を代表値にし、実測の最小・最大で丸める
+                return min(max(upper / math.sqrt(self.growth) if index else upper, self.min), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """集計結果（時間はミリ秒）"""
+        def ms(seconds: float) -> float:
+            return round(seconds * 1000, 1)
+
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "p50_ms": ms(self.percentile(50)),
+            "p95_ms": ms(self.percentile(95)),
+            "p99_ms": ms(self.percentile(99)),
+            "mean_ms": ms(self.total / self.count) if self.count else 0.0,
+            "max_ms": ms(self.max),
+            "total_ms": ms(self.total),
+        }
+
+
+def _node_path(ev: dict) -> str:
+    """langgraph_checkpoint_ns からノードの階層名（例: agent/tools）を作る"""
+    metadata = ev.get("metadata") or {}
+    ns = metadata.get("langgraph_checkpoint_ns") or metadata.get("checkpoint_ns") or ""
+    parts = [part.split(":", 1)[0] for part in ns.split("|") if part]
+    return "/".join(parts) or metadata.get("langgraph_node", "")
+
+
+def _is_graph_node(ev: dict) -> bool:
+    metadata = ev.get("metadata") or {}
+    return bool(metadata.get("langgraph_node")) and metadata.get("langgraph_node") == ev.get("name")
+
+
+def _is_error_output(output) -> bool:
+    return getattr(output, "status", None) == "error"
+
+
+class LatencyTracker:
+    """イベントの開始・終了を対応付けてカテゴリ・名前ごとのヒストグラムに集計する"""
+
+    def __init__(self):
+        self.histograms: dict[str, dict[str, LatencyHistogram]] = {category: {} for category in CATEGORIES}
+        # run_id → (カテゴリ, 名前, 開始時刻, 親のrun_id一覧)
+        self._pending: dict[str, tuple[str, str, float, list[str]]] = {}
+        # 親が先に終わった子の run_id → 親の終了時刻
+        self._detached: dict[str, float] = {}
+
+    def observe(self, ev: dict, now: float | None = None):
+        """astream_events のイベントを1件取り込む"""
+        et = ev.get("event", "")
+        run_id = ev.get("run_id")
+        if not run_id:
+            return
+        now = time.perf_counter() if now is None else now
+
+        category = _START_EVENTS.get(et)
+        if category is not None:
+            if category == NODE and not _is_graph_node(ev):
+                return
+            self._pending[run_id] = (category, self._name(category, ev), now, list(ev.get("parent_ids") or []))
+            return
+
+        if et not in _END_EVENTS:
+            return
+        pending = self._pending.pop(run_id, None)
+        self._detached.pop(run_id, None)
+        if pending is not None:
+            category, name, started, _ = pending
+            error = _is_error_output((ev.get("data") or {}).get("output"))
+            self._record(category, name, now - started, error)
+        # 親より長く続く子の実行（バックグラウンドで生成を続ける計画など）は、自身の終了イベントを待つ
+        for rid, (_, _, _, parents) in self._pending.items():
+            if run_id in parents:
+                self._detached.setdefault(rid, now)
+        if not ev.get("parent_ids"):
+            # 実行全体が終わっても終了イベントが来なかった子の実行はエラーとして数える（時間は親の終了まで）
+            orphans = [rid for rid in self._detached if run_id in self._pending[rid][3]]
+            for rid in orphans:
+                category, name, started, _ = self._pending.pop(rid)
+                self._record(category, name, self._detached.pop(rid) - started, error=True)
+
+    @staticmethod
+    def _name(category: str, ev: dict) -> str:
+        if category == NODE:
+            return _node_path(ev) or ev.get("name", "<node>")
+        if category == LLM:
+            model = (ev.get("metadata") or {}).get("ls_model_name") or ev.get("name", "<llm>")
+            node = _node_path(ev)
+            return f"{node}:{model}" if node else model
+        return ev.get("name") or "<tool>"
+
+    def _record(self, category: str, name: str, seconds: float, error: bool = False):
+        histogram = self.histograms[category].get(name)
+        if histogram is None:
+            histogram = self.histograms[category][name] = LatencyHistogram()
+        histogram.record(seconds, error)
+
+    def report(self) -> dict:
+        """機械可読なレポート（カテゴリ → 名前 → 集計結果）"""
+        return {
+            "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "categories": {
+                category: {name: h.summary() for name, h in sorted(histograms.items())}
+                for category, histograms in self.histograms.items()
+            },
+            "unfinished": len(self._pending),
+        }
+
+    def format_table(self) -> str:
+        """人が読むための表形式"""
+        lines = [f"{'category':<6} {'name':<40} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'total ms':>10}"]
+        for category, histograms in self.histograms.items():
+            for name, h in sorted(histograms.items(), key=lambda item: -item[1].total):
+                s = h.summary()
+                lines.append(f"{category:<6} {name:<40} {s['count']:>6} {s['errors']:>6} {s['p50_ms']:>9.1f}"
+                             f" {s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f} {s['total_ms']:>10.1f}")
+        return "\n".join(lines)
@@ -0,0 +1,341 @@
+"""LLM呼び出しの共有レート制限とリトライ
+
+プランナー・エージェント・simple_chat のチャットモデルは、それぞれ独立にOpenAIを呼び出すため、
+複数のシナリオやデバイスを並列に実行するとレート制限（429）で実行全体が止まる。
+
+ここではプロセス内のすべてのOpenAI呼び出しが通るHTTPトランスポートを用意し、
+- 同時リクエスト数と1分あたりのトークン数（トークンバケット）を制限する
+- 対話セッション（INTERACTIVE）のリクエストをバッチ実行（BATCH）より先に通す
+- 429・5xx・通信エラー（httpx.TransportError）はジッター付きの指数バックオフで再試行する（Retry-Afterがあれば従う）
+
+待ち行列・実行中の数・接続プールはイベントループに結び付くため、イベントループごとに持つ
+（asyncio.run を続けて呼んでも、前のループのFutureや接続を使わない）。
+トークンバケットと統計はプロセス全体で共有する。
+
+使い方:
+    llm = ChatOpenAI(model="gpt-4.1", **rate_limited_client_kwargs())
+    with llm_priority(INTERACTIVE):
+        ...
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import random
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+import httpx
+import openai
+from colorama import Fore
+
+from locator_compactor import estimate_tokens
+
+INTERACTIVE = 0
+BATCH = 1
+
+# 画像1枚あたりのトークン数の見積もり（高解像度の画像1枚分）
+IMAGE_TOKENS = 765
+# detail=low の画像は大きさによらず一定
+LOW_DETAIL_IMAGE_TOKENS = 85
+# 応答の最大トークン数が指定されていない場合の出力トークン数の見積もり
+DEFAULT_OUTPUT_TOKENS = 1000
+
+_priority: ContextVar[int] = ContextVar("llm_priority", default=BATCH)
+
+
+@contextmanager
+def llm_priority(priority: int):
+    """このブロック内（と、ここから作られたタスク）のLLM呼び出しの優先度を設定する"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def estimate_request_tokens(body: bytes) -> int:
+    """Chat Completions のリクエストボディから消費トークン数（入力+出力）を見積もる"""
+    try:
+        payload = json.loads(body or b"{}")
+    except (ValueError, UnicodeDecodeError):
+        return DEFAULT_OUTPUT_TOKENS
+    tokens = 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            for block in content:
+                if isinstance(block, dict) and block.get("type") == "image_url":
+                    low = isinstance(block.get("image_url"), dict) and block["image_url"].get("detail") == "low"
+                    tokens += LOW_DETAIL_IMAGE_TOKENS if low else IMAGE_TOKENS
+                else:
+                    tokens += estimate_tokens(json.dumps(block, ensure_ascii=False))
+        elif content:
+            tokens += estimate_tokens(str(content))
+        if message.get("tool_calls"):
+            tokens += estimate_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+    if payload.get("tools"):
+        tokens += estimate_tokens(json.dumps(payload["tools"], ensure_ascii=False))
+    output = payload.get("max_completion_tokens") or payload.get("max_tokens") or DEFAULT_OUTPUT_TOKENS
+    return tokens + int(output)
+
+
+@dataclass
+class _LoopState:
+    """イベントループごとの待ち行列と実行中のリクエスト数"""
+    active: int = 0
+    waiters: list[tuple[int, int, float, asyncio.Future]] = field(default_factory=list)
+    timer: asyncio.TimerHandle | None = None
+
+
+class TokenBucketLimiter:
+    """同時実行数とトークンバケットでリクエストを制限する（優先度の高い順、同じ優先度なら到着順）
+
+    Args:
+        max_concurrency: 同時に実行するリクエスト数の上限（イベントループごと）
+        tokens_per_minute: 1分あたりのトークン数の上限（バケットの容量も同じ）
+    """
+
+    def __init__(self, max_concurrency: int = 8, tokens_per_minute: int = 200_000):
+        self.max_concurrency = max_concurrency
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._seq = itertools.count()
+        self._loops: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopState] = weakref.WeakKeyDictionary()
+        self.stats = {"requests": 0, "queued": 0, "wait_seconds": 0.0, "retries": 0, "throttled": 0}
+
+    def _state(self) -> _LoopState:
+        """実行中のイベントループの待ち行列（ループが閉じて破棄されれば、残っていた待ち・実行枠も消える）"""
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = _LoopState()
+        return state
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float, priority: int | None = None):
+        """実行枠とトークンを確保するまで待つ"""
+        priority = _priority.get() if priority is None else priority
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._state().waiters, (priority, next(self._seq), min(float(tokens), self.capacity), future))
+        started = time.monotonic()
+        self._dispatch()
+        if not future.done():
+            self.stats["queued"] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self.stats["requests"] += 1
+        self.stats["wait_seconds"] += time.monotonic() - started
+
+    def release(self):
+        self._state().active -= 1
+        self._dispatch()
+
+    def adjust(self, tokens: float):
+        """見積もりと実際の使用量の差（正なら追加消費、負なら返却）を反映する"""
+        self._refill(time.monotonic())
+        self._tokens = min(self.capacity, self._tokens - tokens)
+        self._dispatch()
+
+    def pause(self, seconds: float):
+        """レート制限を受けたとき、すべてのリクエストの開始を一時的に止める"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.stats["throttled"] += 1
+
+    def _dispatch(self):
+        state = self._state()
+        now = time.monotonic()
+        self._refill(now)
+        while state.waiters and state.active < self.max_concurrency:
+            priority, seq, tokens, future = state.waiters[0]
+            if future.done():
+                heapq.heappop(state.waiters)
+                continue
+            delay = max(self._paused_until - now, (tokens - self._tokens) / self.rate)
+            if delay > 0:
+                self._schedule(state, delay)
+                return
+            heapq.heappop(state.waiters)
+            self._tokens -= tokens
+            state.active += 1
+            future.set_result(None)
+
+    def _schedule(self, state: _LoopState, delay: float):
+        if state.timer is not None:
+            state.timer.cancel()
+        state.timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def format_stats(self) -> str:
+        s = self.stats
+        return (f"LLMレート制限: リクエスト {s['requests']}, 待機 {s['queued']}件 / {s['wait_seconds']:.1f}秒, "
+                f"再試行 {s['retries']}, 429 {s['throttled']}")
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    """Retry-After / retry-after-ms ヘッダーの待ち時間（秒）"""
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """応答を読み終えた（閉じた）ときに実行枠を返す"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                self._on_close, on_close = None, self._on_close
+                on_close()
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """TokenBucketLimiter で制限し、429・5xx・通信エラーを再試行するトランスポート
+
+    Args:
+        limiter: 共有するリミッター
+        transport: 実際に送信するトランスポート（省略時はイベントループごとに httpx.AsyncHTTPTransport を作る）
+        max_retries: 再試行の最大回数
+        base_delay / max_delay: 指数バックオフの初期値と上限（秒）。実際の待ち時間は0〜その値のランダム（full jitter）
+    """
+
+    def __init__(self, limiter: TokenBucketLimiter, transport: httpx.AsyncBaseTransport | None = None,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.limiter = limiter
+        self._transport = transport
+        self._transports: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncBaseTransport] = \
+            weakref.WeakKeyDictionary()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @property
+    def transport(self) -> httpx.AsyncBaseTransport:
+        """実行中のイベントループで使うトランスポート（接続プールは作ったループでしか使えない）"""
+        if self._transport is not None:
+            return self._transport
+        loop = asyncio.get_running_loop()
+        transport = self._transports.get(loop)
+        if transport is None:
+            transport = self._transports[loop] = httpx.AsyncHTTPTransport()
+        return transport
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        estimated = estimate_request_tokens(request.content)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(estimated)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except BaseException as e:
+                # キャンセルや再試行しないエラーでも実行枠は必ず返す
+                self.limiter.release()
+                if not isinstance(e, httpx.TransportError) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                print(Fore.YELLOW + f"LLM呼び出しの通信エラー（{e!r}）。{delay:.1f}秒後に再試行します（{attempt + 1}/{self.max_retries}）")
+                self.limiter.stats["retries"] += 1
+                await asyncio.sleep(delay)
+                continue
+
+            status = response.status_code
+            if (status == 429 or status >= 500) and attempt < self.max_retries:
+                delay = _retry_after(response)
+                delay = self._backoff(attempt) if delay is None else delay + random.uniform(0, self.base_delay)
+                try:
+                    await response.aclose()
+                finally:
+                    self.limiter.release()
+                if status == 429:
+                    self.limiter.pause(delay)
+                print(Fore.YELLOW + f"LLM呼び出しが {status} で失敗しました。{delay:.1f}秒後に再試行します（{attempt + 1}/{self.max_retries}）")
+                self.limiter.stats["retries"] += 1
+                await asyncio.sleep(delay)
+                continue
+
+            if status == 200 and response.headers.get("content-type", "").startswith("application/json"):
+                # ストリーミングでない応答は使用量がわかるので、見積もりとの差を反映する
+                try:
+                    body = await response.aread()
+                finally:
+                    self.limiter.release()
+                try:
+                    used = json.loads(body).get("usage", {}).get("total_tokens")
+                except (ValueError, AttributeError):
+                    used = None
+                if used:
+                    self.limiter.adjust(used - estimated)
+                return httpx.Response(status, headers=response.headers, content=body, extensions=response.extensions)
+            return httpx.Response(status, headers=response.headers, extensions=response.extensions,
+                                  stream=_ReleasingStream(response.stream, self.limiter.release))
+        raise AssertionError("unreachable")
+
+    async def aclose(self):
+        if self._transport is not None:
+            await self._transport.aclose()
+            return
+        transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+_limiter: TokenBucketLimiter | None = None
+_client: httpx.AsyncClient | None = None
+
+
+def get_limiter() -> TokenBucketLimiter:
+    """プロセスで共有するリミッター（TEST_ROBOT_LLM_CONCURRENCY / TEST_ROBOT_LLM_TPM で設定）"""
+    global _limiter
+    if _limiter is None:
+        _limiter = TokenBucketLimiter(
+            max_concurrency=int(os.environ.get("TEST_ROBOT_LLM_CONCURRENCY", 8)),
+            tokens_per_minute=int(os.environ.get("TEST_ROBOT_LLM_TPM", 200_000)),
+        )
+    return _limiter
+
+
+def shared_http_client() -> httpx.AsyncClient:
+    """共有リミッターを通すOpenAIクライアント用のHTTPクライアント
+
+    クライアントはイベントループの外でも作れる（ChatOpenAI の構築時に渡すため）。
+    接続はトランスポートがイベントループごとに持つので、別の asyncio.run から使ってもよい。
+    """
+    global _client
+    if _client is None:
+        _client = openai.DefaultAsyncHttpxClient(transport=RateLimitedTransport(get_limiter()))
+    return _client
+
+
+def rate_limited_client_kwargs() -> dict:
+    """ChatOpenAI / init_chat_model に渡す引数（再試行はトランスポートで行うためOpenAIクライアント側は無効にする）"""
+    return {"http_async_client": shared_http_client(), "max_retries": 0}
@@ -0,0 +1,327 @@
+"""ロケーター情報の圧縮
+
+generate_locators の出力（JSONの要素一覧、またはページソースXML）を解析し、
+プランナーのプロンプト用にコンパクトで安定した表現へ変換する。
+
+- 非表示・サイズ0・操作不可かつラベルなしの要素を除外
+- 完全重複の要素と、繰り返しのリスト行を折りたたみ
+- 短いID（e1, e2, ...）とクラス名の略称で1要素1行に整形
+- 設定したトークン予算に収まるよう、優先度の低い要素から省略
+"""
+import json
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+# クラス名の略称
+CLASS_ABBREVIATIONS = {
+    "Button": "Btn",
+    "ImageButton": "ImgBtn",
+    "TextView": "Txt",
+    "EditText": "Edit",
+    "ImageView": "Img",
+    "CheckBox": "Chk",
+    "CheckedTextView": "ChkTxt",
+    "RadioButton": "Radio",
+    "Switch": "Sw",
+    "ToggleButton": "Toggle",
+    "Spinner": "Spin",
+    "SeekBar": "Seek",
+    "ProgressBar": "Prog",
+    "FrameLayout": "Frame",
+    "LinearLayout": "Lin",
+    "RelativeLayout": "Rel",
+    "RecyclerView": "List",
+    "ListView": "List",
+    "GridView": "Grid",
+    "ScrollView": "Scroll",
+    "HorizontalScrollView": "HScroll",
+    "ViewGroup": "Group",
+    "WebView": "Web",
+    "View": "View",
+    "StaticText": "Txt",
+    "TextField": "Edit",
+    "SecureTextField": "Secret",
+    "Cell": "Cell",
+}
+
+# 操作可能とみなす属性と、その略記
+INTERACTIVE_FLAGS = {
+    "clickable": "clk",
+    "long-clickable": "lclk",
+    "checkable": "chk",
+    "scrollable": "scr",
+    "focusable": "foc",
+}
+
+# 同じ形のリスト行をいくつまで残すか
+MAX_SIMILAR_ROWS = 3
+
+LEGEND = "凡例: ID クラス \"テキスト\" desc=説明 #resource-id [左,上,右,下] clk=クリック可 lclk=長押し可 chk=チェック可 scr=スクロール可 foc=フォーカス可 checked/selected/disabled=状態"
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数を概算する（ASCIIは4文字で1トークン、それ以外は1文字1トークン）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+@dataclass
+class LocatorElement:
+    """正規化したUI要素"""
+    cls: str = ""
+    text: str = ""
+    desc: str = ""
+    resource_id: str = ""
+    bounds: tuple[int, int, int, int] | None = None
+    flags: tuple[str, ...] = ()
+    state: tuple[str, ...] = ()
+    displayed: bool = True
+    enabled: bool = True
+
+    @property
+    def interactive(self) -> bool:
+        return bool(set(self.flags) & {"clk", "lclk", "chk", "scr"}) or self.cls in ("Edit", "Secret")
+
+    @property
+    def labelled(self) -> bool:
+        return bool(self.text or self.desc or self.resource_id)
+
+    @property
+    def zero_size(self) -> bool:
+        if self.bounds is None:
+            return False
+        left, top, right, bottom = self.bounds
+        return right <= left or bottom <= top
+
+
+def _as_bool(value, default: bool = False) -> bool:
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("true", "1", "yes")
+
+
+def _abbreviate_class(name: str) -> str:
+    short = name.rsplit(".", 1)[-1]
+    short = short.removeprefix("XCUIElementType")
+    return CLASS_ABBREVIATIONS.get(short, short)
+
+
+def _parse_bounds(value) -> tuple[int, int, int, int] | None:
+    if not value:
+        return None
+    if isinstance(value, dict):
+        try:
+            if "left" in value:
+                return int(value["left"]), int(value["top"]), int(value["right"]), int(value["bottom"])
+            x, y = int(value.get("x", 0)), int(value.get("y", 0))
+            return x, y, x + int(value.get("width", 0)), y + int(value.get("height", 0))
+        except (TypeError, ValueError):
+            return None
+    numbers = [int(n) for n in re.findall(r"-?\d+", str(value))]
+    if len(numbers) == 4:
+        return tuple(numbers)
+    return None
+
+
+def _element_from_attributes(attrs: dict) -> LocatorElement:
+    """JSON/XMLの属性辞書からLocatorElementを作る"""
+    def get(*keys):
+        return next((attrs[k] for k in keys if attrs.get(k) not in (None, "")), None)
+
+    flags = tuple(short for key, short in INTERACTIVE_FLAGS.items()
+                  if _as_bool(get(key, key.replace("-", "_"), key.title().replace("-", ""))))
+    state = tuple(name for name in ("checked", "selected") if _as_bool(get(name)))
+    enabled = _as_bool(get("enabled"), default=True)
+    if not enabled:
+        state += ("disabled",)
+
+    return LocatorElement(
+        cls=_abbreviate_class(str(get("tagName", "class", "className", "type") or "")),
+        text=str(get("text", "label", "value") or "").strip(),
+        desc=str(get("contentDesc", "content-desc", "accessibilityId", "name") or "").strip(),
+        resource_id=str(get("resourceId", "resource-id", "id") or "").strip(),
+        bounds=_parse_bounds(get("bounds", "rect")),
+        flags=flags,
+        state=state,
+        displayed=_as_bool(get("displayed", "visible"), default=True),
+        enabled=enabled,
+    )
+
+
+def _find_element_list(data) -> list[dict] | None:
+    """JSON構造から要素の一覧（dictのリスト）を探す"""
+    if isinstance(data, list) and data and all(isinstance(item, dict) for item in data):
+        return data
+    if isinstance(data, dict):
+        for value in data.values():
+            found = _find_element_list(value)
+            if found is not None:
+                return found
+    return None
+
+
+def _extract_json(text: str):
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"[\[{]", text):
+        try:
+            data, _ = decoder.raw_decode(text, match.start())
+            return data
+        except ValueError:
+            continue
+    return None
+
+
+def parse_locators(raw: str) -> list[LocatorElement] | None:
+    """generate_locators の出力を解析する。解析できない形式の場合はNoneを返す"""
+    raw = raw.strip()
+    if not raw:
+        return []
+
+    if raw.startswith("<"):
+        try:
+            root = ET.fromstring(raw)
+        except ET.ParseError:
+            return None
+        return [_element_from_attributes({"class": node.tag, **node.attrib}) for node in root.iter() if node is not root]
+
+    data = _extract_json(raw)
+    items = _find_element_list(data) if data is not None else None
+    if items is None:
+        return None
+    return [_element_from_attributes(item) for item in items]
+
+
+def _shorten(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+class LocatorCompactor:
+    """generate_locators出力をトークン予算内のコンパクトな表現に変換する"""
+
+    def __init__(self, max_tokens: int = 1500, max_text_length: int = 40):
+        self.max_tokens = max_tokens
+        self.max_text_length = max_text_length
+
+    def filter(self, elements: list[LocatorElement]) -> tuple[list[LocatorElement], int]:
+        """不要な要素を除外し、重複とリスト行の繰り返しを折りたたむ
+
+        Returns:
+            (残した要素, 折りたたんだリスト行の数)
+        """
+        kept = []
+        seen = set()
+        similar_counts: dict[tuple, int] = {}
+        for element in elements:
+            if not element.displayed or element.zero_size:
+                continue
+            if not element.interactive and not (element.text or element.desc):
+                continue
+
+            identity = (element.cls, element.text, element.desc, element.resource_id, element.flags)
+            if identity in seen:
+                continue
+            seen.add(identity)
+
+            # 同じクラス・resource-id・属性の要素はリスト行の繰り返しとみなす
+            if element.resource_id:
+                shape = (element.cls, element.resource_id, element.flags)
+                similar_counts[shape] = similar_counts.get(shape, 0) + 1
+                if similar_counts[shape] > MAX_SIMILAR_ROWS:
+                    continue
+            kept.append(element)
+
+        collapsed = sum(count - MAX_SIMILAR_ROWS for count in similar_counts.values() if count > MAX_SIMILAR_ROWS)
+        return kept, collapsed
+
+    def format_element(self, short_id: str, element: LocatorElement, package: str = "") -> str:
+        parts = [short_id, element.cls or "?"]
+        if element.text:
+            parts.append(json.dumps(_shorten(element.text, self.max_text_length), ensure_ascii=False))
+        if element.desc and element.desc != element.text:
+            parts.append("desc=" + json.dumps(_shorten(element.desc, self.max_text_length), ensure_ascii=False))
+        if element.resource_id:
+            rid = element.resource_id
+            if package and rid.startswith(package + ":id/"):
+                rid = rid[len(package) + 4:]
+            parts.append("#" + rid)
+        if element.bounds:
+            parts.append("[{},{},{},{}]".format(*element.bounds))
+        parts.extend(element.flags)
+        parts.extend(element.state)
+        return " ".join(parts)
+
+    def compact(self, raw: str) -> str:
+        """generate_locators の出力をコンパクトな文字列に変換する"""
+        raw = str(raw)
+        elements = parse_locators(raw)
+        if elements is None:
+            # 未知の形式はそのまま予算内に切り詰める
+            return self._truncate(raw)
+
+        elements, collapsed = self.filter(elements)
+        package = self._common_package(elements)
+
+        header = [LEGEND]
+        if package:
+            header.append(f"resource-id の '{package}:id/' は省略")
+        lines = [self.format_element(f"e{i + 1}", element, package) for i, element in enumerate(elements)]
+
+        # 予算超過時は優先度の低い要素（ラベルのみ → ラベルなし操作要素）から省略する
+        budget = self.max_tokens - estimate_tokens("\n".join(header))
+        priorities = [(0 if e.interactive and e.labelled else 1 if e.interactive else 2) for e in elements]
+        costs = [estimate_tokens(line) + 1 for line in lines]
+        selected = set()
+        used = 0
+        for index in sorted(range(len(lines)), key=lambda i: (priorities[i], i)):
+            if used + costs[index] > budget:
+                continue
+            selected.add(index)
+            used += costs[index]
+
+        body = [line for i, line in enumerate(lines) if i in selected]
+        omitted = len(lines) - len(body) + collapsed
+        if omitted:
+            body.append(f"...（類似・低優先度の要素 {omitted} 件を省略）")
+        return "\n".join(header + body)
+
+    def _truncate(self, raw: str) -> str:
+        if estimate_tokens(raw) <= self.max_tokens:
+            return raw
+        low, high = 0, len(raw)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if estimate_tokens(raw[:mid]) <= self.max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return raw[:low] + "\n...（ロケーター情報を省略）"
+
+    @staticmethod
+    def _common_package(elements: list[LocatorElement]) -> str:
+        packages = {e.resource_id.split(":id/", 1)[0] for e in elements if ":id/" in e.resource_id}
+        return packages.pop() if len(packages) == 1 else ""
+
+
+def locators_contain(raw: str, expected: str) -> bool:
+    """generate_locators の出力に、表示中の要素として expected（テキスト・説明・resource-id）が含まれるか
+
+    resource-id は '#url_bar' のような省略形（compact() の表記）でもよい。
+    解析できない形式の場合は単純な部分文字列として探す。
+    """
+    needle = expected.strip().removeprefix("#").lower()
+    if not needle:
+        return False
+    elements = parse_locators(str(raw))
+    if elements is None:
+        return needle in str(raw).lower()
+    for element in elements:
+        if not element.displayed:
+            continue
+        rid = element.resource_id.lower()
+        if needle in element.text.lower() or needle in element.desc.lower() or rid == needle or rid.endswith("/" + needle):
+            return True
+    return False
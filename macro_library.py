@@ -0,0 +1,307 @@
+"""マクロライブラリ
+
+PlanExecute の実行が Response で終わったとき、エージェントが実際に行ったツール呼び出しの列を
+「マクロ」として目標と開始画面のフィンガープリント（dHash）ごとに保存する。
+以降の実行では、計画の前にマクロを試し、各ステップの前に画面のフィンガープリントを確認しながら
+LLMを使わずにツールを再実行する。画面が記録と異なる・ツールが失敗した場合は、そこから通常の計画に切り替える。
+
+マクロは観測（plan / replan時の画面取得）ごとのセグメントに分かれる:
+    セグメント = 観測した画面のdHash + 実行した計画ステップ + そのステップで呼んだツールの列
+
+要素UUIDはAppiumセッションごとに変わるため、記録時に find_element の結果に現れたUUIDを覚えておき、
+再実行時には同じ呼び出しの結果に現れた新しいUUIDに置き換える。
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from colorama import Fore
+from langchain_core.tools import BaseTool
+
+from screen_diff import hamming_distance
+from screen_observation import screen_fingerprint
+from tool_hooks import call_tool_coroutine, tool_content, wrap_tools
+from tool_registry import ToolRegistry, is_mutating
+
+DEFAULT_MACRO_DIR = Path(os.environ.get("TEST_ROBOT_CACHE_DIR", Path.home() / ".cache" / "test_robot")) / "macros"
+
+UUID_PATTERN = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_goal(goal: str) -> str:
+    return _WHITESPACE.sub(" ", goal).strip()
+
+
+def is_recordable(tool_name: str) -> bool:
+    """マクロに記録するツールか（画面を操作するツールと、要素UUIDを得る find_element）"""
+    return is_mutating(tool_name) or "find_element" in tool_name
+
+
+@dataclass
+class MacroCall:
+    """マクロ内の1回のツール呼び出し"""
+    tool: str
+    args: dict
+    uuids: list[str] = field(default_factory=list)  # 結果に現れた要素UUID
+
+
+@dataclass
+class MacroSegment:
+    """1回の観測とその後に実行した計画ステップ"""
+    phash: int | None
+    step: str = ""
+    calls: list[MacroCall] = field(default_factory=list)
+
+
+@dataclass
+class Macro:
+    goal: str
+    segments: list[MacroSegment]
+    final_phash: int | None
+    response: str
+    created_at: float = 0.0
+    successes: int = 0
+    failures: int = 0
+
+    @property
+    def start_phash(self) -> int | None:
+        return self.segments[0].phash if self.segments else self.final_phash
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Macro":
+        segments = [MacroSegment(phash=s["phash"], step=s.get("step", ""),
+                                 calls=[MacroCall(**c) for c in s.get("calls", [])]) for s in data["segments"]]
+        return cls(**{**data, "segments": segments})
+
+
+class MacroStore:
+    """目標ごとのJSONファイルにマクロを保存する
+
+    Args:
+        root: 保存先ディレクトリ
+        max_hamming: 同じ画面とみなすdHashのハミング距離の上限
+        max_per_goal: 1つの目標に保持するマクロ数（開始画面違い）の上限
+        max_failures: この回数以上失敗し、成功より失敗が多いマクロは削除する
+    """
+
+    def __init__(self, root: str | Path = DEFAULT_MACRO_DIR, max_hamming: int = 6, max_per_goal: int = 5,
+                 max_failures: int = 3):
+        self.root = Path(root)
+        self.max_hamming = max_hamming
+        self.max_per_goal = max_per_goal
+        self.max_failures = max_failures
+
+    def _path(self, goal: str) -> Path:
+        return self.root / (hashlib.sha1(normalize_goal(goal).encode("utf-8")).hexdigest()[:16] + ".json")
+
+    def load(self, goal: str) -> list[Macro]:
+        path = self._path(goal)
+        if not path.exists():
+            return []
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            return [Macro.from_dict(m) for m in data["macros"]]
+        except Exception as e:
+            print(Fore.YELLOW + f"マクロを読み込めません（{path}）: {e}")
+            return []
+
+    def _write(self, goal: str, macros: list[Macro]):
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self._path(goal)
+        data = {"goal": normalize_goal(goal), "macros": [m.to_dict() for m in macros]}
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+        tmp_path.replace(path)
+
+    def same_screen(self, a: int | None, b: int | None) -> bool:
+        return a is not None and b is not None and hamming_distance(a, b) <= self.max_hamming
+
+    def find(self, goal: str, phash: int | None) -> Macro | None:
+        """目標と開始画面に合うマクロを返す（成功回数が多いものを優先）"""
+        candidates = [m for m in self.load(goal) if self.same_screen(m.start_phash, phash)]
+        return max(candidates, key=lambda m: (m.successes - m.failures, m.created_at), default=None)
+
+    def save(self, macro: Macro):
+        """マクロを保存する（同じ開始画面のマクロは置き換える）"""
+        macros = [m for m in self.load(macro.goal) if not self.same_screen(m.start_phash, macro.start_phash)]
+        macros.append(macro)
+        macros.sort(key=lambda m: m.created_at, reverse=True)
+        self._write(macro.goal, macros[:self.max_per_goal])
+
+    def record_result(self, macro: Macro, success: bool):
+        """マクロの再実行結果を記録する（失敗が続くマクロは削除する）"""
+        macros = self.load(macro.goal)
+        for m in macros:
+            if m.created_at == macro.created_at and m.start_phash == macro.start_phash:
+                if success:
+                    m.successes += 1
+                else:
+                    m.failures += 1
+        macros = [m for m in macros if not (m.failures >= self.max_failures and m.failures > m.successes)]
+        self._write(macro.goal, macros)
+
+
+class MacroRecorder:
+    """1回の実行中の観測とツール呼び出しを記録し、成功したらマクロとして保存する"""
+
+    def __init__(self, store: MacroStore):
+        self.store = store
+        self.reset("")
+
+    def reset(self, goal: str):
+        self.goal = goal
+        self.segments: list[MacroSegment] = []
+        self.failed = False
+
+    def observe(self, phash: int | None):
+        """画面を観測した（新しいセグメントを開始する）"""
+        self.segments.append(MacroSegment(phash=phash))
+
+    def begin_step(self, step: str):
+        """セグメントで実行するステップを記録する（観測を挟まずに続けて実行したステップは連結する）"""
+        if self.segments:
+            segment = self.segments[-1]
+            segment.step = f"{segment.step} / {step}" if segment.step else step
+
+    def add_call(self, tool_name: str, args: dict, result):
+        if not self.segments:
+            return
+        uuids = list(dict.fromkeys(UUID_PATTERN.findall(str(result))))
+        self.segments[-1].calls.append(MacroCall(tool=tool_name, args=dict(args), uuids=uuids))
+
+    def wrap_tools(self, tools: list[BaseTool]) -> list[BaseTool]:
+        """エージェントのツール呼び出しを記録するツールに置き換える"""
+        async def around(tool, kwargs, call):
+            result = await call(kwargs)
+            if is_recordable(tool.name):
+                self.add_call(tool.name, kwargs, tool_content(tool, result))
+            return result
+
+        return wrap_tools(tools, around)
+
+    def finish(self, response: str) -> Macro | None:
+        """実行が Response で終わったときに呼ぶ。記録をマクロとして保存して返す"""
+        if self.failed or not self.goal or len(self.segments) < 2:
+            return None
+        *segments, final = self.segments
+        if not any(segment.calls for segment in segments):
+            return None
+        macro = Macro(goal=normalize_goal(self.goal), segments=segments, final_phash=final.phash,
+                      response=response, created_at=time.time())
+        self.store.save(macro)
+        print(Fore.GREEN + f"マクロを保存しました（{len(segments)}ステップ, "
+                           f"{sum(len(s.calls) for s in segments)}回のツール呼び出し）")
+        return macro
+
+
+class MacroDiverged(Exception):
+    """マクロの再実行中に画面やツール結果が記録と食い違った"""
+
+
+async def _wait_for_screen(store: MacroStore, screenshot_tool, expected: int | None, retries: int,
+                           interval: float) -> int | None:
+    """画面が期待したフィンガープリントになるまで待つ（アニメーション中を考慮して数回確認する）"""
+    phash = None
+    for attempt in range(retries):
+        phash = await screen_fingerprint(screenshot_tool)
+        if store.same_screen(expected, phash):
+            return phash
+        if attempt < retries - 1:
+            await asyncio.sleep(interval)
+    distance = hamming_distance(expected, phash) if expected is not None and phash is not None else None
+    raise MacroDiverged(f"画面が記録と異なります（ハミング距離: {distance}）")
+
+
+def _substitute(value, uuid_map: dict[str, str]):
+    if isinstance(value, str):
+        def replace(match):
+            if match.group(0) not in uuid_map:
+                raise MacroDiverged(f"記録にない要素UUIDです: {match.group(0)}")
+            return uuid_map[match.group(0)]
+        return UUID_PATTERN.sub(replace, value)
+    if isinstance(value, dict):
+        return {k: _substitute(v, uuid_map) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_substitute(v, uuid_map) for v in value]
+    return value
+
+
+async def replay_macro(macro: Macro, store: MacroStore, registry: ToolRegistry, screenshot_tool,
+                       recorder: MacroRecorder, initial_phash: int | None = None,
+                       retries: int = 3, interval: float = 0.7) -> list[tuple]:
+    """マクロを再実行し、完了したステップの past_steps を返す
+
+    画面やツール結果が記録と食い違った場合は MacroDiverged を送出する
+    （それまでに完了したステップは例外の past_steps 属性に入る）。
+
+    Args:
+        initial_phash: 確認済みの開始画面のdHash（指定すると最初の画面確認を省略する）
+    """
+    past_steps: list[tuple] = []
+    uuid_map: dict[str, str] = {}
+    try:
+        for index, segment in enumerate(macro.segments):
+            if index == 0 and store.same_screen(segment.phash, initial_phash):
+                phash = initial_phash
+            else:
+                phash = await _wait_for_screen(store, screenshot_tool, segment.phash, retries, interval)
+            recorder.observe(phash)
+            recorder.begin_step(segment.step)
+            for call in segment.calls:
+                args = _substitute(call.args, uuid_map)
+                tool = registry[call.tool]
+                try:
+                    result = tool_content(tool, await call_tool_coroutine(tool, args))
+                except Exception as e:
+                    raise MacroDiverged(f"{call.tool} が失敗しました: {e}") from e
+                new_uuids = list(dict.fromkeys(UUID_PATTERN.findall(str(result))))
+                if len(new_uuids) != len(call.uuids):
+                    raise MacroDiverged(f"{call.tool} の結果が記録と異なります: {str(result)[:200]}")
+                uuid_map.update(zip(call.uuids, new_uuids))
+                recorder.add_call(call.tool, args, result)
+            print(Fore.GREEN + f"マクロ ステップ{index + 1}/{len(macro.segments)}: {segment.step}")
+            past_steps.append((segment.step, f"マクロで実行しました（{len(segment.calls)}回のツール呼び出し）"))
+
+        recorder.observe(await _wait_for_screen(store, screenshot_tool, macro.final_phash, retries, interval))
+    except MacroDiverged as e:
+        e.past_steps = past_steps
+        raise
+    return past_steps
+
+
+def create_macro_step(store: MacroStore, recorder: MacroRecorder, registry: ToolRegistry, screenshot_tool):
+    """計画の前にマクロを試すグラフノードを作る"""
+    async def macro_step(state):
+        recorder.reset(state["input"])
+        try:
+            phash = await screen_fingerprint(screenshot_tool)
+        except Exception as e:
+            print(Fore.YELLOW + f"マクロ: 画面を取得できません: {e}")
+            return {}
+        macro = store.find(state["input"], phash)
+        if macro is None:
+            return {}
+
+        print(Fore.GREEN + f"マクロを再実行します（{len(macro.segments)}ステップ, 成功{macro.successes}回）")
+        try:
+            past_steps = await replay_macro(macro, store, registry, screenshot_tool, recorder, initial_phash=phash)
+        except MacroDiverged as e:
+            print(Fore.YELLOW + f"マクロを中断して計画に切り替えます: {e}")
+            store.record_result(macro, success=False)
+            # 計画からやり直すため、マクロ部分の記録は破棄する
+            recorder.reset(state["input"])
+            steps = e.past_steps + [("マクロ再実行", f"中断: {e}")]
+            return {"past_steps": steps}
+        store.record_result(macro, success=True)
+        return {"past_steps": past_steps, "response": macro.response}
+
+    return macro_step
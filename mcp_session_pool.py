@@ -0,0 +1,242 @@
+"""MCPセッションプール
+
+MCPセッション（stdioなら npx -y jarvis-appium のプロセス）とAppiumセッション
+（select_platform → create_session）を開いたまま保持し、複数の実行で再利用する。
+
+- warm_up(): 使用前にセッションを並行して開いておく
+- acquire(): 一定時間使われていないセッションはping / Appiumプローブで正常性を確認し、
+  異常なら作り直してから返す
+- 返すツールはプロキシで、呼び出し時点の最新セッションを使う。実行中に接続切れや
+  Appiumセッション切れが起きた場合は、セッションを作り直して1回だけ再実行する
+
+プロセスをまたいでウォームな状態を保つ場合は、SSEトランスポート（jarvis-appium-sse）で
+常駐させたサーバーをプールから利用する。
+"""
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+
+import anyio
+from colorama import Fore
+from langchain_core.tools import BaseTool
+from langchain_mcp_adapters.client import MultiServerMCPClient
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
+
+from tool_hooks import call_tool_coroutine, wrap_tool
+from tool_registry import ToolRegistry, ToolSchemaCache, load_tools_cached
+
+# 接続レベルの障害とみなす例外
+CONNECTION_ERRORS = (
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    anyio.EndOfStream,
+    ConnectionError,
+)
+
+# Appiumセッション切れを示すエラーメッセージ
+STALE_APPIUM_SESSION = re.compile(
+    r"invalid session id|no active session|session (?:is )?(?:not (?:started|created)|terminated|does not exist)|"
+    r"A session is either terminated or not started",
+    re.IGNORECASE,
+)
+
+# Appiumセッションを作り直す対象外のツール（セッション作成そのもの）
+SESSION_TOOLS = {"select_platform", "create_session", "create_lambdatest_session"}
+
+
+@dataclass
+class PooledSession:
+    """プール内の1つのMCPセッション"""
+    server_name: str
+    platform: str
+    session: object = None
+    tools: list[BaseTool] = field(default_factory=list)  # 呼び出し時に最新セッションを使うプロキシ
+    registry: ToolRegistry = field(default_factory=lambda: ToolRegistry([]))  # プロキシの索引
+    raw_tools: dict[str, BaseTool] = field(default_factory=dict)  # 現在のセッションのツール
+    server_version: str = ""
+    setup_steps: list = field(default_factory=list)  # select_platform / create_session の結果
+    appium_ready: bool = False
+    generation: int = 0
+    last_used: float = 0.0
+    owner: asyncio.Task | None = None
+    closing: asyncio.Event = field(default_factory=asyncio.Event)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def tool(self, name: str) -> BaseTool:
+        return self.registry[name]
+
+
+def is_connection_error(e: Exception) -> bool:
+    """MCPサーバーとの接続が切れたことを示す例外か"""
+    if isinstance(e, McpError):
+        return e.error.code == CONNECTION_CLOSED
+    return isinstance(e, CONNECTION_ERRORS)
+
+
+class MCPSessionPool:
+    """MCPセッションとAppiumセッションを保持・再利用するプール
+
+    Args:
+        server_config: MultiServerMCPClient と同じ形式のサーバー設定
+        health_check_interval: この秒数以上使われていないセッションは取得時に正常性を確認する
+        ping_timeout: MCP ping のタイムアウト（秒）
+        appium_probe_tool: Appiumセッションの確認に使う読み取り専用ツール（Noneで確認しない）
+        schema_cache: ツールスキーマのディスクキャッシュ（Noneなら毎回 tools/list で取得する）
+    """
+
+    def __init__(self, server_config: dict, health_check_interval: float = 30.0, ping_timeout: float = 5.0,
+                 appium_probe_tool: str | None = "appium_screenshot", schema_cache: ToolSchemaCache | None = None):
+        self.server_config = server_config
+        self.schema_cache = schema_cache or ToolSchemaCache()
+        self.health_check_interval = health_check_interval
+        self.ping_timeout = ping_timeout
+        self.appium_probe_tool = appium_probe_tool
+        self._entries: dict[tuple[str, str], PooledSession] = {}
+
+    # --- 公開API ---
+    async def acquire(self, server_name: str, platform: str = "android", prepare_appium: bool = True) -> PooledSession:
+        """ウォームなセッションを取得する（必要なら開く・作り直す）"""
+        key = (server_name, platform)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = PooledSession(server_name=server_name, platform=platform)
+
+        async with entry.lock:
+            if entry.owner is None or entry.owner.done():
+                await self._open(entry)
+            elif time.monotonic() - entry.last_used > self.health_check_interval:
+                await self._health_check(entry)
+            if prepare_appium and not entry.appium_ready:
+                await self._prepare_appium(entry)
+            entry.last_used = time.monotonic()
+        return entry
+
+    async def warm_up(self, server_names: list[str], platform: str = "android", prepare_appium: bool = True):
+        """複数のセッションを並行して開いておく"""
+        await asyncio.gather(*(self.acquire(name, platform, prepare_appium) for name in server_names))
+
+    async def recycle(self, entry: PooledSession):
+        """セッションを閉じて開き直す"""
+        print(Fore.YELLOW + f"[{entry.server_name}] MCPセッションを作り直します (generation {entry.generation})")
+        had_appium = entry.appium_ready
+        await self._close(entry)
+        await self._open(entry)
+        if had_appium:
+            await self._prepare_appium(entry)
+
+    async def aclose(self):
+        for entry in self._entries.values():
+            await self._close(entry)
+        self._entries.clear()
+
+    # --- セッションの保持 ---
+    async def _hold(self, entry: PooledSession, ready: asyncio.Future):
+        """MCPセッションを開いたまま保持する（開始と終了は同じタスクで行う必要がある）"""
+        try:
+            connection = self.server_config[entry.server_name]
+            client = MultiServerMCPClient({entry.server_name: connection})
+            async with client.session(entry.server_name, auto_initialize=False) as session:
+                init = await session.initialize()
+                entry.session = session
+                entry.server_version = f"{init.serverInfo.name}@{init.serverInfo.version}"
+                key = ToolSchemaCache.key(entry.server_name, connection, entry.server_version)
+                tools = await load_tools_cached(session, key, self.schema_cache,
+                                                on_revalidated=lambda fresh: self._set_tools(entry, fresh))
+                self._set_tools(entry, tools)
+                ready.set_result(None)
+                await entry.closing.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                print(Fore.RED + f"[{entry.server_name}] MCPセッションエラー: {e}")
+        finally:
+            entry.session = None
+
+    async def _open(self, entry: PooledSession):
+        started = time.perf_counter()
+        entry.closing = asyncio.Event()
+        entry.appium_ready = False
+        ready = asyncio.get_running_loop().create_future()
+        entry.owner = asyncio.create_task(self._hold(entry, ready))
+        await ready
+        entry.generation += 1
+        print(Fore.CYAN + f"[{entry.server_name}] MCPセッション開始 ({time.perf_counter() - started:.1f}s, ツール数: {len(entry.tools)})")
+
+    def _set_tools(self, entry: PooledSession, tools: list[BaseTool]):
+        entry.raw_tools = {t.name: t for t in tools}
+        # ツール一覧が変わった場合のみプロキシを作り直す
+        if [t.name for t in entry.tools] != list(entry.raw_tools):
+            entry.tools = [wrap_tool(tool, self._make_proxy(entry)) for tool in tools]
+            entry.registry = ToolRegistry(entry.tools)
+
+    async def _close(self, entry: PooledSession):
+        if entry.owner is None:
+            return
+        entry.closing.set()
+        try:
+            await asyncio.wait_for(entry.owner, timeout=10)
+        except Exception:
+            entry.owner.cancel()
+        entry.owner = None
+        entry.appium_ready = False
+
+    async def _prepare_appium(self, entry: PooledSession):
+        """プラットフォーム選択とAppiumセッション作成を行う"""
+        entry.setup_steps = []
+        select_platform = entry.raw_tools["select_platform"]
+        create_session = entry.raw_tools["create_session"]
+
+        print("select_platform 実行...")
+        platform = await select_platform.ainvoke({"platform": entry.platform})
+        print("select_platform結果:", platform)
+        entry.setup_steps.append(("select_platform", str(platform)))
+
+        print("create_session 実行...")
+        session_result = await create_session.ainvoke({"platform": entry.platform})
+        print("create_session結果:", session_result)
+        entry.setup_steps.append(("create_session", str(session_result)))
+        entry.appium_ready = True
+
+    # --- 正常性チェック ---
+    async def _health_check(self, entry: PooledSession):
+        try:
+            await asyncio.wait_for(entry.session.send_ping(), timeout=self.ping_timeout)
+        except Exception as e:
+            print(Fore.YELLOW + f"[{entry.server_name}] MCP pingに失敗しました: {e}")
+            await self.recycle(entry)
+            return
+
+        probe = entry.raw_tools.get(self.appium_probe_tool) if self.appium_probe_tool else None
+        if entry.appium_ready and probe is not None:
+            try:
+                await probe.ainvoke({})
+            except Exception as e:
+                print(Fore.YELLOW + f"[{entry.server_name}] Appiumセッションが無効です: {e}")
+                await self._prepare_appium(entry)
+
+    def _make_proxy(self, entry: PooledSession):
+        """最新セッションのツールを呼び出し、障害時は作り直して1回再実行するフック"""
+        async def around(tool, kwargs, call):
+            generation = entry.generation
+            try:
+                result = await call_tool_coroutine(entry.raw_tools[tool.name], kwargs)
+                entry.last_used = time.monotonic()
+                return result
+            except Exception as e:
+                if is_connection_error(e):
+                    print(Fore.YELLOW + f"[{entry.server_name}] {tool.name} で接続エラー: {e}")
+                    async with entry.lock:
+                        if entry.generation == generation:
+                            await self.recycle(entry)
+                elif tool.name not in SESSION_TOOLS and STALE_APPIUM_SESSION.search(str(e)):
+                    print(Fore.YELLOW + f"[{entry.server_name}] {tool.name} でAppiumセッション切れ: {e}")
+                    async with entry.lock:
+                        await self._prepare_appium(entry)
+                else:
+                    raise
+            return await call_tool_coroutine(entry.raw_tools[tool.name], kwargs)
+
+        return around
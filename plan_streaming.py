@@ -0,0 +1,106 @@
+"""計画のストリーミング生成
+
+with_structured_output(Plan) は計画全体が生成されるまで結果を返さないため、
+最初のステップを実行できるのは計画の最後のステップが生成された後になる。
+
+ここではモデルの出力（{"steps": [...], "expectations": [...]} のJSON）をストリーミングで受け取りながら
+逐次解析し、最初のステップが完成した時点で呼び出し元に返す。
+残りはバックグラウンドのタスクで生成を続け、完了したら完全な Plan を返す。
+"""
+import asyncio
+from typing import Awaitable, Callable
+
+from langchain_core.messages import BaseMessage
+from langchain_core.utils.json import parse_partial_json
+from pydantic import BaseModel
+
+
+# 文字列が閉じているかの判定に使う文字（モデルが出力しない私用領域の文字）
+_SENTINEL = "\ue000"
+
+
+def _parse_steps(text: str) -> list[str] | None:
+    try:
+        data = parse_partial_json(text)
+    except Exception:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("steps"), list):
+        return None
+    return [str(step) for step in data["steps"]]
+
+
+class PlanStreamParser:
+    """ストリーミング中のJSONから完成したステップを取り出す
+
+    parse_partial_json は途中の文字列も閉じて解析するため、最後の要素は
+    末尾に文字を足して解析し直し、その文字が要素に入る（文字列が閉じていない）かで完成を判定する。
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.steps: list[str] = []
+
+    def feed(self, chunk: str) -> list[str]:
+        """出力の断片を追加し、新しく完成したステップを返す"""
+        if not chunk:
+            return []
+        self.text += chunk
+        steps = _parse_steps(self.text)
+        if not steps:
+            return []
+        probe = _parse_steps(self.text + _SENTINEL)
+        open_string = self.text.endswith("\\") or (probe is not None and probe[-1:] == [steps[-1] + _SENTINEL])
+        complete = steps[:-1] if open_string else steps
+        new = complete[len(self.steps):]
+        self.steps.extend(new)
+        return new
+
+
+def _chunk_text(chunk) -> str:
+    content = chunk.content
+    if isinstance(content, list):
+        return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return content or ""
+
+
+async def stream_structured(llm, schema: type[BaseModel], messages: list[BaseMessage],
+                            on_steps: Callable[[list[str]], None]) -> BaseModel:
+    """構造化出力をストリーミングで生成し、ステップが完成するたびに on_steps を呼ぶ"""
+    parser = PlanStreamParser()
+    parsed = None
+    async for chunk in llm.astream(messages, response_format=schema):
+        new = parser.feed(_chunk_text(chunk))
+        if new:
+            on_steps(new)
+        parsed = chunk.additional_kwargs.get("parsed") or parsed
+    if isinstance(parsed, schema):
+        return parsed
+    if parsed is not None:
+        return schema.model_validate(parsed)
+    return schema.model_validate_json(parser.text)
+
+
+async def start_streaming(generate: Callable[[Callable[[list[str]], None]], Awaitable[BaseModel]],
+                          min_steps: int = 1) -> tuple[list[str], asyncio.Task | None, BaseModel | None]:
+    """ストリーミング生成を開始し、最初の min_steps 件のステップが揃うまで待つ
+
+    Returns:
+        (揃ったステップ, 残りを生成中のタスク, 生成済みの結果) のタプル。
+        ステップが揃う前に生成が終わった場合はタスクの代わりに結果を返す。
+    """
+    first: asyncio.Future = asyncio.get_running_loop().create_future()
+    received: list[str] = []
+
+    def on_steps(steps: list[str]):
+        received.extend(steps)
+        if len(received) >= min_steps and not first.done():
+            first.set_result(list(received))
+
+    task = asyncio.create_task(generate(on_steps))
+    # 生成が失敗した後に誰も結果を取得しなくても警告が出ないようにする
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    await asyncio.wait([first, task], return_when=asyncio.FIRST_COMPLETED)
+    if task.done():
+        first.cancel()
+        return received, None, task.result()
+    return first.result(), task, None
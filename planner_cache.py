@@ -0,0 +1,219 @@
+"""プランナー応答キャッシュ
+
+SimplePlanner の create_plan / replan の構造化出力を、正規化したプロンプト・ロケーター情報の
+ハッシュ・スクリーンショットの知覚ハッシュ（dHash）で引けるようにキャッシュする。
+
+- 1段目: プロセス内のLRU（max_entries件）
+- 2段目: SQLiteのローカルストア（TTLとサイズ上限で削除）。複数プロセスから共有できる
+
+プロンプトは空白を正規化し、プロンプトとロケーター情報からセッションごとに変わる要素UUIDや画像データを除いてからハッシュする。
+スクリーンショットはステータスバーの時計などで毎回少し変わるため、キーには含めずに保存しておき、
+dHashのハミング距離が max_hamming 以下のときだけヒットとみなす。
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+from langchain_core.messages import BaseMessage
+
+from macro_library import UUID_PATTERN
+from screen_diff import hamming_distance, locator_hash
+
+DEFAULT_CACHE_PATH = Path(os.environ.get("TEST_ROBOT_CACHE_DIR", Path.home() / ".cache" / "test_robot")) / "planner_cache.sqlite3"
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(messages: list[BaseMessage]) -> str:
+    """キャッシュキー用にプロンプトを正規化する（画像は除き、UUIDと空白を正規化）"""
+    parts = []
+    for message in messages:
+        content = message.content
+        if isinstance(content, list):
+            content = " ".join(
+                "<image>" if isinstance(block, dict) and block.get("type") == "image_url"
+                else (block.get("text", "") if isinstance(block, dict) else str(block))
+                for block in content
+            )
+        parts.append(f"{message.type}: {content}")
+    text = UUID_PATTERN.sub("<uuid>", "\n".join(parts))
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def locator_key(locator: str) -> str:
+    """キャッシュキー用のロケーター情報のハッシュ（セッションごとに変わる要素UUIDを除く）"""
+    return locator_hash(UUID_PATTERN.sub("<uuid>", locator)) if locator else ""
+
+
+@dataclass
+class _Entry:
+    value: dict
+    phash: int | None
+    created_at: float
+
+
+def _phash_text(phash: int | None) -> str:
+    return format(phash, "x") if phash is not None else ""
+
+
+class PlannerCache:
+    """プランナー応答の2段キャッシュ（LRU + SQLite）
+
+    同じキー（プロンプト）でも画面が異なれば別のエントリとして保存し、
+    取得時はハミング距離が最も近いエントリを返す。
+
+    Args:
+        path: SQLiteファイルのパス（Noneならメモリ内LRUのみ）
+        max_entries: メモリ内LRUの最大キー数
+        ttl: エントリの有効期間（秒）
+        max_bytes: SQLiteストアの値の合計サイズの上限（超えたら最終利用が古いものから削除）
+        max_hamming: ヒットとみなすスクリーンショットdHashのハミング距離の上限
+    """
+
+    def __init__(self, path: str | Path | None = DEFAULT_CACHE_PATH, max_entries: int = 256,
+                 ttl: float = 7 * 24 * 3600, max_bytes: int = 50 * 1024 * 1024, max_hamming: int = 4):
+        self.path = Path(path) if path else None
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_hamming = max_hamming
+        self._memory: OrderedDict[str, list[_Entry]] = OrderedDict()
+        self._db: sqlite3.Connection | None = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "screen_mismatches": 0,
+                      "expired": 0, "stores": 0, "evictions": 0}
+        if self.path is not None:
+            self._open()
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS planner_cache ("
+            " key TEXT, phash TEXT, kind TEXT, value TEXT,"
+            " size INTEGER, created_at REAL, last_used REAL, PRIMARY KEY (key, phash))"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def key(kind: str, messages: list[BaseMessage], locator_hash: str = "") -> str:
+        """種別（plan / replan）・正規化プロンプト・ロケーター情報のハッシュ（locator_key）からキーを作る"""
+        data = json.dumps([kind, normalize_prompt(messages), locator_hash], ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _distance(self, stored: int | None, phash: int | None) -> int | None:
+        """画面の距離（一致しなければNone）"""
+        if stored is None or phash is None:
+            return 0 if stored is None and phash is None else None
+        distance = hamming_distance(stored, phash)
+        return distance if distance <= self.max_hamming else None
+
+    def _load(self, key: str) -> list[_Entry]:
+        rows = self._db.execute("SELECT value, phash, created_at FROM planner_cache WHERE key = ?", (key,)).fetchall()
+        return [_Entry(json.loads(value), int(phash, 16) if phash else None, created_at) for value, phash, created_at in rows]
+
+    def get(self, key: str, phash: int | None = None) -> dict | None:
+        """キャッシュされた応答（model_dump の辞書）を返す。なければNone"""
+        now = time.time()
+        entries = self._memory.get(key)
+        tier = "memory_hits"
+        if entries is None and self._db is not None:
+            entries = self._load(key) or None
+            tier = "disk_hits"
+        if not entries:
+            self.stats["misses"] += 1
+            return None
+
+        live = [e for e in entries if now - e.created_at <= self.ttl]
+        if len(live) < len(entries):
+            self.stats["expired"] += len(entries) - len(live)
+            for entry in entries:
+                if entry not in live:
+                    self._delete(key, entry.phash)
+        candidates = [(d, e) for e in live if (d := self._distance(e.phash, phash)) is not None]
+        if not candidates:
+            if live:
+                self.stats["screen_mismatches"] += 1
+            self.stats["misses"] += 1
+            if tier == "disk_hits" and live:
+                self._remember(key, live)
+            return None
+
+        _, entry = min(candidates, key=lambda item: item[0])
+        self.stats[tier] += 1
+        self._remember(key, live)
+        if self._db is not None:
+            self._db.execute("UPDATE planner_cache SET last_used = ? WHERE key = ? AND phash = ?",
+                             (now, key, _phash_text(entry.phash)))
+            self._db.commit()
+        return entry.value
+
+    def put(self, key: str, kind: str, value: dict, phash: int | None = None):
+        """応答を保存する"""
+        now = time.time()
+        entries = [e for e in self._memory.get(key, []) if e.phash != phash]
+        self._remember(key, entries + [_Entry(value, phash, now)])
+        self.stats["stores"] += 1
+        if self._db is None:
+            return
+        data = json.dumps(value, ensure_ascii=False)
+        self._db.execute(
+            "INSERT OR REPLACE INTO planner_cache (key, phash, kind, value, size, created_at, last_used)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, _phash_text(phash), kind, data, len(data), now, now),
+        )
+        self._evict(now)
+        self._db.commit()
+
+    def _remember(self, key: str, entries: list[_Entry]):
+        self._memory[key] = entries
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _delete(self, key: str, phash: int | None):
+        entries = [e for e in self._memory.get(key, []) if e.phash != phash]
+        if entries:
+            self._memory[key] = entries
+        else:
+            self._memory.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM planner_cache WHERE key = ? AND phash = ?", (key, _phash_text(phash)))
+            self._db.commit()
+
+    def _evict(self, now: float):
+        """期限切れのエントリと、サイズ上限を超えた分を最終利用が古い順に削除する"""
+        deleted = self._db.execute("DELETE FROM planner_cache WHERE created_at < ?", (now - self.ttl,)).rowcount
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM planner_cache").fetchone()[0]
+        if total > self.max_bytes:
+            rows = self._db.execute("SELECT key, phash, size FROM planner_cache ORDER BY last_used").fetchall()
+            for key, phash, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self._db.execute("DELETE FROM planner_cache WHERE key = ? AND phash = ?", (key, phash))
+                self._memory.pop(key, None)
+                total -= size
+                deleted += 1
+        self.stats["evictions"] += deleted
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        lookups = hits + self.stats["misses"]
+        return hits / lookups if lookups else 0.0
+
+    def format_stats(self) -> str:
+        s = self.stats
+        return (f"プランナーキャッシュ: ヒット率 {self.hit_rate():.0%} "
+                f"(メモリ {s['memory_hits']}, ディスク {s['disk_hits']}, ミス {s['misses']}, "
+                f"画面不一致 {s['screen_mismatches']}, 期限切れ {s['expired']}, 保存 {s['stores']}, 削除 {s['evictions']})")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
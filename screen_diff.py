@@ -0,0 +1,174 @@
+"""画面変化検出
+
+デコード済みスクリーンショットの知覚ハッシュ（dHash）と輝度グリッド、
+およびgenerate_locators出力のハッシュを使って、前回観測からの画面変化を判定する。
+
+- unchanged: 画面が変化していない（ステータスバーの時計程度の差分は無視）
+- minor: 一部の領域のみ変化した（ダイアログ・入力欄など）
+- changed: 画面全体が変化した
+"""
+import hashlib
+from dataclasses import dataclass, field
+
+from PIL import Image
+
+# 輝度グリッドのサイズ（列 x 行）。縦長のモバイル画面を想定
+GRID_COLS = 18
+GRID_ROWS = 32
+# セルを「変化あり」とみなす輝度差（0-255）
+CELL_THRESHOLD = 16
+
+UNCHANGED = "unchanged"
+MINOR = "minor"
+CHANGED = "changed"
+
+
+@dataclass
+class ScreenChange:
+    """2つの観測間の画面変化"""
+    kind: str
+    hamming: int = 64
+    changed_ratio: float = 1.0
+    # 変化領域のバウンディングボックス（0.0-1.0の正規化座標: left, top, right, bottom）
+    bbox: tuple[float, float, float, float] | None = None
+    # 変化領域を近接するセルごとにまとめたもの（bboxと同じ正規化座標）
+    regions: list[tuple[float, float, float, float]] = field(default_factory=list)
+    locators_changed: bool = True
+
+    @property
+    def unchanged(self) -> bool:
+        return self.kind == UNCHANGED
+
+
+@dataclass
+class ScreenChangeThresholds:
+    """画面変化判定のしきい値"""
+    unchanged_ratio: float = 0.01  # 変化セル比率がこれ以下なら未変化
+    minor_ratio: float = 0.25      # 変化セル比率がこれ以下なら部分変化
+    minor_hamming: int = 12        # dHashのハミング距離がこれ以下なら部分変化の候補
+    ignore_rows: set[int] = field(default_factory=lambda: {0})  # ステータスバー行は無視
+
+
+def dhash(img: Image.Image, hash_size: int = 8) -> int:
+    """差分ハッシュ（64bit）を計算する"""
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def luminance_grid(img: Image.Image) -> bytes:
+    """領域差分用の輝度グリッド（GRID_COLS x GRID_ROWS）を計算する"""
+    return img.convert("L").resize((GRID_COLS, GRID_ROWS), Image.BOX).tobytes()
+
+
+def locator_hash(locator: str) -> str:
+    """generate_locators出力のハッシュ"""
+    return hashlib.sha1(locator.encode("utf-8", "replace")).hexdigest()[:16]
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def diff_grids(prev: bytes, cur: bytes, ignore_rows: set[int] | None = None) -> tuple[float, tuple[float, float, float, float] | None]:
+    """輝度グリッドを比較し、(変化セル比率, 変化領域bbox) を返す"""
+    if len(prev) != len(cur) or not cur:
+        return 1.0, (0.0, 0.0, 1.0, 1.0)
+
+    ignore_rows = ignore_rows or set()
+    changed = 0
+    total = 0
+    left, top, right, bottom = GRID_COLS, GRID_ROWS, -1, -1
+    for row in range(GRID_ROWS):
+        if row in ignore_rows:
+            continue
+        base = row * GRID_COLS
+        for col in range(GRID_COLS):
+            total += 1
+            if abs(prev[base + col] - cur[base + col]) > CELL_THRESHOLD:
+                changed += 1
+                left, right = min(left, col), max(right, col)
+                top, bottom = min(top, row), max(bottom, row)
+
+    if not changed:
+        return 0.0, None
+    bbox = (left / GRID_COLS, top / GRID_ROWS, (right + 1) / GRID_COLS, (bottom + 1) / GRID_ROWS)
+    return changed / total, bbox
+
+
+def changed_regions(prev: bytes, cur: bytes, ignore_rows: set[int] | None = None, max_regions: int = 3,
+                    gap: int = 1) -> list[tuple[float, float, float, float]]:
+    """変化したセルを近接するもの（gapセル以内）ごとにまとめ、それぞれの bbox を返す
+
+    領域が max_regions を超える場合は、全体を囲む1つの領域を返す。
+    """
+    if len(prev) != len(cur) or not cur:
+        return [(0.0, 0.0, 1.0, 1.0)]
+
+    ignore_rows = ignore_rows or set()
+    cells = {
+        (row, col)
+        for row in range(GRID_ROWS) if row not in ignore_rows
+        for col in range(GRID_COLS)
+        if abs(prev[row * GRID_COLS + col] - cur[row * GRID_COLS + col]) > CELL_THRESHOLD
+    }
+    boxes = []
+    while cells:
+        stack = [cells.pop()]
+        top, left = bottom, right = stack[0]
+        while stack:
+            row, col = stack.pop()
+            top, bottom, left, right = min(top, row), max(bottom, row), min(left, col), max(right, col)
+            for neighbor in [(r, c) for r in range(row - gap - 1, row + gap + 2)
+                             for c in range(col - gap - 1, col + gap + 2) if (r, c) in cells]:
+                cells.discard(neighbor)
+                stack.append(neighbor)
+        boxes.append((left, top, right + 1, bottom + 1))
+
+    # 同じ行にかかる領域は1つにまとめる（背景と似た色のダイアログは左右の縁だけが変化として検出される）
+    merged = True
+    while merged:
+        merged = False
+        for i, a in enumerate(boxes):
+            for b in boxes[i + 1:]:
+                if a[1] < b[3] and b[1] < a[3]:
+                    boxes.remove(b)
+                    boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    merged = True
+                    break
+            if merged:
+                break
+
+    if len(boxes) > max_regions:
+        boxes = [(min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))]
+    boxes.sort(key=lambda b: (b[2] - b[0]) * (b[3] - b[1]), reverse=True)
+    return [(left / GRID_COLS, top / GRID_ROWS, right / GRID_COLS, bottom / GRID_ROWS) for left, top, right, bottom in boxes]
+
+
+def compare_screens(prev, cur, thresholds: ScreenChangeThresholds | None = None) -> ScreenChange:
+    """2つのScreenObservationを比較して画面変化を判定する"""
+    thresholds = thresholds or ScreenChangeThresholds()
+    locators_changed = prev.locator_hash != cur.locator_hash
+
+    if prev.phash is None or cur.phash is None:
+        # 画像がない場合はロケーターのみで判定
+        kind = CHANGED if locators_changed else UNCHANGED
+        return ScreenChange(kind=kind, locators_changed=locators_changed)
+
+    hamming = hamming_distance(prev.phash, cur.phash)
+    ratio, bbox = diff_grids(prev.grid, cur.grid, thresholds.ignore_rows)
+
+    if ratio <= thresholds.unchanged_ratio and not locators_changed:
+        kind = UNCHANGED
+    elif ratio <= thresholds.minor_ratio and hamming <= thresholds.minor_hamming:
+        kind = MINOR
+    else:
+        kind = CHANGED
+    regions = changed_regions(prev.grid, cur.grid, thresholds.ignore_rows) if kind == MINOR else []
+    return ScreenChange(kind=kind, hamming=hamming, changed_ratio=ratio, bbox=bbox, regions=regions,
+                        locators_changed=locators_changed)
@@ -0,0 +1,118 @@
+"""画面観測ステージ
+
+スクリーンショットとロケーター情報を並行して取得し、
+base64デコード・知覚ハッシュ計算・リサイズ・JPEG再エンコードはワーカースレッドで実行する。
+イベントループをPillowの処理でブロックしないため、観測中も他のコルーチンが動作できる。
+"""
+import asyncio
+import base64
+import io
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from PIL import Image
+
+from frame_store import open_frame
+from screen_diff import dhash, locator_hash, luminance_grid
+
+# Vision APIに送る画像の最大横幅
+MAX_IMAGE_WIDTH = 1280
+# Vision APIに送る画像のJPEG品質（Pillowの既定値）
+JPEG_QUALITY = 75
+
+# 画像処理用のワーカープール（プロセス内で共有）
+_image_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="screen-image")
+
+
+@dataclass
+class ScreenObservation:
+    """1回の画面観測結果"""
+    locator: str
+    image_url: str = ""
+    width: int = 0
+    height: int = 0
+    captured_at: float = 0.0
+    elapsed: float = 0.0  # 観測にかかった時間（秒）
+    phash: int | None = None  # スクリーンショットのdHash
+    grid: bytes = field(default=b"", repr=False)  # 領域差分用の輝度グリッド
+    locator_hash: str = ""
+    image: Image.Image | None = field(default=None, repr=False)  # リサイズ済みの画像（領域の切り出し用）
+
+    @property
+    def has_image(self) -> bool:
+        return bool(self.image_url)
+
+
+def process_screenshot(screenshot: str, observation: ScreenObservation) -> None:
+    """スクリーンショット（base64、またはフレームの参照）をデコードし、ハッシュとVision API用のJPEGデータURLを設定する（同期処理）"""
+    img = open_frame(screenshot)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    observation.phash = dhash(img)
+    observation.grid = luminance_grid(img)
+
+    # 横幅1280px以上ならリサイズ
+    if img.width > MAX_IMAGE_WIDTH:
+        ratio = MAX_IMAGE_WIDTH / img.width
+        new_size = (MAX_IMAGE_WIDTH, int(img.height * ratio))
+        img = img.resize(new_size, Image.LANCZOS)
+
+    # Vision API用にJPEG形式でbase64化
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=JPEG_QUALITY)
+    observation.image = img
+    observation.image_url = "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
+    observation.width = img.width
+    observation.height = img.height
+
+
+async def generate_screen_info(screenshot_tool, generate_locators, executor: Executor | None = None) -> ScreenObservation:
+    """スクリーンショットとロケーター情報を並行取得し、ScreenObservationを返す
+
+    Args:
+        screenshot_tool: appium_screenshot ツール
+        generate_locators: generate_locators ツール
+        executor: 画像処理に使うExecutor（省略時は共有スレッドプール）
+    """
+    started = time.perf_counter()
+    captured_at = time.time()
+
+    print("screenshot_tool / generate_locators 並行実行...")
+    screenshot, locator = await asyncio.gather(
+        screenshot_tool.ainvoke({}),
+        generate_locators.ainvoke({}),
+    )
+    print("screenshot_tool 結果:", screenshot[:100] if screenshot else "No screenshot")
+    print("generate_locators 結果:", locator[:100] if locator else "No locator")
+
+    observation = ScreenObservation(locator=str(locator), captured_at=captured_at)
+    observation.locator_hash = locator_hash(observation.locator)
+
+    if screenshot:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(executor or _image_executor, process_screenshot, screenshot, observation)
+        except Exception as e:
+            print(f"画像処理エラー: {e}")
+
+    observation.elapsed = time.perf_counter() - started
+    return observation
+
+
+def screenshot_fingerprint(screenshot: str) -> int:
+    """スクリーンショット（base64、またはフレームの参照）のdHashだけを計算する（同期処理）"""
+    img = open_frame(screenshot)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return dhash(img)
+
+
+async def screen_fingerprint(screenshot_tool, executor: Executor | None = None) -> int | None:
+    """スクリーンショットだけを取得してdHashを返す（ロケーター取得・JPEG変換を省いた軽量な観測）"""
+    screenshot = await screenshot_tool.ainvoke({})
+    if not screenshot:
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or _image_executor, screenshot_fingerprint, screenshot)
@@ -1,9 +1,13 @@
+import argparse
 import asyncio
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_mcp_adapters.tools import load_mcp_tools
 from langgraph.prebuilt import create_react_agent
 from langchain.chat_models import init_chat_model
+from element_cache import ElementCache
 from event_logger import EventLogger
+from frame_store import get_frame_store
+from llm_rate_limiter import INTERACTIVE, llm_priority, rate_limited_client_kwargs
+from mcp_session_pool import MCPSessionPool
+from trace_replay import TracePlayer, TraceRecorder
 
 SERVER_CONFIG = {
     "jarvis-appium": {
@@ -18,14 +22,32 @@ SERVER_CONFIG = {
     }
 }
 
-async def main():
+async def main(record_dir: str | None = None, replay_dir: str | None = None):
+    player = TracePlayer(replay_dir) if replay_dir else None
+    recorder = TraceRecorder(record_dir) if record_dir else None
     print("MCPクライアント初期化...")
-    client = MultiServerMCPClient(SERVER_CONFIG)
-    async with client.session("jarvis-appium") as session:
-        print("セッション開始: jarvis-appium")
-        tools = await load_mcp_tools(session)
+    pool = MCPSessionPool(SERVER_CONFIG)
+    try:
+        if player:
+            # 記録済みトレースを再生する（MCPサーバーとOpenAIには接続しない）
+            tools = player.tools()
+            llm = player.chat_model("gpt-4o")
+        else:
+            # MCPセッションとAppiumセッションを事前に開いておく（接続切れ時はプールが作り直す）
+            pooled = await pool.acquire("jarvis-appium")
+            print("セッション開始: jarvis-appium")
+            tools = pooled.tools
+            callbacks = None
+            if recorder:
+                recorder.record_setup(pooled.setup_steps)
+                tools = recorder.wrap_tools(tools)
+                callbacks = [recorder.llm_handler]
+            llm = init_chat_model(model="gpt-4o", temperature=0, callbacks=callbacks, **rate_limited_client_kwargs())
+        # スクリーンショットはフレームストアに保存し、エージェントのメッセージには参照だけを渡す
+        tools = get_frame_store().wrap_tools(tools)
+        # 画面が変わるまで find_element の結果を再利用する
+        tools = ElementCache().wrap_tools(tools)
         print(f"取得ツール数: {len(tools)}")
-        llm = init_chat_model(model="gpt-4o", temperature=0)
         agent = create_react_agent(
             model=llm,
             tools=tools,
@@ -33,12 +55,18 @@ async def main():
                 "あなたはAppiumテストエージェントです。ユーザーの指示に従い、Androidデバイスを操作してください。"
             )
         )
-        logger = EventLogger(verbose=True)
+        logger = EventLogger(verbose=True, async_sink=True)
         print("インタラクティブモード開始。'exit'で終了")
 
         
         while True:
-            user_input = input(">>> 入力: ").strip()
+            if player:
+                user_input = player.inputs.popleft() if player.inputs else "exit"
+                print(f">>> 入力: {user_input}")
+            else:
+                user_input = input(">>> 入力: ").strip()
+                if recorder:
+                    recorder.record_input(user_input)
             if user_input.lower() in ("exit", "quit"):
                 print("終了します。")
                 break
@@ -53,9 +81,29 @@ async def main():
                 ("user", user_input),
                 ("user", post_task_message)
             ]}
-            async for event in agent.astream_events(inputs, version="v2"):
-                logger.dispatch(event)
+            try:
+                # 対話中のLLM呼び出しは、同じプロセスで動いているバッチ実行より優先する
+                with llm_priority(INTERACTIVE):
+                    async for event in agent.astream_events(inputs, version="v2"):
+                        logger.dispatch(event)
+            finally:
+                # 次の入力プロンプトの前にログを出し切る
+                await logger.aflush()
+        # ノード・ツール・LLM呼び出しごとのレイテンシー集計を出力する
+        logger.attach_latency_report()
+        await logger.aclose()
+        if player:
+            print(player.format_report())
+    finally:
+        if recorder:
+            recorder.close()
+        await pool.aclose()
     print("セッション終了")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Appium チャットエージェント")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--record", metavar="DIR", help="実行をトレースとして記録するディレクトリ")
+    group.add_argument("--replay", metavar="DIR", help="再生する記録済みトレースのディレクトリ")
+    args = parser.parse_args()
+    asyncio.run(main(record_dir=args.record, replay_dir=args.replay))
@@ -0,0 +1,95 @@
+"""先読み画面観測
+
+execute_step の中でエージェントが画面を操作するツール（click / set_value など）を呼び終えたら、
+すぐに次の replan_step 用の画面観測をバックグラウンドで開始する。
+エージェントの最後のLLMターン（デバイスに触れない要約）と観測の待ち時間が重なる。
+
+その後さらに画面を操作するツールが呼ばれた場合、先読みした観測は破棄して新しく開始し直す。
+"""
+import asyncio
+import time
+
+from colorama import Fore
+from langchain_core.tools import BaseTool
+
+from screen_observation import ScreenObservation, generate_screen_info
+from tool_hooks import wrap_tools
+from tool_registry import is_mutating
+
+
+class SpeculativeObserver:
+    """画面操作の直後に次の観測を先行して開始する
+
+    Args:
+        screenshot_tool: appium_screenshot ツール
+        generate_locators: generate_locators ツール
+        settle_delay: 操作後、観測を開始するまでの待ち時間（画面遷移のアニメーション対策, 秒）
+    """
+
+    def __init__(self, screenshot_tool, generate_locators, settle_delay: float = 0.3):
+        self.screenshot_tool = screenshot_tool
+        self.generate_locators = generate_locators
+        self.settle_delay = settle_delay
+        self._generation = 0
+        self._pending: tuple[int, float, asyncio.Task] | None = None
+        self._in_flight = 0  # 実行中の画面操作ツールの数（ToolNodeは複数のツール呼び出しを並行実行する）
+        self.stats = {"used": 0, "discarded": 0}
+
+    def wrap_tools(self, tools: list[BaseTool]) -> list[BaseTool]:
+        """画面を操作するツールの呼び出し後に先読み観測を開始するツールに置き換える"""
+        async def around(tool, kwargs, call):
+            if not is_mutating(tool.name):
+                return await call(kwargs)
+            self.invalidate()
+            self._in_flight += 1
+            try:
+                return await call(kwargs)
+            finally:
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self._start()
+
+        return wrap_tools(tools, around)
+
+    def invalidate(self):
+        """先読み中の観測を破棄する（実行中のタスクはキャンセルし、次のステップのAppium呼び出しと競合させない）"""
+        self._generation += 1
+        self._discard()
+
+    def _discard(self):
+        if self._pending is not None:
+            self.stats["discarded"] += 1
+            self._pending[2].cancel()
+            self._pending = None
+
+    def _start(self):
+        self._discard()
+        generation = self._generation
+        task = asyncio.create_task(self._observe())
+        # 破棄された観測の例外が「未取得の例外」として警告されないようにする
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._pending = (generation, time.perf_counter(), task)
+
+    async def _observe(self) -> ScreenObservation:
+        if self.settle_delay:
+            await asyncio.sleep(self.settle_delay)
+        return await generate_screen_info(self.screenshot_tool, self.generate_locators)
+
+    async def take(self) -> ScreenObservation | None:
+        """有効な先読み観測があれば完了を待って返す（なければNone）"""
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return None
+        generation, started, task = pending
+        if generation != self._generation:
+            self.stats["discarded"] += 1
+            task.cancel()
+            return None
+        try:
+            observation = await task
+        except Exception as e:
+            print(Fore.YELLOW + f"先読み観測に失敗しました: {e}")
+            return None
+        self.stats["used"] += 1
+        print(Fore.CYAN + f"先読み観測を使用します（{time.perf_counter() - started:.1f}秒前に開始）")
+        return observation
@@ -0,0 +1,114 @@
+"""実行履歴（past_steps）の圧縮
+
+PlanExecute.past_steps は operator.add で増え続けるため、そのまま replan のプロンプトに入れると
+リプランを重ねるほどプロンプトが大きく遅くなる。
+
+- 直近 keep_recent 件のステップは結果も含めてそのまま残す
+- それより古いステップは1行ずつの要約に畳み込む（畳み込んだ分は次回以降再計算しない）
+- 大きなツール出力は BlobStore に退避し、state とプロンプトには先頭部分と参照（blob:...）だけを残す
+- 全体がトークン予算を超える場合は、古い要約行から省略する
+"""
+import os
+from pathlib import Path
+
+from blob_store import BlobStore
+from locator_compactor import estimate_tokens
+
+DEFAULT_HISTORY_DIR = Path(os.environ.get("TEST_ROBOT_CACHE_DIR", Path.home() / ".cache" / "test_robot")) / "step_history"
+
+
+# 見出し行の分（予算の計算用）
+_HEADERS = "以前のステップ（要約, 000件, 古い000件は省略）:\n直近のステップ:\n"
+
+
+def _one_line(text: str, limit: int) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+
+class StepHistory:
+    """past_steps をトークン予算内のテキストに変換する
+
+    Args:
+        token_budget: replan のプロンプトに入れる実行履歴のトークン予算
+        keep_recent: 結果を省略せずに残す直近のステップ数
+        max_result_chars: これより長い結果は先頭だけを残して BlobStore に退避する
+        summary_chars: 要約に畳み込んだステップ1件あたりの最大文字数
+        blob_dir: 退避先のディレクトリ（Noneなら退避せずに切り詰めるだけ）
+    """
+
+    def __init__(self, token_budget: int = 1500, keep_recent: int = 3, max_result_chars: int = 600,
+                 summary_chars: int = 80, blob_dir: str | Path | None = DEFAULT_HISTORY_DIR):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.max_result_chars = max_result_chars
+        self.summary_chars = summary_chars
+        self.blobs = BlobStore(blob_dir) if blob_dir else None
+        # 要約済みの先頭部分（同じ実行の past_steps なら次回はその続きだけを要約する）
+        self._folded_steps: list[tuple] = []
+        self._folded_lines: list[str] = []
+
+    def offload(self, result, limit: int | None = None) -> str:
+        """大きな結果を退避し、state に残す短い文字列を返す"""
+        text = str(result)
+        limit = limit or self.max_result_chars
+        if len(text) <= limit:
+            return text
+        note = f"...（{len(text) - limit}文字省略）"
+        if self.blobs is not None:
+            ref = BlobStore.ref(self.blobs.put(text))
+            note = f"...（{len(text) - limit}文字省略, {ref}）"
+        return text[:limit] + note
+
+    def _fold(self, older: list) -> list[str]:
+        """古いステップを1行ずつの要約にする（前回までに要約した分は再利用する）"""
+        count = len(self._folded_steps)
+        if count > len(older) or older[:count] != self._folded_steps:
+            # 別の実行の履歴: 最初から要約し直す
+            self._folded_steps, self._folded_lines = [], []
+            count = 0
+        for i, step in enumerate(older[count:], start=count + 1):
+            task, result = (step[0], step[1]) if len(step) >= 2 else (step[0], "")
+            self._folded_lines.append(
+                f"{i}. {_one_line(task, self.summary_chars)} → {_one_line(result, self.summary_chars)}")
+            self._folded_steps.append(step)
+        return self._folded_lines
+
+    def _render_recent(self, past_steps: list, split: int, limit: int) -> str:
+        lines = []
+        for i, step in enumerate(past_steps[split:], start=split + 1):
+            task, result = (step[0], step[1]) if len(step) >= 2 else (step[0], "")
+            lines.append(f"{i}. {task}\n   結果: {self.offload(result, limit)}")
+        return "\n".join(lines)
+
+    def render(self, past_steps: list) -> str:
+        """replan のプロンプトに入れる実行履歴のテキスト"""
+        if not past_steps:
+            return "（まだありません）"
+        split = max(len(past_steps) - self.keep_recent, 0)
+        summary = self._fold(list(past_steps[:split]))
+        limit = self.max_result_chars
+        recent_text = self._render_recent(past_steps, split, limit)
+        # 直近のステップだけで予算を超える場合は結果をさらに短くする
+        while estimate_tokens(recent_text + _HEADERS) > self.token_budget and limit > self.summary_chars:
+            limit //= 2
+            recent_text = self._render_recent(past_steps, split, limit)
+        budget = self.token_budget - estimate_tokens(recent_text) - estimate_tokens(_HEADERS)
+        # 予算に収まるだけ新しい方から要約行を残す
+        kept: list[str] = []
+        for line in reversed(summary):
+            cost = estimate_tokens(line) + 1
+            if cost > budget:
+                break
+            kept.append(line)
+            budget -= cost
+        kept.reverse()
+
+        parts = []
+        if summary:
+            omitted = len(summary) - len(kept)
+            header = f"以前のステップ（要約, {len(summary)}件"
+            header += f", 古い{omitted}件は省略）:" if omitted else "）:"
+            parts.append("\n".join([header] + kept))
+        parts.append("直近のステップ:\n" + recent_text)
+        return "\n".join(parts)
@@ -0,0 +1,417 @@
+"""シナリオスイートの並列実行（シャーディングとAllureレポート）
+
+シナリオファイル（目的・ノウハウ・期待結果）から多数のシナリオを読み込み、
+デバイスとワーカープロセスに振り分けて PlanExecute グラフで並列に実行する。
+
+- シャーディング: --workers N でワーカープロセスを起動し、デバイスとシナリオを N 分割する（N はデバイス数まで）。
+  複数のマシンで分担する場合は各マシンで --shard i/N を指定する
+- 判定: 期待結果が書かれたシナリオは、最終応答と実行履歴をLLMで期待結果と照合する
+- レポート: シナリオごとの結果・デバイス別ログ・EventLoggerの添付（レイテンシー集計など）を
+  1つのallure-resultsディレクトリに書き出す（全シャードが同じディレクトリに書き込む）
+
+シナリオファイルは JSON（配列、または {"scenarios": [...]}）か JSONL:
+    {"id": "chrome-yahoo", "goal": "Chromeを起動して yahoo.co.jp を開く",
+     "expected": "Yahoo! JAPANのトップページが表示されている", "tags": ["smoke"]}
+
+使い方:
+    uv run python suite_runner.py suite.jsonl --devices fleet.json --workers 2
+    uv run python suite_runner.py suite.jsonl --udid emulator-5554 --shard 1/3
+    allure serve allure-results
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import sys
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import allure_commons
+from allure_commons.logger import AllureFileLogger
+from allure_commons.model2 import Attachment, Label, Parameter, Status, StatusDetails, TestResult
+from allure_commons.types import LabelType
+from colorama import Fore, init
+from langchain_core.messages import HumanMessage
+from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, Field
+
+from event_logger import EventLogger
+from fleet_runner import (DevicePool, ScenarioResult, _install_log_router, _safe_name, assign_system_ports,
+                          load_device_profiles, profiles_from_udids, run_on_pool)
+from llm_rate_limiter import get_limiter, rate_limited_client_kwargs
+from macro_library import MacroStore
+from planner_cache import PlannerCache
+from test_plan_and_execute_agent import KNOWHOW
+
+init(autoreset=True)
+
+# グラフが途中で打ち切った場合の応答（期待結果がなくても失敗とみなす）
+_ABORTED_RESPONSES = ("リプラン回数が制限", "エラーが発生しました")
+
+# 現在のタスクで実行中のシナリオの結果（allure.attach の添付先）
+_current_case = contextvars.ContextVar("suite_case", default=None)
+
+
+@dataclass
+class Scenario:
+    """スイートの1シナリオ"""
+    id: str
+    goal: str
+    expected: str = ""
+    knowhow: str = KNOWHOW
+    device: str | None = None  # 実行するデバイスを固定する場合のみ
+    tags: list[str] = field(default_factory=list)
+
+
+def load_scenarios(path: str) -> list[Scenario]:
+    """シナリオファイル（JSON / JSONL）を読み込む。文字列だけの要素は goal として扱う"""
+    text = Path(path).read_text(encoding="utf-8")
+    if path.endswith(".jsonl"):
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        data = json.loads(text)
+        items = data.get("scenarios", []) if isinstance(data, dict) else data
+
+    scenarios, seen = [], set()
+    for i, item in enumerate(items):
+        if isinstance(item, str):
+            item = {"goal": item}
+        scenario = Scenario(
+            id=str(item.get("id") or f"scenario-{i + 1:03d}"),
+            goal=item["goal"],
+            expected=item.get("expected", ""),
+            knowhow=item.get("knowhow") or KNOWHOW,
+            device=item.get("device"),
+            tags=list(item.get("tags", [])),
+        )
+        if scenario.id in seen:
+            raise ValueError(f"シナリオIDが重複しています: {scenario.id}")
+        seen.add(scenario.id)
+        scenarios.append(scenario)
+    return scenarios
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """'i/N'（1始まり）を (index, count)（0始まり）に変換する"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"--shard は i/N の形式で指定してください: {value}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"--shard の i は 1〜N で指定してください: {value}")
+    return index - 1, count
+
+
+def shard_items(items: list, index: int, count: int) -> list:
+    """要素を count 個に分けたうちの index 番目（ファイル内の順に交互に割り当てる）"""
+    return items[index::count]
+
+
+def shard_devices(profiles: dict[str, dict], index: int, count: int) -> dict[str, dict]:
+    """デバイスを count 個のシャードに分ける
+
+    デバイスがシャードより少ない場合は、複数のマシンで分担している（各マシンに自分のデバイスを指定している）とみなし、
+    すべてのデバイスを使う。同じマシンのワーカー（--workers）はデバイス数までに制限するため、1台を共有することはない。
+    """
+    names = list(profiles)
+    if len(names) < count:
+        return dict(profiles)
+    return {name: profiles[name] for name in shard_items(names, index, count)}
+
+
+def shard_scenarios(scenarios: list[Scenario], profiles: dict[str, dict], index: int, count: int) -> list[Scenario]:
+    """シナリオを count 個のシャードに分ける（profiles はシャードに分ける前の全デバイス）
+
+    デバイスを固定したシナリオは、そのデバイスを持つシャードに割り当て、残りのシナリオを交互に割り当てる。
+    どのシャードにもないデバイスを固定したシナリオも交互に割り当て、実行時にBROKENとして報告する。
+    """
+    owners: dict[str, list[int]] = {}
+    for i in range(count):
+        for name in shard_devices(profiles, i, count):
+            owners.setdefault(name, []).append(i)
+    pinned = {s.id: owners[s.device][0] for s in scenarios if s.device and len(owners.get(s.device, [])) == 1}
+    chosen = {s.id for s in shard_items([s for s in scenarios if s.id not in pinned], index, count)}
+    chosen |= {scenario_id for scenario_id, owner in pinned.items() if owner == index}
+    return [s for s in scenarios if s.id in chosen]
+
+
+class Verdict(BaseModel):
+    """期待結果との照合結果"""
+    passed: bool = Field(description="期待結果を満たしていればtrue")
+    reason: str = Field(description="判定の理由（1〜2文）")
+
+
+JUDGE_PROMPT = """あなたはモバイルアプリのテスト結果を判定するレビュアーです。
+テストの目的と期待結果、エージェントの実行履歴と最終応答から、期待結果を満たしているかを判定してください。
+実行履歴に根拠がない場合は満たしていないと判定してください。
+
+目的: {goal}
+期待結果: {expected}
+
+実行履歴:
+{history}
+
+最終応答: {response}"""
+
+
+async def judge_result(llm, scenario: Scenario, result: ScenarioResult) -> tuple[bool, str]:
+    """シナリオが成功したかを判定する（期待結果がない場合は正常終了したかだけを見る）"""
+    if result.error:
+        return False, result.error
+    if not result.response or result.response.startswith(_ABORTED_RESPONSES):
+        return False, result.response or "最終応答がありません"
+    if not scenario.expected or llm is None:
+        return True, result.response
+    history = "\n".join(f"- {step}: {str(output)[:300]}" for step, output in result.past_steps[-10:]) or "（なし）"
+    verdict = await llm.with_structured_output(Verdict).ainvoke([HumanMessage(JUDGE_PROMPT.format(
+        goal=scenario.goal, expected=scenario.expected, history=history, response=result.response))])
+    return verdict.passed, verdict.reason
+
+
+class AllureSuiteReporter:
+    """シナリオごとの結果をallure-resultsに書き出す
+
+    allure-pytest を使わずにレポートを作るため、allure_commons のプラグインとして登録し、
+    実行中のシナリオ（contextvarで判定）への allure.attach を受け取って添付ファイルにする。
+    """
+
+    def __init__(self, results_dir: str, suite_name: str, shard: str = ""):
+        self.results_dir = Path(results_dir)
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self.suite_name = suite_name
+        self.shard = shard
+        self.file_logger = AllureFileLogger(str(self.results_dir), clean=False)
+        allure_commons.plugin_manager.register(self)
+
+    def close(self):
+        allure_commons.plugin_manager.unregister(self)
+
+    @contextmanager
+    def case(self, scenario: Scenario):
+        """シナリオの TestResult を作り、ブロック内の allure.attach をそのシナリオに添付する"""
+        result = TestResult(
+            uuid=str(uuid.uuid4()),
+            name=scenario.id,
+            fullName=f"{self.suite_name}.{scenario.id}",
+            # 同じシナリオIDの結果を実行をまたいで履歴（トレンド・リトライ）として扱う
+            historyId=hashlib.md5(f"{self.suite_name}.{scenario.id}".encode()).hexdigest(),
+            testCaseId=hashlib.md5(scenario.id.encode()).hexdigest(),
+            description=f"{scenario.goal}\n\n期待結果: {scenario.expected or '（指定なし）'}",
+            labels=[Label(LabelType.SUITE, self.suite_name), Label(LabelType.FRAMEWORK, "plan-and-execute")]
+            + [Label(LabelType.TAG, tag) for tag in scenario.tags],
+            start=int(time.time() * 1000),
+        )
+        if self.shard:
+            result.labels.append(Label("shard", self.shard))
+        token = _current_case.set(result)
+        try:
+            yield result
+        finally:
+            _current_case.reset(token)
+            result.stop = int(time.time() * 1000)
+            self.file_logger.report_result(result)
+
+    @staticmethod
+    def start(case: TestResult):
+        """実行の開始時刻を記録し直す（デバイスの空き待ちをテストの実行時間に含めない）"""
+        case.start = int(time.time() * 1000)
+
+    def _attachment(self, name, attachment_type, extension) -> tuple[Attachment, str] | None:
+        result = _current_case.get()
+        if result is None:
+            return None
+        mime_type = getattr(attachment_type, "mime_type", attachment_type)
+        extension = extension or getattr(attachment_type, "extension", None) or "attach"
+        file_name = f"{uuid.uuid4()}-attachment.{extension}"
+        attachment = Attachment(name=name or "attachment", source=file_name, type=mime_type)
+        result.attachments.append(attachment)
+        return attachment, file_name
+
+    @allure_commons.hookimpl
+    def attach_data(self, body, name, attachment_type, extension):
+        if found := self._attachment(name, attachment_type, extension):
+            self.file_logger.report_attached_data(body, found[1])
+
+    @allure_commons.hookimpl
+    def attach_file(self, source, name, attachment_type, extension):
+        if found := self._attachment(name, attachment_type, extension):
+            self.file_logger.report_attached_file(source, found[1])
+
+
+async def run_suite_scenario(pool: DevicePool, reporter: AllureSuiteReporter, judge_llm, scenario: Scenario,
+                             index: int) -> dict:
+    """1シナリオを実行して判定し、Allureの結果を書き出す"""
+    with reporter.case(scenario) as case:
+        log_dir = pool.work_dir / "events"
+        log_dir.mkdir(parents=True, exist_ok=True)
+        logger = EventLogger(log_file=str(log_dir / f"{_safe_name(scenario.id)}-{uuid.uuid4().hex[:8]}.log"))
+        result = None
+        try:
+            names = [slot.name for slot in pool.devices]
+            if scenario.device and scenario.device not in names:
+                # 空くのを待ち続けないよう、プールにないデバイスを固定したシナリオはBROKENにする
+                raise ValueError(f"デバイス '{scenario.device}' がありません（{', '.join(names)}）")
+            result = await run_on_pool(pool, scenario.goal, index, scenario.device,
+                                       knowhow=scenario.knowhow, logger=logger,
+                                       on_acquired=lambda slot: reporter.start(case))
+            case.labels.append(Label(LabelType.HOST, result.device))
+            case.parameters.append(Parameter(name="device", value=result.device))
+            passed, reason = await judge_result(judge_llm, scenario, result)
+            if result.error:
+                case.status = Status.BROKEN
+            else:
+                case.status = Status.PASSED if passed else Status.FAILED
+            case.statusDetails = StatusDetails(message=reason)
+        except Exception as e:
+            result = result or ScenarioResult(scenario=scenario.goal, device=scenario.device or "")
+            result.error = str(e)
+            case.status = Status.BROKEN
+            case.statusDetails = StatusDetails(message=str(e), trace=traceback.format_exc())
+        finally:
+            logger.attach_complete_log()
+            # CancelledError などが result の代入前に送出された場合は result がない
+            if result is not None and result.log_path and Path(result.log_path).exists():
+                allure_commons.plugin_manager.hook.attach_file(
+                    source=result.log_path, name="Device Log", attachment_type="text/plain", extension="log")
+            logger.close()
+
+    color = {Status.PASSED: Fore.GREEN, Status.FAILED: Fore.RED}.get(case.status, Fore.YELLOW)
+    print(color + f"{case.status.upper()} {scenario.id} [{result.device}] {result.elapsed:.1f}s: "
+          f"{case.statusDetails.message if case.statusDetails else ''}")
+    return {"id": scenario.id, "status": case.status, "device": result.device, "elapsed": result.elapsed,
+            "message": case.statusDetails.message if case.statusDetails else "", "log_path": result.log_path}
+
+
+async def run_suite(profiles: dict[str, dict], scenarios: list[Scenario], results_dir: str = "allure-results",
+                    work_dir: str = "suite_logs", suite_name: str = "scenario-suite", shard: str = "",
+                    max_parallel: int | None = None, judge: bool = True, use_planner_cache: bool = True,
+                    use_macros: bool = True) -> list[dict]:
+    """シナリオをデバイスプールで並列に実行し、結果をallure-resultsに書き出す"""
+    _install_log_router()
+    planner_cache = PlannerCache() if use_planner_cache else None
+    pool = DevicePool(profiles, work_dir=work_dir, max_parallel=max_parallel, planner_cache=planner_cache,
+                      macro_store=MacroStore() if use_macros else None)
+    reporter = AllureSuiteReporter(results_dir, suite_name, shard)
+    judge_llm = ChatOpenAI(model="gpt-4.1-mini", temperature=0, **rate_limited_client_kwargs()) if judge else None
+    try:
+        return await asyncio.gather(*(
+            run_suite_scenario(pool, reporter, judge_llm, scenario, i) for i, scenario in enumerate(scenarios)
+        ))
+    finally:
+        reporter.close()
+        await pool.aclose()
+        if planner_cache:
+            print(Fore.CYAN + planner_cache.format_stats())
+            planner_cache.close()
+        print(Fore.CYAN + get_limiter().format_stats())
+
+
+async def run_workers(argv: list[str], workers: int, summary_dir: Path) -> list[dict]:
+    """同じ引数で --shard i/N のワーカープロセスを起動し、各シャードの結果をまとめる"""
+    processes = []
+    for i in range(workers):
+        summary = summary_dir / f"shard-{i + 1}.json"
+        processes.append((summary, await asyncio.create_subprocess_exec(
+            sys.executable, __file__, *argv, "--shard", f"{i + 1}/{workers}", "--summary", str(summary))))
+    results = []
+    for summary, process in processes:
+        if await process.wait() != 0:
+            print(Fore.RED + f"ワーカー（{summary.stem}）が終了コード {process.returncode} で終了しました")
+        if summary.exists():
+            results.extend(json.loads(summary.read_text(encoding="utf-8")))
+    return results
+
+
+def _strip_worker_args(argv: list[str]) -> list[str]:
+    """親プロセスの引数からワーカー数の指定を取り除く"""
+    stripped, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--workers":
+            skip = True
+        elif not arg.startswith("--workers="):
+            stripped.append(arg)
+    return stripped
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="シナリオスイートをデバイスとプロセスに振り分けて並列実行する")
+    parser.add_argument("suite", help="シナリオファイル（JSON / JSONL）")
+    parser.add_argument("--devices", help="デバイスプロファイルのJSONファイル（名前 → capabilities）")
+    parser.add_argument("--udid", action="append", default=[], help="capabilities.json の android プロファイルを元にudidを差し替えて追加")
+    parser.add_argument("--capabilities", default="capabilities.json", help="--udid 指定時の元になるcapabilities")
+    parser.add_argument("--workers", type=int, default=1, help="ワーカープロセス数（デバイスとシナリオを分割する）")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="このプロセスで実行するシャード（i/N）")
+    parser.add_argument("--tag", action="append", default=[], help="このタグを持つシナリオだけを実行する")
+    parser.add_argument("--max-parallel", type=int, default=None, help="同時に使用するデバイス数の上限")
+    parser.add_argument("--results-dir", default="allure-results", help="Allureの結果の出力先")
+    parser.add_argument("--log-dir", default="suite_logs", help="デバイス別ログの出力先")
+    parser.add_argument("--suite-name", default=None, help="Allureのスイート名（省略時はファイル名）")
+    parser.add_argument("--no-judge", action="store_true", help="期待結果のLLM判定を行わない（正常終了したかだけを見る）")
+    parser.add_argument("--no-planner-cache", action="store_true", help="プランナー応答キャッシュを使わない")
+    parser.add_argument("--no-macros", action="store_true", help="マクロの再実行と保存を行わない")
+    parser.add_argument("--summary", help=argparse.SUPPRESS)  # ワーカーが結果を親に渡すファイル
+    args = parser.parse_args()
+
+    scenarios = load_scenarios(args.suite)
+    if args.tag:
+        scenarios = [s for s in scenarios if set(args.tag) & set(s.tags)]
+    if not scenarios:
+        parser.error("実行するシナリオがありません")
+
+    profiles = load_device_profiles(args.devices) if args.devices else {}
+    if args.udid:
+        base = load_device_profiles(args.capabilities)["android"]
+        profiles.update(profiles_from_udids(args.udid, base))
+    if not profiles:
+        parser.error("--devices または --udid でデバイスを指定してください")
+    # systemPort はシャードに分ける前の位置で決める（同じホストのワーカー間で重ならないように）
+    profiles = assign_system_ports(profiles)
+
+    workers = args.workers
+    if workers > len(profiles):
+        print(Fore.YELLOW + f"ワーカー数をデバイス数（{len(profiles)}）に制限します（指定: {workers}）")
+        workers = len(profiles)
+    if workers > 1 and args.shard is None:
+        summary_dir = Path(args.log_dir) / "shards"
+        summary_dir.mkdir(parents=True, exist_ok=True)
+        results = await run_workers(_strip_worker_args(sys.argv[1:]), workers, summary_dir)
+    else:
+        shard = ""
+        if args.shard is not None:
+            index, count = args.shard
+            shard = f"{index + 1}/{count}"
+            # デバイスを固定したシナリオは、そのデバイスを持つシャードで実行する
+            scenarios = shard_scenarios(scenarios, profiles, index, count)
+            profiles = shard_devices(profiles, index, count)
+            print(Fore.CYAN + f"シャード {shard}: デバイス {', '.join(profiles)} / シナリオ {len(scenarios)}件")
+
+        results = await run_suite(profiles, scenarios, results_dir=args.results_dir,
+                                  work_dir=str(Path(args.log_dir) / (f"shard-{shard.split('/')[0]}" if shard else "")),
+                                  suite_name=args.suite_name or Path(args.suite).stem, shard=shard,
+                                  max_parallel=args.max_parallel, judge=not args.no_judge,
+                                  use_planner_cache=not args.no_planner_cache, use_macros=not args.no_macros)
+        if args.summary:
+            Path(args.summary).write_text(json.dumps(results, ensure_ascii=False, indent=1), encoding="utf-8")
+            return
+
+    print(Fore.CYAN + "=== スイート実行結果 ===")
+    counts = {}
+    for result in sorted(results, key=lambda r: r["id"]):
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        color = {Status.PASSED: Fore.GREEN, Status.FAILED: Fore.RED}.get(result["status"], Fore.YELLOW)
+        print(color + f"{result['status'].upper():7} [{result['device']}] {result['elapsed']:.1f}s {result['id']}: {result['message']}")
+    print(Fore.CYAN + ", ".join(f"{status}: {count}" for status, count in sorted(counts.items()))
+          + f"（allure serve {args.results_dir} で表示）")
+    if any(r["status"] != Status.PASSED for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
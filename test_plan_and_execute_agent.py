@@ -8,18 +8,33 @@ import operator
 from typing import Annotated, List, Tuple, Union
 from typing_extensions import TypedDict
 from pydantic import BaseModel, Field
+import argparse
 import asyncio
 from colorama import Fore, init
 
 from langchain_openai import ChatOpenAI
 from langgraph.prebuilt import create_react_agent
 from langgraph.graph import StateGraph, START, END
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_mcp_adapters.tools import load_mcp_tools
 from langchain_core.messages import HumanMessage, SystemMessage
-import base64
-from PIL import Image
-import io
+from screen_observation import generate_screen_info
+from frame_store import get_frame_store
+from vision_images import FULL, ImagePreparation, VisionImage, format_images, prepare_vision_images
+from screen_diff import CHANGED, compare_screens
+from locator_compactor import LocatorCompactor, locators_contain
+from planner_cache import PlannerCache, locator_key
+from macro_library import MacroRecorder, MacroStore, create_macro_step
+from speculative_observation import SpeculativeObserver
+from step_history import StepHistory
+from plan_streaming import start_streaming, stream_structured
+from action_compiler import ActionCompiler
+from tool_selector import ToolSelector
+from element_cache import ElementCache
+from llm_rate_limiter import get_limiter, rate_limited_client_kwargs
+from graph_checkpoint import DEFAULT_CHECKPOINT_PATH, SqliteCheckpointSaver, new_thread_id
+from mcp_session_pool import MCPSessionPool
+from tool_registry import ToolRegistry
+from trace_replay import TracePlayer, TraceRecorder
+from event_logger import EventLogger
 
 SERVER_CONFIG = {
     "jarvis-appium": {
@@ -48,10 +63,15 @@ class PlanExecute(TypedDict):
     past_steps: Annotated[List[Tuple], operator.add]
     response: str
     replan_count: int  # リプラン回数の追跡
+    expectations: List[str]  # 各ステップ完了後に画面上で確認できるテキスト / resource-id（planと同じ順序）
 
 # --- プランモデル ---
 class Plan(BaseModel):
     steps: List[str] = Field(description="実行すべき手順の一覧（順序通りに並べる）")
+    expectations: List[str] = Field(
+        default_factory=list,
+        description="各ステップの完了後に画面上に表示されるはずのテキストまたはresource-id（stepsと同じ順序。画面から確認できないステップは空文字）",
+    )
 
 # --- 応答モデル ---
 class Response(BaseModel):
@@ -61,40 +81,107 @@ class Act(BaseModel):
     action: Union[Response, Plan] = Field(description="実行するアクション。ユーザーに応答する場合はResponse、さらにツールを使用してタスクを実行する場合はPlanを使用してください。")
 
 # --- シンプルなプランナークラス ---
+def _image_message(text: str, images: list[VisionImage]) -> HumanMessage:
+    """指示のテキストと、説明付きの画像（変化領域の切り出し・縮小画像など）のメッセージ"""
+    return HumanMessage(content=[{"type": "text", "text": text}] + [block for image in images for block in image.content_blocks()])
+
+
 class SimplePlanner:
-    """テスト用のシンプルなプランナー"""
-    def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4.1", temperature=0)
+    """テスト用のシンプルなプランナー
+
+    Args:
+        locator_token_budget: プロンプトに含めるロケーター情報のトークン予算
+        llm: 使用するチャットモデル（省略時は gpt-4.1）
+        cache: 応答キャッシュ（同じ目標・同じ画面での計画をLLMを呼ばずに再利用する）
+        history: 実行履歴をトークン予算内に要約する（省略時は既定の StepHistory）
+    """
+    def __init__(self, locator_token_budget: int = 1500, llm=None, cache: PlannerCache | None = None,
+                 history: StepHistory | None = None):
+        self.llm = llm or ChatOpenAI(model="gpt-4.1", temperature=0, **rate_limited_client_kwargs())
+        self.locator_compactor = LocatorCompactor(max_tokens=locator_token_budget)
+        self.cache = cache
+        self.history = history or StepHistory()
+
+    async def _invoke_structured(self, schema, kind: str, messages: list, locator: str, screen_hash: int | None):
+        """構造化出力でLLMを呼び出す（キャッシュがあれば先に引く）"""
+        if self.cache is None:
+            return await self.llm.with_structured_output(schema).ainvoke(messages)
+        key = PlannerCache.key(kind, messages, locator_key(locator))
+        cached = self.cache.get(key, screen_hash)
+        if cached is not None:
+            print(Fore.GREEN + f"プランナーキャッシュにヒットしました（{kind}）")
+            return schema.model_validate(cached)
+        result = await self.llm.with_structured_output(schema).ainvoke(messages)
+        self.cache.put(key, kind, result.model_dump(mode="json"), screen_hash)
+        return result
     
-    async def create_plan(self, user_input: str, locator: str = "", image_url: str = "") -> Plan:
+    def build_plan_messages(self, user_input: str, locator: str = "", image_url: str = "",
+                            images: list[VisionImage] | None = None) -> list:
+        """create_plan のプロンプト（メッセージ列）を組み立てる（images を渡した場合は image_url の代わりに使う）"""
         content = f"""与えられた目標に対して、シンプルなステップバイステップの計画を作成してください。
 この計画は、正しく実行されれば正解を得られる個別のタスクで構成される必要があります。
 不要なステップは追加しないでください。最終ステップの結果が最終的な答えとなります。
 各ステップに必要な情報がすべて含まれていることを確認し、ステップを飛ばさないでください。
+expectations には、各ステップの完了後に画面に表示されるはずのテキストまたはresource-idを1つずつ、stepsと同じ順序で入れてください。
+画面から確認できないステップは空文字にしてください。
 
 目標: {user_input}"""
         
         if locator:
-            content += f"\n\n画面ロケーター情報: {locator}"
+            content += f"\n\n画面ロケーター情報:\n{self.locator_compactor.compact(locator)}"
         
         messages = [SystemMessage(content=content)]
         
-        if image_url:
+        if images:
+            messages.append(_image_message("この画面に基づいて計画を作成してください。", images))
+        elif image_url:
             messages.append(HumanMessage(content=[
                 {"type": "text", "text": "この画面に基づいて計画を作成してください。"},
                 {"type": "image_url", "image_url": {"url": image_url}}
             ]))
         else:
             messages.append(HumanMessage(content="この目標のための計画を作成してください。"))
-        
-        structured_llm = self.llm.with_structured_output(Plan)
-        plan = await structured_llm.ainvoke(messages)
-        return plan
+        return messages
+
+    async def create_plan(self, user_input: str, locator: str = "", image_url: str = "", screen_hash: int | None = None,
+                          images: list[VisionImage] | None = None) -> Plan:
+        messages = self.build_plan_messages(user_input, locator, image_url, images)
+        return await self._invoke_structured(Plan, "plan", messages, locator, screen_hash)
+
+    async def start_plan(self, user_input: str, locator: str = "", image_url: str = "", screen_hash: int | None = None,
+                         images: list[VisionImage] | None = None):
+        """計画をストリーミングで生成し、最初のステップが完成した時点で返す
+
+        Returns:
+            (Plan, 残りを生成中のタスク) のタプル。生成中の場合の Plan は完成済みのステップだけを含み、
+            タスクは完全な Plan を返す。キャッシュにヒットした場合や先に生成が終わった場合のタスクはNone。
+        """
+        messages = self.build_plan_messages(user_input, locator, image_url, images)
+        key = PlannerCache.key("plan", messages, locator_key(locator)) if self.cache else None
+        if key is not None:
+            cached = self.cache.get(key, screen_hash)
+            if cached is not None:
+                print(Fore.GREEN + "プランナーキャッシュにヒットしました（plan）")
+                return Plan.model_validate(cached), None
+
+        async def generate(on_steps) -> Plan:
+            plan = await stream_structured(self.llm, Plan, messages, on_steps)
+            if key is not None:
+                self.cache.put(key, "plan", plan.model_dump(mode="json"), screen_hash)
+            return plan
+
+        steps, task, plan = await start_streaming(generate)
+        if task is None:
+            return plan, None
+        return Plan(steps=steps), task
     
-    async def replan(self, state: PlanExecute, locator: str = "", image_url: str = "") -> Act:
+    def build_replan_messages(self, state: PlanExecute, locator: str = "", image_url: str = "",
+                              images: list[VisionImage] | None = None, note: str = "") -> list:
+        """replan のプロンプト（メッセージ列）を組み立てる（images を渡した場合は image_url の代わりに使う。note は状況の補足）"""
         content = f"""あなたの目標: {state["input"]}
 元の計画: {str(state["plan"])}
-現在完了したステップ: {str(state["past_steps"])}
+現在完了したステップ:
+{self.history.render(state["past_steps"])}
 
 重要な指示:
 1. メインの目標が完全に達成されているかを必ず分析してください
@@ -104,103 +191,191 @@ class SimplePlanner:
 5. 次に取るべきアクションが見える場合は、それをPlanに含めてください
 
 前のステップでエラーが発生した場合は、それを考慮して代替アプローチを考えてください。
+Planの expectations には、各ステップの完了後に画面に表示されるはずのテキストまたはresource-idを、stepsと同じ順序で入れてください（確認できないステップは空文字）。
 
 覚えておいてください: あなたの仕事は、現在の状態を観察するだけでなく、実行可能なステップを提供することです。"""
         
+        if note:
+            content += f"\n\n{note}"
         if locator:
-            content += f"\n\n現在の画面ロケーター情報: {locator}"
+            content += f"\n\n現在の画面ロケーター情報:\n{self.locator_compactor.compact(locator)}"
         
         messages = [SystemMessage(content=content)]
         
-        if image_url:
+        if images:
+            messages.append(_image_message(
+                "現在の画面状態に基づいて、目標を完了するための残りのステップは何ですか？残りのステップがある場合はPlanとして返してください。目標が完全に達成された場合のみResponseを使用してください。",
+                images))
+        elif image_url:
             messages.append(HumanMessage(content=[
                 {"type": "text", "text": "現在の画面状態に基づいて、目標を完了するための残りのステップは何ですか？残りのステップがある場合はPlanとして返してください。目標が完全に達成された場合のみResponseを使用してください。"},
                 {"type": "image_url", "image_url": {"url": image_url}}
             ]))
         else:
             messages.append(HumanMessage(content="目標を完了するための残りのステップは何ですか？残りのステップがある場合はPlanとして返してください。"))
-        
-        structured_llm = self.llm.with_structured_output(Act)
-        act = await structured_llm.ainvoke(messages)
-        return act
-
-# --- ヘルパー関数 ---
-async def generate_screen_info(screenshot_tool, generate_locators):
-    """スクリーンショットとロケーター情報を取得する"""
-    print("screenshot_tool 実行...")
-    screenshot = await screenshot_tool.ainvoke({})
-    print("screenshot_tool 結果:", screenshot[:100] if screenshot else "No screenshot")
+        return messages
 
-    print("generate_locators 実行...")
-    locator = await generate_locators.ainvoke({})
-    print("generate_locators 結果:", locator[:100] if locator else "No locator")
-
-    if not screenshot:
-        return str(locator), ""
-
-    try:
-        img_bytes = base64.b64decode(screenshot)
-        img = Image.open(io.BytesIO(img_bytes))
-        if img.mode == "RGBA":
-            img = img.convert("RGB")
-        
-        # 横幅1280px以上ならリサイズ
-        if img.width > 1280:
-            ratio = 1280 / img.width
-            new_size = (1280, int(img.height * ratio))
-            img = img.resize(new_size, Image.LANCZOS)
-
-        # Vision API用にJPEG形式でbase64化
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG")
-        img_bytes_jpeg = buf.getvalue()
-        image_url = "data:image/jpeg;base64," + base64.b64encode(img_bytes_jpeg).decode()
-        
-        return str(locator), image_url
-    except Exception as e:
-        print(f"画像処理エラー: {e}")
-        return str(locator), ""
+    async def replan(self, state: PlanExecute, locator: str = "", image_url: str = "", screen_hash: int | None = None,
+                     images: list[VisionImage] | None = None, note: str = "") -> Act:
+        messages = self.build_replan_messages(state, locator, image_url, images, note)
+        return await self._invoke_structured(Act, "replan", messages, locator, screen_hash)
 
 # --- ワークフロー関数の定義 ---
-def create_workflow_functions(planner: SimplePlanner, agent_executor, screenshot_tool, generate_locators, max_replan_count: int = 5):
+def create_workflow_functions(planner: SimplePlanner, agent_executor, screenshot_tool, generate_locators, max_replan_count: int = 5,
+                              detect_screen_change: bool = True, macro_recorder: MacroRecorder | None = None,
+                              speculative: SpeculativeObserver | None = None, multi_step: bool = True,
+                              max_steps_per_cycle: int = 5, verify_retries: int = 3, verify_interval: float = 0.5,
+                              streaming_plan: bool = True, action_compiler: ActionCompiler | None = None,
+                              image_preparation: ImagePreparation | None = None,
+                              tool_selector: ToolSelector | None = None):
     """ワークフロー関数を作成する（セッション内のツールを使用）
     
     Args:
         max_replan_count: 最大リプラン回数（デフォルト5回）
+        detect_screen_change: 前回観測から画面が変化していない場合にLLMリプランを省略/テキストのみに格下げする
+        macro_recorder: 観測とツール呼び出しを記録し、Responseで終わった実行をマクロとして保存する
+        speculative: エージェントの画面操作直後に開始した先読み観測をリプランで使う
+        multi_step: 各ステップの期待結果（expectations）をロケーター情報で確認できる間は、
+            リプランを挟まずに計画の次のステップを続けて実行する
+        max_steps_per_cycle: multi_step で1回の execute_step が実行する最大ステップ数
+        verify_retries / verify_interval: 期待結果の確認の試行回数と間隔（秒, 画面遷移の待ち）
+        streaming_plan: 最初の計画をストリーミングで生成し、ステップ1が完成した時点で実行を始める
+            （残りのステップは実行中に生成を続け、ステップ1の実行後に計画へ反映する）
+        action_compiler: 定型のステップをエージェントを使わずに直接ツール呼び出しで実行する
+            （変換できない・失敗したステップはエージェントで実行する）
+        image_preparation: プランナーに送る画像の準備方法。ROIモードでは画面の変化が小さいリプランで
+            変化領域の切り出しと縮小画像を送る（Noneなら観測した画面全体の画像をそのまま送る）
+        tool_selector: ステップごとに関係するツールだけを渡したエージェントで実行する（agent_executor の代わりに使う。
+            エラーになった・必要なツールがないと答えた場合はツールを広げて再実行する）
     """
-    
-    async def execute_step(state: PlanExecute):
-        plan = state["plan"]
-        if not plan:
-            return {"past_steps": [("error", "計画が空です")]}
-        
+    # 直前の画面観測（画面変化検出用）
+    screen_state = {"last": None}
+    # 生成中の計画の残り（plan_step が開始し、execute_step が受け取る）
+    pending_plan = {"task": None}
+
+    async def receive_rest(plan: list[str], expectations: list[str]) -> tuple[list[str], list[str]]:
+        """生成中の計画があれば完了を待ち、実行中の計画と照合して返す"""
+        task, pending_plan["task"] = pending_plan["task"], None
+        if task is None:
+            return plan, expectations
+        try:
+            full = await task
+        except Exception as e:
+            print(Fore.RED + f"計画の生成中にエラー: {e}")
+            return plan, expectations
+        if full.steps[:len(plan)] != plan:
+            print(Fore.YELLOW + f"生成された計画が実行中の計画と一致しないため、リプランで扱います: {full}")
+            return plan, expectations
+        print(Fore.GREEN + f"生成された計画（残り）: {full}")
+        return full.steps, full.expectations
+
+    async def run_task(plan: list[str], index: int) -> tuple[str, bool]:
+        """計画の index 番目のステップをエージェントで実行し、(結果, 成功したか) を返す"""
         plan_str = "\n".join(f"{i + 1}. {step}" for i, step in enumerate(plan))
-        task = plan[0]
-        task_formatted = f"""以下の計画について: {plan_str}\n\nあなたはステップ1の実行を担当します: {task}。ツールを呼び出す場合は、ツール呼び出しの出力を直接返してください。余計なコメントは追加しないでください。"""
-        
+        task = plan[index]
+        if action_compiler:
+            result = await action_compiler.run(task)
+            if result is not None:
+                return planner.history.offload(result), True
+        task_formatted = f"""以下の計画について: {plan_str}\n\nあなたはステップ{index + 1}の実行を担当します: {task}。ツールを呼び出す場合は、ツール呼び出しの出力を直接返してください。余計なコメントは追加しないでください。"""
+        level = tool_selector.start_level(task) if tool_selector else None
         try:
-            agent_response = await agent_executor.ainvoke(
-                {"messages": [("user", task_formatted)]}
-            )
+            while True:
+                executor = tool_selector.executor(task, level) if tool_selector else agent_executor
+                try:
+                    agent_response = await executor.ainvoke(
+                        {"messages": [("user", task_formatted)]}
+                    )
+                except Exception as e:
+                    if tool_selector and (level := tool_selector.widen(task, level, f"エラーになった（{e}）")) is not None:
+                        continue
+                    raise
+                if (tool_selector and tool_selector.missing_tools(agent_response["messages"])
+                        and (level := tool_selector.widen(task, level, "必要なツールがなかった")) is not None):
+                    continue
+                break
             print(Fore.RED + f"ステップ '{task}' のエージェント応答: {agent_response['messages'][-1].content}")
-            return {
-                "past_steps": [(task, agent_response["messages"][-1].content)],
-            }
+            # 大きなツール出力は退避して、state には先頭部分と参照だけを残す
+            return planner.history.offload(agent_response["messages"][-1].content), True
         except Exception as e:
             print(Fore.RED + f"execute_stepでエラー: {e}")
-            return {"past_steps": [(task, f"エラー: {str(e)}")]}
+            if macro_recorder:
+                macro_recorder.failed = True
+            return f"エラー: {str(e)}", False
+
+    async def verify(expected: str) -> bool:
+        """期待結果がロケーター情報に現れるかを確認する（スクリーンショットとLLMは使わない）"""
+        for attempt in range(verify_retries):
+            if attempt:
+                await asyncio.sleep(verify_interval)
+            try:
+                if locators_contain(await generate_locators.ainvoke({}), expected):
+                    return True
+            except Exception as e:
+                print(Fore.YELLOW + f"期待結果の確認に失敗しました: {e}")
+                return False
+        return False
+
+    async def execute_step(state: PlanExecute):
+        plan = state["plan"]
+        if not plan:
+            return {"past_steps": [("error", "計画が空です")]}
+        expectations = list(state.get("expectations") or [])
+        if macro_recorder:
+            macro_recorder.begin_step(plan[0])
+
+        past_steps = []
+        index = 0
+        received = pending_plan["task"] is not None
+        while True:
+            result, ok = await run_task(plan, index)
+            past_steps.append((plan[index], result))
+            if pending_plan["task"] is not None:
+                plan, expectations = await receive_rest(plan, expectations)
+            expected = expectations[index] if index < len(expectations) else ""
+            if not multi_step or not ok or not expected.strip() or index + 1 >= min(len(plan), max_steps_per_cycle):
+                break
+            if not await verify(expected):
+                print(Fore.YELLOW + f"期待結果 '{expected}' を確認できなかったため、リプランします。")
+                break
+            print(Fore.GREEN + f"期待結果 '{expected}' を確認しました。リプランせずに次のステップへ進みます。")
+            index += 1
+            if macro_recorder:
+                macro_recorder.begin_step(plan[index])
+
+        update = {"past_steps": past_steps}
+        if index or received:
+            # replan_step は plan[0] を直前に実行したステップとして扱うため、実行済みの分だけ進める
+            update["plan"] = plan[index:]
+            update["expectations"] = expectations[index:]
+        return update
 
     async def plan_step(state: PlanExecute):
+        if speculative:
+            speculative.invalidate()
+        pending_plan["task"] = None
         try:
-            locator, image_url = await generate_screen_info(screenshot_tool, generate_locators)
-            plan = await planner.create_plan(state["input"], locator, image_url)
-            print(Fore.GREEN + f"生成された計画: {plan}")
-            return {"plan": plan.steps, "replan_count": 0}  # 初期化時はreplan_countを0に設定
+            observation = await generate_screen_info(screenshot_tool, generate_locators)
+            screen_state["last"] = observation
+            if macro_recorder:
+                macro_recorder.observe(observation.phash)
+            images = await prepare_vision_images(observation, None, image_preparation) if image_preparation else None
+            if streaming_plan:
+                plan, pending_plan["task"] = await planner.start_plan(
+                    state["input"], observation.locator, observation.image_url, screen_hash=observation.phash,
+                    images=images)
+            else:
+                plan = await planner.create_plan(state["input"], observation.locator, observation.image_url,
+                                                 screen_hash=observation.phash, images=images)
+            print(Fore.GREEN + f"生成された計画{'（生成中）' if pending_plan['task'] else ''}: {plan}")
+            return {"plan": plan.steps, "expectations": plan.expectations, "replan_count": 0}  # 初期化時はreplan_countを0に設定
         except Exception as e:
             print(Fore.RED + f"plan_stepでエラー: {e}")
+            if macro_recorder:
+                macro_recorder.failed = True
             # フォールバック: 基本的なプランを作成
             basic_plan = await planner.create_plan(state["input"])
-            return {"plan": basic_plan.steps, "replan_count": 0}
+            return {"plan": basic_plan.steps, "expectations": basic_plan.expectations, "replan_count": 0}
 
     async def replan_step(state: PlanExecute):
         current_replan_count = state.get("replan_count", 0)
@@ -214,11 +389,48 @@ def create_workflow_functions(planner: SimplePlanner, agent_executor, screenshot
             }
         
         try:
-            locator, image_url = await generate_screen_info(screenshot_tool, generate_locators)
-            output = await planner.replan(state, locator, image_url)
+            observation = await speculative.take() if speculative else None
+            if observation is None:
+                observation = await generate_screen_info(screenshot_tool, generate_locators)
+            previous = screen_state["last"]
+            screen_state["last"] = observation
+            image_url = observation.image_url
+            if macro_recorder:
+                macro_recorder.observe(observation.phash)
+
+            change = None
+            note = ""
+            if detect_screen_change and previous is not None:
+                change = compare_screens(previous, observation)
+                print(Fore.YELLOW + f"画面変化: {change.kind} (changed_ratio={change.changed_ratio:.3f}, hamming={change.hamming})")
+                last_result = str(state["past_steps"][-1][1]) if state["past_steps"] else ""
+                expectations = list(state.get("expectations") or [])
+                expected = expectations[0] if expectations else ""
+                if change.unchanged and len(state["plan"]) > 1 and not last_result.startswith("エラー") \
+                        and expected.strip() and locators_contain(observation.locator, expected):
+                    # 画面を変えないステップ（期待結果が既に表示されている）: LLMを呼ばずに計画の次のステップへ進む
+                    print(Fore.YELLOW + f"画面に変化がなく、期待結果 '{expected}' を確認できたため、リプランを省略して次のステップへ進みます。")
+                    return {"plan": state["plan"][1:], "expectations": expectations[1:]}
+                if change.unchanged:
+                    # 操作が効かなかった可能性がある: 画像なしの安いリプランで計画を見直す
+                    note = "直前のステップの後、画面に変化がありません。操作が失敗した可能性を考慮してください。"
+                    image_url = ""
+                elif change.kind != CHANGED and (image_preparation is None or image_preparation.mode == FULL):
+                    # 画面の変化が小さい場合は画像なし（テキストのみ）でリプランする
+                    image_url = ""
+
+            images = None
+            if image_preparation is not None and image_url:
+                # ROIモードでは変化が小さい場合に変化領域の切り出しと縮小画像だけを送る
+                images = await prepare_vision_images(observation, change, image_preparation)
+                print(Fore.CYAN + format_images(images, observation))
+            output = await planner.replan(state, observation.locator, image_url, screen_hash=observation.phash,
+                                          images=images, note=note)
             print(Fore.YELLOW + f"Replanner Output (replan #{current_replan_count + 1}): {output}")
             
             if isinstance(output.action, Response):
+                if macro_recorder:
+                    macro_recorder.finish(output.action.response)
                 return {
                     "response": output.action.response,
                     "replan_count": current_replan_count + 1
@@ -226,6 +438,7 @@ def create_workflow_functions(planner: SimplePlanner, agent_executor, screenshot
             else:
                 return {
                     "plan": output.action.steps,
+                    "expectations": output.action.expectations,
                     "replan_count": current_replan_count + 1
                 }
         except Exception as e:
@@ -246,61 +459,10 @@ def create_workflow_functions(planner: SimplePlanner, agent_executor, screenshot
     
     return execute_step, plan_step, replan_step, should_end
 
-# --- メイン実行関数 ---
-async def main():
-    """MCPセッション内ですべての処理を実行するメイン関数"""
-    config = {"recursion_limit": 50}
-    past_steps = []
-
-    client = MultiServerMCPClient(SERVER_CONFIG)
-    async with client.session("jarvis-appium-sse") as session:
-        # ツールを取得
-        tools = await load_mcp_tools(session)
-
-        # 必要なツールを取得
-        select_platform = next(t for t in tools if t.name == "select_platform")
-        create_session = next(t for t in tools if t.name == "create_session")
-        screenshot_tool = next(t for t in tools if t.name == "appium_screenshot")
-        generate_locators = next(t for t in tools if t.name == "generate_locators")
-
-        # プラットフォーム選択とセッション作成
-        print("select_platform 実行...")
-        platform = await select_platform.ainvoke({"platform": "android"})
-        print("select_platform結果:", platform)
-        past_steps.append(("select_platform", str(platform)))
-
-        print("create_session 実行...")
-        session_result = await create_session.ainvoke({"platform": "android"})
-        print("create_session結果:", session_result)
-        past_steps.append(("create_session", str(session_result)))
-
-        # エージェントエグゼキューターを作成
-        llm = ChatOpenAI(model="gpt-4.1", temperature=0)
-        prompt = "あなたは親切なアシスタントです。与えられたタスクを正確に実行してください。"
-        agent_executor = create_react_agent(llm, tools, prompt=prompt)
-
-        # プランナーを作成
-        planner = SimplePlanner()
-
-        # ワークフロー関数を作成（セッション内のツールを使用）
-        max_replan_count = 10
-        execute_step, plan_step, replan_step, should_end = create_workflow_functions(
-            planner, agent_executor, screenshot_tool, generate_locators, max_replan_count
-        )
-
-        # ワークフローを構築
-        workflow = StateGraph(PlanExecute)
-        workflow.add_node("planner", plan_step)
-        workflow.add_node("agent", execute_step)
-        workflow.add_node("replan", replan_step)
-        workflow.add_edge(START, "planner")
-        workflow.add_edge("planner", "agent")
-        workflow.add_edge("agent", "replan")
-        workflow.add_conditional_edges("replan", should_end, ["agent", END])
-        app = workflow.compile()
+# --- グラフ構築・実行 ---
+AGENT_PROMPT = "あなたは親切なアシスタントです。与えられたタスクを正確に実行してください。"
 
-        # 実行
-        knowhow = """
+KNOWHOW = """
         1. アプリを実行するときは `appium_activate_app` ツールを使用します。
         例えば:
             await appium_activate_app.ainvoke({"id": "com.android.chrome"})
@@ -308,24 +470,240 @@ async def main():
         例えば:
             await appium_set_value.ainvoke({"args.elementUUID": "xxxx", "args.text": 'www.google.com\n'})
         """
-        #query = "Androidで動作するChromeを起動して、メニューを開いて、新しいタブを開く。すべて日本語で回答してください。"
-        query = "Androidで動作するChromeを起動して、yahoo.co.jp を開いてください"
-        inputs = {
-            "input": knowhow + query,
-            "past_steps": past_steps,
-            "replan_count": 0  # 初期化
-        }
-        
-        print(Fore.CYAN + "=== Plan-and-Execute Agent 開始 ===")
-        try:
-            async for event in app.astream(inputs, config=config):
-                for k, v in event.items():
-                    if k != "__end__":
-                        print(Fore.BLUE + str(v))
-        except Exception as e:
-            print(Fore.RED + f"実行中にエラーが発生しました: {e}")
-        finally:
-            print(Fore.CYAN + "=== Plan-and-Execute Agent 終了 ===")
+
+
+def build_app(tools, max_replan_count: int = 10, llm=None, planner_cache: PlannerCache | None = None,
+              macro_store: MacroStore | None = None, speculative_observation: bool = True, multi_step: bool = True,
+              streaming_plan: bool = True, compile_actions: bool = True, checkpointer=None,
+              image_preparation: ImagePreparation | None = None, store_frames: bool = True,
+              select_tools: bool = True, cache_elements: bool = True):
+    """ツール一覧からPlan-and-Executeグラフを構築してコンパイルする
+
+    llm を渡した場合はエージェントとプランナーの両方で使う（トレースの記録・再生用）
+    planner_cache を渡した場合はプランナーの応答をキャッシュする
+    macro_store を渡した場合は、計画の前に保存済みマクロを試し、成功した実行をマクロとして保存する
+    speculative_observation がTrueなら、エージェントの画面操作が終わった時点で次の観測を先行して開始する
+    multi_step がTrueなら、期待結果をロケーター情報で確認できたステップの後はリプランせずに次のステップを実行する
+    streaming_plan がTrueなら、最初の計画のステップ1が生成された時点で実行を始める
+    compile_actions がTrueなら、アプリの起動・文字の入力・タップなどの定型ステップをLLMを使わずに実行する
+    checkpointer を渡した場合はノードごとにグラフの状態を保存する（config に thread_id が必要）
+    image_preparation はプランナーに送る画像の準備方法（省略時はROIモード: 変化が小さいリプランでは変化領域の切り出しと縮小画像を送る）
+    store_frames がTrueなら、スクリーンショットをフレームストアに保存し、ツールの出力（エージェントのメッセージ・ログ）には参照だけを残す
+    select_tools がTrueなら、エージェントにはステップに関係するツールだけを渡す（実行できなければ広げる）
+    cache_elements がTrueなら、画面が変わるまで find_element の結果を再利用する（古い要素UUIDは検索し直して再試行）
+    """
+    if store_frames:
+        tools = get_frame_store().wrap_tools(tools)
+    if cache_elements:
+        # グラフの画面観測も通して、画面の変化でキャッシュを破棄する
+        tools = ElementCache().wrap_tools(tools)
+    registry = ToolRegistry(tools)
+    screenshot_tool = registry["appium_screenshot"]
+    generate_locators = registry["generate_locators"]
+
+    # マクロ記録用にエージェントのツール呼び出しを記録する
+    macro_recorder = MacroRecorder(macro_store) if macro_store else None
+    agent_tools = macro_recorder.wrap_tools(tools) if macro_recorder else tools
+    speculative = SpeculativeObserver(screenshot_tool, generate_locators) if speculative_observation else None
+    if speculative:
+        agent_tools = speculative.wrap_tools(agent_tools)
+
+    action_compiler = ActionCompiler(agent_tools) if compile_actions else None
+
+    # エージェントエグゼキューターを作成
+    llm = llm or ChatOpenAI(model="gpt-4.1", temperature=0, **rate_limited_client_kwargs())
+    # エージェント内部のメッセージ（スクリーンショットを含む）はチェックポイントに保存しない
+    tool_selector = ToolSelector(llm, agent_tools, prompt=AGENT_PROMPT) if select_tools else None
+    agent_executor = None if tool_selector else create_react_agent(llm, agent_tools, prompt=AGENT_PROMPT, checkpointer=False)
+
+    # プランナーを作成
+    planner = SimplePlanner(llm=llm, cache=planner_cache)
+
+    # ワークフロー関数を作成（セッション内のツールを使用）
+    execute_step, plan_step, replan_step, should_end = create_workflow_functions(
+        planner, agent_executor, screenshot_tool, generate_locators, max_replan_count,
+        macro_recorder=macro_recorder, speculative=speculative, multi_step=multi_step,
+        streaming_plan=streaming_plan, action_compiler=action_compiler,
+        image_preparation=image_preparation or ImagePreparation(), tool_selector=tool_selector,
+    )
+
+    # ワークフローを構築
+    workflow = StateGraph(PlanExecute)
+    workflow.add_node("planner", plan_step)
+    workflow.add_node("agent", execute_step)
+    workflow.add_node("replan", replan_step)
+    if macro_recorder:
+        workflow.add_node("macro", create_macro_step(macro_store, macro_recorder, registry, screenshot_tool))
+        workflow.add_edge(START, "macro")
+        workflow.add_conditional_edges("macro", lambda state: END if state.get("response") else "planner",
+                                       ["planner", END])
+    else:
+        workflow.add_edge(START, "planner")
+    workflow.add_edge("planner", "agent")
+    workflow.add_edge("agent", "replan")
+    workflow.add_conditional_edges("replan", should_end, ["agent", END])
+    return workflow.compile(checkpointer=checkpointer)
+
+
+async def _node_updates(app, inputs: dict, config: dict, logger: EventLogger | None):
+    """グラフの各ノードの出力（{ノード名: 出力}）を順に返す
+
+    logger を渡した場合は astream_events で実行し、全イベントを logger.dispatch() に渡す
+    （ノード・ツール・LLM呼び出しのレイテンシーが集計される）。
+    """
+    if logger is None:
+        async for event in app.astream(inputs, config=config):
+            yield event
+        return
+    async for ev in app.astream_events(inputs, config=config, version="v2"):
+        logger.dispatch(ev)
+        # トップレベルのグラフノードの終了イベントが astream の1イベントに相当する
+        if ev["event"] == "on_chain_end" and len(ev.get("parent_ids", [])) == 1 \
+                and ev.get("metadata", {}).get("langgraph_node") == ev["name"]:
+            yield {ev["name"]: ev["data"].get("output")}
+
+
+async def run_scenario(app, query: str, past_steps: list, knowhow: str = KNOWHOW, config: dict | None = None,
+                       logger: EventLogger | None = None, resume: bool = False) -> dict:
+    """コンパイル済みグラフで1つのシナリオを実行し、最終状態（response, past_steps）を返す
+
+    logger を渡した場合はイベントを記録し、終了時にレイテンシー集計をAllureに添付する。
+    resume がTrueなら、config の thread_id のチェックポイントから最後に完了したノードの次を実行する
+    （チェックポイント付きでコンパイルしたグラフが必要。query と past_steps は使わない）。
+    """
+    config = config or {"recursion_limit": 50}
+    inputs = {
+        "input": knowhow + query,
+        "past_steps": list(past_steps),
+        "replan_count": 0  # 初期化
+    }
+    result = {"response": "", "past_steps": list(past_steps)}
+    if resume:
+        snapshot = await app.aget_state(config)
+        if not snapshot.values:
+            raise ValueError(f"スレッド '{config['configurable']['thread_id']}' のチェックポイントがありません")
+        result = {"response": snapshot.values.get("response", ""),
+                  "past_steps": [tuple(step) for step in snapshot.values.get("past_steps", [])]}
+        if not snapshot.next:
+            print(Fore.YELLOW + "このシナリオは既に完了しています。")
+            return result
+        print(Fore.CYAN + f"チェックポイントから再開します（完了済み {len(result['past_steps'])}ステップ, 次のノード: {', '.join(snapshot.next)}）")
+        inputs = None
+
+    print(Fore.CYAN + "=== Plan-and-Execute Agent 開始 ===")
+    try:
+        async for event in _node_updates(app, inputs, config, logger):
+            for k, v in event.items():
+                if k != "__end__":
+                    print(Fore.BLUE + str(v))
+                    if v:
+                        result["past_steps"] += v.get("past_steps", [])
+                        result["response"] = v.get("response") or result["response"]
+    except Exception as e:
+        print(Fore.RED + f"実行中にエラーが発生しました: {e}")
+        result["error"] = str(e)
+    finally:
+        if logger is not None:
+            await logger.aflush()
+            logger.attach_latency_report()
+        print(Fore.CYAN + "=== Plan-and-Execute Agent 終了 ===")
+    return result
+
+
+# --- メイン実行関数 ---
+async def main(record_dir: str | None = None, replay_dir: str | None = None, latency_report: str | None = None,
+               use_planner_cache: bool = True, use_macros: bool = True, checkpoint_db: str | None = None,
+               resume_thread: str | None = None, full_images: bool = False):
+    """MCPセッション内ですべての処理を実行するメイン関数
+
+    Args:
+        record_dir: 指定した場合、ツール呼び出しとLLM呼び出しをこのディレクトリにトレースとして記録する
+        replay_dir: 指定した場合、MCPサーバーとOpenAIの代わりに記録済みトレースを再生する
+        latency_report: 指定した場合、ノード・ツール・LLMごとのレイテンシー集計をこのJSONファイルに書き出す
+        use_planner_cache: プランナー応答キャッシュを使う（記録・再生時はLLM呼び出しを省略しないよう常に無効）
+        use_macros: 保存済みマクロを試し、成功した実行をマクロとして保存する（記録・再生時は常に無効）
+        checkpoint_db: ノードごとにグラフの状態を保存するSQLiteファイル（Noneなら保存しない）
+        resume_thread: 指定した場合、このスレッドIDのチェックポイントから実行を再開する
+            （デバイスのセッションは新しく作り直し、最後に完了したノードの次から続ける）
+        full_images: 変化領域の切り出しを行わず、リプランでも画面全体の画像を送る
+    """
+    logger = EventLogger()
+    #query = "Androidで動作するChromeを起動して、メニューを開いて、新しいタブを開く。すべて日本語で回答してください。"
+    query = "Androidで動作するChromeを起動して、yahoo.co.jp を開いてください"
+
+    if replay_dir:
+        # デバイスもネットワークも使わずにトレースを再生する
+        player = TracePlayer(replay_dir)
+        # 計画のストリーミング生成と先読み観測はエージェントの実行と並行するため、記録時と同じく使わない
+        app = build_app(player.tools(), max_replan_count=10, llm=player.chat_model(), streaming_plan=False,
+                        speculative_observation=False)
+        await run_scenario(app, query, player.setup_steps, logger=logger)
+        print(Fore.CYAN + player.format_report())
+        if latency_report:
+            logger.write_latency_report(latency_report)
+        return
+
+    if resume_thread and not checkpoint_db:
+        raise ValueError("再開するにはチェックポイントのファイルが必要です")
+    pool = MCPSessionPool(SERVER_CONFIG)
+    checkpointer = SqliteCheckpointSaver(checkpoint_db) if checkpoint_db else None
+    thread_id = resume_thread or new_thread_id()
+    config = {"recursion_limit": 50, "configurable": {"thread_id": thread_id}}
+    if checkpointer:
+        print(Fore.CYAN + f"チェックポイント: {checkpoint_db}（再開するときは --resume {thread_id}）")
+    recorder = TraceRecorder(record_dir) if record_dir else None
+    planner_cache = PlannerCache() if use_planner_cache and not recorder else None
+    macro_store = MacroStore() if use_macros and not recorder else None
+    try:
+        # MCPセッションを開き、プラットフォーム選択とAppiumセッション作成を行う
+        pooled = await pool.acquire("jarvis-appium-sse")
+
+        tools, llm = pooled.tools, None
+        if recorder:
+            recorder.record_setup(pooled.setup_steps)
+            tools = recorder.wrap_tools(tools)
+            llm = ChatOpenAI(model="gpt-4.1", temperature=0, callbacks=[recorder.llm_handler], **rate_limited_client_kwargs())
+        # 再開時はマクロを使わない（グラフの途中から続けるため）
+        app = build_app(tools, max_replan_count=10, llm=llm, planner_cache=planner_cache,
+                        macro_store=None if resume_thread else macro_store, checkpointer=checkpointer,
+                        image_preparation=ImagePreparation(mode=FULL) if full_images else None,
+                        # ストリーミング中の計画はエージェントのプロンプトに入る時点のステップ数が実行ごとに変わり、
+                        # 再生時のLLMリクエストが記録と一致しなくなる
+                        streaming_plan=not recorder,
+                        # 取り消された先読み観測は記録されないが、再生時はツールの記録を消費して以降の結果がずれる
+                        speculative_observation=not recorder)
+
+        # 実行
+        await run_scenario(app, query, pooled.setup_steps, config=config, logger=logger, resume=bool(resume_thread))
+        if latency_report:
+            logger.write_latency_report(latency_report)
+    finally:
+        if recorder:
+            recorder.close()
+        if planner_cache:
+            print(Fore.CYAN + planner_cache.format_stats())
+            planner_cache.close()
+        print(Fore.CYAN + get_limiter().format_stats())
+        print(Fore.CYAN + get_frame_store().format_stats())
+        if checkpointer:
+            checkpointer.close()
+        await pool.aclose()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Plan-and-Execute Agent")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--record", metavar="DIR", help="実行をトレースとして記録するディレクトリ")
+    group.add_argument("--replay", metavar="DIR", help="再生する記録済みトレースのディレクトリ")
+    group.add_argument("--resume", metavar="THREAD_ID", help="チェックポイントから再開するスレッドID")
+    parser.add_argument("--checkpoint-db", metavar="PATH", default=str(DEFAULT_CHECKPOINT_PATH),
+                        help="グラフの状態を保存するSQLiteファイル")
+    parser.add_argument("--no-checkpoint", action="store_true", help="グラフの状態を保存しない")
+    parser.add_argument("--latency-report", metavar="PATH", help="レイテンシー集計を書き出すJSONファイル")
+    parser.add_argument("--no-planner-cache", action="store_true", help="プランナー応答キャッシュを使わない")
+    parser.add_argument("--no-macros", action="store_true", help="マクロの再実行と保存を行わない")
+    parser.add_argument("--full-images", action="store_true", help="変化領域の切り出しを行わず、常に画面全体の画像を送る")
+    args = parser.parse_args()
+    asyncio.run(main(record_dir=args.record, replay_dir=args.replay, latency_report=args.latency_report,
+                     use_planner_cache=not args.no_planner_cache, use_macros=not args.no_macros,
+                     checkpoint_db=None if args.no_checkpoint else args.checkpoint_db, resume_thread=args.resume,
+                     full_images=args.full_images))
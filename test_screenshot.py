@@ -1,10 +1,10 @@
 import asyncio
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_mcp_adapters.tools import load_mcp_tools
 import base64
 from PIL import Image
 import io
 
+from mcp_session_pool import MCPSessionPool
+
 SERVER_CONFIG = {
     "jarvis-appium": {
         "command": "/opt/homebrew/opt/node@20/bin/npx",
@@ -19,20 +19,13 @@ SERVER_CONFIG = {
 }
 
 async def main():
-    client = MultiServerMCPClient(SERVER_CONFIG)
-    async with client.session("jarvis-appium") as session:
-        tools = await load_mcp_tools(session)
-        select_platform = next(t for t in tools if t.name == "select_platform")
-        create_session = next(t for t in tools if t.name == "create_session")
-        screenshot_tool = next(t for t in tools if t.name == "appium_screenshot")
-
-        print("select_platform 実行...")
-        platform = await select_platform.ainvoke({"platform": "android"})
-        print("select_platform結果:", platform)
-
-        print("create_session 実行...")
-        session = await create_session.ainvoke({"platform": "android"})
-        print("create_session結果:", session)
+    pool = MCPSessionPool(SERVER_CONFIG)
+    try:
+        # select_platform → create_session はプールがセッションを開くときに実行する
+        pooled = await pool.acquire("jarvis-appium")
+        for name, result in pooled.setup_steps:
+            print(f"{name}結果:", result)
+        screenshot_tool = pooled.tool("appium_screenshot")
 
         print("screenshot_tool 実行...")
         screenshot = await screenshot_tool.ainvoke({})
@@ -48,6 +41,8 @@ async def main():
             img.save("test_screenshot.jpg", "JPEG")
         
         print("test_screenshot.png と test_screenshot.jpg 保存完了")
+    finally:
+        await pool.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())
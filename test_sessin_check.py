@@ -1,6 +1,6 @@
 import asyncio
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_mcp_adapters.tools import load_mcp_tools
+
+from mcp_session_pool import MCPSessionPool
 
 SERVER_CONFIG = {
     "jarvis-appium": {
@@ -17,27 +17,21 @@ SERVER_CONFIG = {
 
 async def main():
     print("MCPクライアント初期化...")
-    client = MultiServerMCPClient(SERVER_CONFIG)
-    async with client.session("jarvis-appium") as session:
-        print("セッション開始: jarvis-appium")
-        tools = await load_mcp_tools(session)
-        print(f"取得ツール数: {len(tools)}")
+    pool = MCPSessionPool(SERVER_CONFIG)
+    try:
         # select_platform → create_session → generate_locators の流れをテスト
-        select_platform = next(t for t in tools if t.name == "select_platform")
-        create_session = next(t for t in tools if t.name == "create_session")
-        generate_locators = next(t for t in tools if t.name == "generate_locators")
-
-        print("select_platform 実行...")
-        result1 = await select_platform.ainvoke({"platform": "android"})
-        print("select_platform結果:", result1)
-
-        print("create_session 実行...")
-        result2 = await create_session.ainvoke({"platform": "android"})
-        print("create_session結果:", result2)
+        # （select_platform / create_session はプールがセッションを開くときに実行する）
+        pooled = await pool.acquire("jarvis-appium")
+        print("セッション開始: jarvis-appium")
+        print(f"取得ツール数: {len(pooled.tools)}")
+        for name, result in pooled.setup_steps:
+            print(f"{name}結果:", result)
 
         print("generate_locators 実行...")
-        result3 = await generate_locators.ainvoke({})
-        print("generate_locators結果:", result3)
+        result = await pooled.tool("generate_locators").ainvoke({})
+        print("generate_locators結果:", result)
+    finally:
+        await pool.aclose()
 
     print("セッション終了")
 
@@ -0,0 +1,53 @@
+"""ツール呼び出しのフック
+
+MCPツールと同じ名前・説明・引数スキーマを持つツールを作り、呼び出しの前後に処理を挟む。
+内側のツールは ainvoke ではなく coroutine を直接呼ぶため、コールバック
+（astream_events のツールイベント）が二重に発生しない。
+"""
+import asyncio
+from functools import partial
+from typing import Any, Awaitable, Callable
+
+from langchain_core.tools import BaseTool, StructuredTool
+
+# around(tool, kwargs, call) -> result
+#   call(kwargs) で内側のツールを実行する
+AroundHook = Callable[[BaseTool, dict, Callable[[dict], Awaitable[Any]]], Awaitable[Any]]
+
+
+async def call_tool_coroutine(tool: BaseTool, kwargs: dict):
+    """コールバックを発火させずにツール本体を実行する"""
+    coroutine = getattr(tool, "coroutine", None)
+    if coroutine is not None:
+        return await coroutine(**kwargs)
+    func = getattr(tool, "func", None)
+    if func is None:
+        return await tool.ainvoke(kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, **kwargs))
+
+
+def wrap_tool(tool: BaseTool, around: AroundHook) -> StructuredTool:
+    """ツール呼び出しをaroundフックで包んだツールを返す"""
+    async def coroutine(**kwargs):
+        return await around(tool, kwargs, partial(call_tool_coroutine, tool))
+
+    return StructuredTool(
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+        coroutine=coroutine,
+        response_format=tool.response_format,
+        metadata=tool.metadata,
+        handle_tool_error=tool.handle_tool_error,
+    )
+
+
+def wrap_tools(tools: list[BaseTool], around: AroundHook) -> list[StructuredTool]:
+    return [wrap_tool(tool, around) for tool in tools]
+
+
+def tool_content(tool: BaseTool, result):
+    """coroutineの戻り値からテキスト出力部分を取り出す（content_and_artifact形式に対応）"""
+    if tool.response_format == "content_and_artifact" and isinstance(result, tuple):
+        return result[0]
+    return result
@@ -0,0 +1,176 @@
+"""ツールレジストリとスキーマキャッシュ
+
+- ToolRegistry: ツールを名前と機能（capability）で索引する
+- ToolSchemaCache: サーバーごと・サーバーバージョンごとにツールスキーマをローカルに保存する
+- load_tools_cached(): キャッシュがあれば tools/list を待たずにツールを構築し、
+  バックグラウンドで tools/list を実行してキャッシュを再検証する
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+
+from colorama import Fore
+from langchain_core.tools import BaseTool
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+from mcp.types import Tool as MCPTool
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("TEST_ROBOT_CACHE_DIR", Path.home() / ".cache" / "test_robot")) / "tool_schemas"
+
+# 機能タグ → ツール名のパターン
+CAPABILITY_PATTERNS = {
+    "session": r"select_platform|create_session|create_lambdatest_session|upload_app",
+    "observe": r"screenshot|generate_locators|get_text|find_element|list_elements|get_screen_size|get_orientation|list_apps|list_available_devices",
+    "element": r"find_element|click|set_value|get_text|scroll_to_element",
+    "app": r"activate_app|terminate_app|launch_app|list_apps|open_url",
+    "gesture": r"scroll|swipe|click_on_screen|long_press|press_button",
+    "input": r"set_value|type_keys",
+    "docs": r"documentation_query|generate_tests",
+}
+
+# 画面の状態を変える（デバイスを操作する）ツールのパターン
+MUTATING_PATTERN = re.compile(
+    r"click|set_value|scroll|swipe|activate_app|terminate_app|launch_app|open_url|long_press|press_button|type_keys|set_orientation"
+)
+
+
+def is_mutating(tool_name: str) -> bool:
+    """画面の状態を変えるツールか"""
+    return bool(MUTATING_PATTERN.search(tool_name))
+
+
+def infer_capabilities(tool_name: str) -> set[str]:
+    """ツール名から機能タグを推定する"""
+    capabilities = {cap for cap, pattern in CAPABILITY_PATTERNS.items() if re.search(pattern, tool_name)}
+    if is_mutating(tool_name):
+        capabilities.add("mutating")
+    return capabilities
+
+
+class ToolRegistry:
+    """ツールを名前と機能で索引する"""
+
+    def __init__(self, tools: list[BaseTool]):
+        self.tools = list(tools)
+        self._by_name = {t.name: t for t in self.tools}
+        self._by_capability: dict[str, list[BaseTool]] = {}
+        for tool in self.tools:
+            for capability in infer_capabilities(tool.name):
+                self._by_capability.setdefault(capability, []).append(tool)
+
+    def __getitem__(self, name: str) -> BaseTool:
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise KeyError(f"ツール '{name}' が見つかりません。利用可能: {list(self._by_name)}") from None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._by_name
+
+    def __iter__(self):
+        return iter(self.tools)
+
+    def __len__(self):
+        return len(self.tools)
+
+    def get(self, name: str, default=None) -> BaseTool | None:
+        return self._by_name.get(name, default)
+
+    def names(self) -> list[str]:
+        return list(self._by_name)
+
+    def by_capability(self, capability: str) -> list[BaseTool]:
+        return list(self._by_capability.get(capability, []))
+
+
+class ToolSchemaCache:
+    """ツールスキーマのディスクキャッシュ（サーバー設定 + サーバーバージョンごと）"""
+
+    def __init__(self, cache_dir: str | Path = DEFAULT_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+
+    @staticmethod
+    def key(server_name: str, connection: dict, server_version: str) -> str:
+        # 環境変数（ローカルパス）はツールスキーマに影響しないためキーから除外する
+        config = {k: v for k, v in connection.items() if k != "env"}
+        digest = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:12]
+        return f"{re.sub(r'[^\w.-]+', '_', server_name)}-{digest}-{re.sub(r'[^\w.-]+', '_', server_version)}"
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def load(self, key: str) -> list[MCPTool] | None:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            return [MCPTool.model_validate(item) for item in data["tools"]]
+        except Exception as e:
+            print(Fore.YELLOW + f"ツールスキーマキャッシュを読み込めません（{path}）: {e}")
+            return None
+
+    def save(self, key: str, tools: list[MCPTool]):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        data = {"tools": [t.model_dump(mode="json", by_alias=True, exclude_none=True) for t in tools]}
+        tmp_path = self._path(key).with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+        tmp_path.replace(self._path(key))
+
+
+async def list_all_tools(session) -> list[MCPTool]:
+    """tools/list をページングしながら全件取得する"""
+    tools = []
+    cursor = None
+    while True:
+        result = await session.list_tools(cursor=cursor)
+        tools.extend(result.tools)
+        cursor = result.nextCursor
+        if not cursor:
+            return tools
+
+
+def _schema_fingerprint(tools: list[MCPTool]) -> list[str]:
+    return sorted(json.dumps(t.model_dump(mode="json", exclude_none=True), sort_keys=True) for t in tools)
+
+
+async def load_tools_cached(session, key: str, cache: ToolSchemaCache, on_revalidated=None) -> list[BaseTool]:
+    """キャッシュからツールを構築する。キャッシュがなければ tools/list で取得して保存する
+
+    キャッシュを使った場合はバックグラウンドで tools/list を実行し、スキーマが変わっていれば
+    キャッシュを更新して on_revalidated(新しいツール一覧) を呼ぶ。
+    """
+    cached = cache.load(key)
+    if cached is None:
+        mcp_tools = await list_all_tools(session)
+        cache.save(key, mcp_tools)
+        return [convert_mcp_tool_to_langchain_tool(session, t) for t in mcp_tools]
+
+    # 出力スキーマ検証用のセッション内キャッシュも埋めておく（初回call_toolでのtools/listを避ける）
+    output_schemas = getattr(session, "_tool_output_schemas", None)
+    if isinstance(output_schemas, dict):
+        for t in cached:
+            output_schemas.setdefault(t.name, t.outputSchema)
+
+    async def revalidate():
+        try:
+            fresh = await list_all_tools(session)
+        except Exception as e:
+            print(Fore.YELLOW + f"ツールスキーマの再検証に失敗しました: {e}")
+            return
+        if _schema_fingerprint(cached) == _schema_fingerprint(fresh):
+            return
+        print(Fore.YELLOW + "ツールスキーマが変更されたため、キャッシュを更新しました。")
+        cache.save(key, fresh)
+        if on_revalidated is not None:
+            on_revalidated([convert_mcp_tool_to_langchain_tool(session, t) for t in fresh])
+
+    _background_tasks.add(task := asyncio.create_task(revalidate()))
+    task.add_done_callback(_background_tasks.discard)
+    return [convert_mcp_tool_to_langchain_tool(session, t) for t in cached]
+
+
+# バックグラウンドタスクがGCされないよう参照を保持する
+_background_tasks: set[asyncio.Task] = set()
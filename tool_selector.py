@@ -0,0 +1,207 @@
+"""計画ステップごとのツール選択
+
+create_react_agent に全ツールを渡すと、create_lambdatest_session / upload_app_lambdatest /
+appium_generate_tests のようにステップと関係のないツールのJSONスキーマまで、エージェントの毎回のLLM呼び出しに入る。
+
+ToolSelector はツール名・説明・機能タグ（tool_registry）から作ったローカルのキーワード索引で
+ステップに関係するツールだけを選び、選んだツールの組み合わせごとにReActエージェントをキャッシュする。
+日本語のステップは KEYWORDS でツール名に現れる英単語に対応付ける（埋め込みモデルは使わない）。
+
+選んだツールでは実行できなかった場合（エラーになった場合、渡していないツールを呼ぼうとした場合、
+ツールを呼ばずに NO_TOOL_REPLY と答えた場合）は、
+段階的にツールを広げて再実行する。
+  0: 選んだツール + 常に含めるツール（CORE_TOOLS）
+  1: セッション管理・ドキュメント以外のすべてのツール
+  2: すべてのツール
+同じステップがリプランで再び実行される場合は、前回広げた段階から始める。
+"""
+import json
+import math
+import re
+from collections import Counter
+
+from colorama import Fore
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langgraph.prebuilt import create_react_agent
+from langgraph.prebuilt.tool_node import INVALID_TOOL_NAME_ERROR_TEMPLATE
+
+from locator_compactor import estimate_tokens
+from tool_registry import infer_capabilities
+
+# 要素を操作するほとんどのステップで必要になるツール
+CORE_TOOLS = ("generate_locators", "appium_find_element")
+# 計画ステップの実行では使わない機能（段階0・1では除く）
+EXCLUDED_CAPABILITIES = frozenset({"session", "docs"})
+
+# ステップに現れる日本語 → ツール名・説明に現れる英単語
+KEYWORDS = {
+    "起動": ["activate", "launch", "app"],
+    "開": ["activate", "launch", "open"],
+    "アプリ": ["app"],
+    "終了": ["terminate"],
+    "閉じ": ["terminate"],
+    "停止": ["terminate"],
+    "入力": ["set", "value", "type", "keys"],
+    "タイプ": ["set", "value", "type"],
+    "検索": ["set", "value"],
+    "タップ": ["click", "tap"],
+    "クリック": ["click"],
+    "押": ["click", "press"],
+    "選択": ["click"],
+    "スクロール": ["scroll"],
+    "スワイプ": ["swipe", "scroll"],
+    "長押し": ["long", "press"],
+    "テキスト": ["text"],
+    "文字": ["text"],
+    "取得": ["get", "text"],
+    "確認": ["get", "text"],
+    "スクリーンショット": ["screenshot"],
+    "画面": ["screenshot"],
+    "url": ["url", "open"],
+    # 英語のステップでツール名に現れない動詞
+    "tap": ["click"],
+    "press": ["click"],
+    "launch": ["activate"],
+    "open": ["activate"],
+    "close": ["terminate"],
+    "enter": ["set", "value"],
+    "type": ["set", "value"],
+    "swipe": ["scroll"],
+}
+
+_WORD = re.compile(r"[A-Z]+(?![a-z])|[A-Za-z][a-z]*")
+_STOP_WORDS = frozenset({"the", "a", "an", "to", "of", "and", "or", "for", "in", "on", "with", "is", "this", "that",
+                         "by", "from", "appium", "tool", "returns", "use", "using"})
+
+NO_TOOL_REPLY = "必要なツールがありません"
+# 渡していないツールを呼ぼうとした場合の ToolNode のエラー
+_INVALID_TOOL = INVALID_TOOL_NAME_ERROR_TEMPLATE.split("{requested_tool}")[1].split("{")[0]
+SUBSET_PROMPT = f"このステップに必要なツールが見つからない場合は、ツールを呼び出さずに「{NO_TOOL_REPLY}」とだけ答えてください。"
+
+
+def _words(text: str) -> list[str]:
+    words = (word.lower() for word in _WORD.findall(text.replace("_", " ")))
+    return [word for word in words if len(word) > 1 and word not in _STOP_WORDS]
+
+
+def step_terms(step: str) -> list[str]:
+    """ステップの検索語（英単語と、日本語のキーワードを対応付けた英単語）"""
+    terms = _words(step)
+    lowered = step.lower()
+    for keyword, words in KEYWORDS.items():
+        if keyword in lowered:
+            terms.extend(words)
+    return terms
+
+
+def schema_tokens(tool: BaseTool) -> int:
+    """ツールのJSONスキーマがプロンプトに占めるトークン数の見積もり"""
+    return estimate_tokens(json.dumps(convert_to_openai_tool(tool), ensure_ascii=False))
+
+
+class ToolSelector:
+    """計画ステップに関係するツールを選び、ツールの組み合わせごとのReActエージェントを返す
+
+    Args:
+        llm: エージェントのチャットモデル
+        tools: すべてのツール（マクロ記録などのフックを通したもの）
+        prompt: エージェントのプロンプト
+        max_tools: 段階0で選ぶツール数の上限（CORE_TOOLS を除く）
+    """
+
+    LEVELS = 3
+
+    def __init__(self, llm, tools: list[BaseTool], prompt: str, max_tools: int = 6, max_executors: int = 32):
+        self.llm = llm
+        self.tools = list(tools)
+        self.prompt = prompt
+        self.max_tools = max_tools
+        self.max_executors = max_executors
+        self._executors: dict[tuple[str, ...], object] = {}
+        self._levels: dict[str, int] = {}
+        self._tokens = {tool.name: schema_tokens(tool) for tool in self.tools}
+        self.stats = {"selected": 0, "widened": 0, "tools": 0, "schema_tokens": 0}
+
+        # ツール名の単語は説明の単語より重く数える
+        self._index = {
+            tool.name: Counter(_words(tool.name) * 3 + _words(tool.description or "") + sorted(infer_capabilities(tool.name)))
+            for tool in self.tools
+        }
+        documents = len(self.tools) or 1
+        frequency = Counter(word for terms in self._index.values() for word in terms)
+        self._idf = {word: math.log(1 + documents / count) for word, count in frequency.items()}
+
+    def _excluded(self, tool: BaseTool) -> bool:
+        return bool(infer_capabilities(tool.name) & EXCLUDED_CAPABILITIES)
+
+    def score(self, step: str) -> dict[str, float]:
+        """ツールごとのステップとの関連度"""
+        terms = step_terms(step)
+        return {
+            name: sum(self._idf.get(term, 0.0) * min(counts[term], 3) for term in terms)
+            for name, counts in self._index.items()
+        }
+
+    def select(self, step: str, level: int = 0) -> list[BaseTool]:
+        """段階 level でステップに渡すツール"""
+        if level >= 2:
+            return list(self.tools)
+        candidates = [tool for tool in self.tools if not self._excluded(tool)]
+        if level == 1:
+            return candidates
+        scores = self.score(step)
+        ranked = sorted((tool for tool in candidates if scores[tool.name] > 0 and tool.name not in CORE_TOOLS),
+                        key=lambda tool: scores[tool.name], reverse=True)
+        chosen = {tool.name for tool in ranked[:self.max_tools]} | set(CORE_TOOLS)
+        return [tool for tool in candidates if tool.name in chosen]
+
+    def start_level(self, step: str) -> int:
+        return self._levels.get(step, 0)
+
+    def widen(self, step: str, level: int, reason: str) -> int | None:
+        """次の段階に広げる（これ以上広げられなければNone）"""
+        if level + 1 >= self.LEVELS:
+            return None
+        self._levels[step] = level + 1
+        self.stats["widened"] += 1
+        print(Fore.YELLOW + f"ツール選択: '{step}' は{reason}ため、ツールを広げて再実行します（段階{level + 1}）")
+        return level + 1
+
+    @staticmethod
+    def missing_tools(messages: list[BaseMessage]) -> bool:
+        """エージェントが渡していないツールを呼ぼうとしたか、ツールを呼ばずに必要なツールがないと答えたか"""
+        if any(isinstance(m, ToolMessage) and _INVALID_TOOL in str(m.content) for m in messages):
+            return True
+        if any(isinstance(m, AIMessage) and m.tool_calls for m in messages):
+            return False
+        content = messages[-1].content if messages else ""
+        return NO_TOOL_REPLY in str(content) or not str(content).strip()
+
+    def executor(self, step: str, level: int = 0):
+        """ステップ用のReActエージェント（同じツールの組み合わせでは同じものを使う）"""
+        tools = self.select(step, level)
+        key = tuple(sorted(tool.name for tool in tools))
+        tokens = sum(self._tokens[tool.name] for tool in tools)
+        self.stats["selected"] += 1
+        self.stats["tools"] += len(tools)
+        self.stats["schema_tokens"] += tokens
+        print(Fore.CYAN + f"ツール選択（段階{level}）: {len(tools)}/{len(self.tools)}ツール, スキーマ約{tokens}トークン"
+                          f"（全体 {sum(self._tokens.values())}）: {', '.join(key)}")
+        executor = self._executors.get(key)
+        if executor is None:
+            if len(self._executors) >= self.max_executors:
+                self._executors.pop(next(iter(self._executors)))
+            prompt = self.prompt if len(tools) == len(self.tools) else f"{self.prompt}\n{SUBSET_PROMPT}"
+            executor = create_react_agent(self.llm, tools, prompt=prompt, checkpointer=False)
+            self._executors[key] = executor
+        return executor
+
+    def format_stats(self) -> str:
+        s = self.stats
+        if not s["selected"]:
+            return "ツール選択: 実行なし"
+        return (f"ツール選択: {s['selected']}回, 平均 {s['tools'] / s['selected']:.1f}/{len(self.tools)}ツール, "
+                f"スキーマ平均 約{s['schema_tokens'] / s['selected']:.0f}/{sum(self._tokens.values())}トークン, "
+                f"拡大 {s['widened']}回")
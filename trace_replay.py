@@ -0,0 +1,301 @@
+"""記録・再生（record & replay）トレース
+
+PlanExecuteワークフローや simple_chat.py の実行中に発生した
+MCPツール呼び出しと結果、LLMリクエストと応答をコンパクトなJSONLトレースに記録する。
+スクリーンショットなどの大きな文字列はコンテンツハッシュでBlobストアに保存する。
+
+再生時は TracePlayer がMCPセッション（ツール）と ChatOpenAI の代わりになり、
+デバイスもネットワークもなしでシナリオを決定的に再実行できる。
+
+トレースディレクトリの構成:
+    trace.jsonl   1行1レコード（tools / setup / input / tool / llm）
+    blobs/        コンテンツアドレスのBlob
+"""
+import hashlib
+import json
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Any
+from uuid import UUID
+
+from colorama import Fore
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessageChunk, BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult, LLMResult
+from langchain_core.tools import BaseTool, StructuredTool, ToolException
+from langchain_openai import ChatOpenAI
+from pydantic import BaseModel
+
+from blob_store import BlobStore
+from tool_hooks import tool_content, wrap_tools
+
+# この文字数を超える文字列はBlobとして保存する
+BLOB_THRESHOLD = 512
+BLOB_KEY = "$blob"
+
+
+def _jsonable(value):
+    """JSONに変換できない値（pydanticモデル等）を変換する"""
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, BaseMessage):
+        return message_to_dict(value)
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def blobify(value, store: BlobStore, threshold: int = BLOB_THRESHOLD):
+    """大きな文字列をBlobストアに移し、{"$blob": hash} に置き換える"""
+    if isinstance(value, str):
+        if len(value) > threshold:
+            return {BLOB_KEY: store.put(value)}
+        return value
+    if isinstance(value, dict):
+        return {k: blobify(v, store, threshold) for k, v in value.items()}
+    if isinstance(value, list):
+        return [blobify(v, store, threshold) for v in value]
+    return value
+
+
+def unblobify(value, store: BlobStore):
+    """blobify() の逆変換"""
+    if isinstance(value, dict):
+        if set(value) == {BLOB_KEY}:
+            return store.get_text(value[BLOB_KEY])
+        return {k: unblobify(v, store) for k, v in value.items()}
+    if isinstance(value, list):
+        return [unblobify(v, store) for v in value]
+    return value
+
+
+def _canonical_message(message: BaseMessage) -> dict:
+    # id や response_metadata は実行ごとに変わるため、ハッシュには内容だけを使う
+    return {
+        "type": message.type,
+        "content": message.content,
+        "tool_calls": [(c["name"], c["args"]) for c in getattr(message, "tool_calls", [])],
+    }
+
+
+def request_hash(messages: list[BaseMessage]) -> str:
+    """LLMリクエスト（メッセージ列）のハッシュ"""
+    data = json.dumps(_jsonable([_canonical_message(m) for m in messages]), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def _tool_schema(tool: BaseTool) -> dict:
+    args_schema = tool.args_schema
+    if isinstance(args_schema, type) and issubclass(args_schema, BaseModel):
+        args_schema = args_schema.model_json_schema()
+    return {
+        "name": tool.name,
+        "description": tool.description,
+        "args_schema": args_schema or {"type": "object", "properties": {}},
+        "response_format": tool.response_format,
+    }
+
+
+class TraceRecorder:
+    """ツール呼び出しとLLM呼び出しをトレースに記録する"""
+
+    def __init__(self, trace_dir: str | Path):
+        self.trace_dir = Path(trace_dir)
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+        self.blobs = BlobStore(self.trace_dir / "blobs")
+        self._fp = open(self.trace_dir / "trace.jsonl", "a", encoding="utf-8")
+        self._seq = 0
+        self.llm_handler = _LLMRecordingHandler(self)
+
+    def write(self, record: dict):
+        self._seq += 1
+        record = {"seq": self._seq, "ts": round(time.time(), 3), **record}
+        self._fp.write(json.dumps(blobify(_jsonable(record), self.blobs), ensure_ascii=False) + "\n")
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+    def record_setup(self, setup_steps: list):
+        """select_platform / create_session の結果を記録する（再生時のpast_steps初期値）"""
+        self.write({"type": "setup", "steps": [list(step) for step in setup_steps]})
+
+    def record_input(self, text: str):
+        """ユーザー入力（simple_chat）を記録する"""
+        self.write({"type": "input", "text": text})
+
+    def wrap_tools(self, tools: list[BaseTool]) -> list[BaseTool]:
+        """ツール一覧を記録し、呼び出しを記録するツールに置き換える"""
+        self.write({"type": "tools", "tools": [_tool_schema(t) for t in tools]})
+
+        async def around(tool, kwargs, call):
+            started = time.perf_counter()
+            try:
+                result = await call(kwargs)
+            except Exception as e:
+                self.write({"type": "tool", "name": tool.name, "args": kwargs, "error": str(e),
+                            "elapsed": round(time.perf_counter() - started, 3)})
+                raise
+            self.write({"type": "tool", "name": tool.name, "args": kwargs, "result": tool_content(tool, result),
+                        "elapsed": round(time.perf_counter() - started, 3)})
+            return result
+
+        return wrap_tools(tools, around)
+
+
+class _LLMRecordingHandler(BaseCallbackHandler):
+    """チャットモデルのリクエストと応答を記録するコールバック"""
+    run_inline = True  # 記録順序を呼び出し順に保つ
+
+    def __init__(self, recorder: TraceRecorder):
+        self.recorder = recorder
+        self._requests: dict[UUID, tuple[list, float]] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any):
+        self._requests[run_id] = (messages[0] if messages else [], time.perf_counter())
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        request, started = self._requests.pop(run_id, ([], time.perf_counter()))
+        generation = response.generations[0][0]
+        message = getattr(generation, "message", None)
+        self.recorder.write({
+            "type": "llm",
+            "request_hash": request_hash(request),
+            "request": [message_to_dict(m) for m in request],
+            "response": message_to_dict(message) if message is not None else {"text": generation.text},
+            "elapsed": round(time.perf_counter() - started, 3),
+        })
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        request, started = self._requests.pop(run_id, ([], time.perf_counter()))
+        self.recorder.write({"type": "llm", "request_hash": request_hash(request), "error": str(error),
+                             "elapsed": round(time.perf_counter() - started, 3)})
+
+
+class TracePlayer:
+    """記録したトレースを再生し、MCPツールとLLMの代わりを提供する
+
+    Args:
+        strict: Trueの場合、LLMリクエストが記録と異なれば例外を送出する（Falseなら警告のみ）
+    """
+
+    def __init__(self, trace_dir: str | Path, strict: bool = False):
+        self.trace_dir = Path(trace_dir)
+        self.blobs = BlobStore(self.trace_dir / "blobs")
+        self.strict = strict
+        self.tool_schemas: list[dict] = []
+        self.setup_steps: list = []
+        self.inputs: deque[str] = deque()
+        self.tool_results: dict[str, deque[dict]] = defaultdict(deque)
+        self.llm_responses: deque[dict] = deque()
+        # 並行するLLM呼び出し（計画のストリーミング生成とエージェントなど）は、記録（終了順）と
+        # 再生（開始順）で順序が入れ替わるため、リクエストのハッシュで応答を探す
+        self._llm_by_hash: dict[str, deque[dict]] = defaultdict(deque)
+        self._llm_used: set[int] = set()
+        self.llm_mismatches = 0
+        with open(self.trace_dir / "trace.jsonl", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self._load(json.loads(line))
+
+    def _load(self, record: dict):
+        kind = record.get("type")
+        if kind == "tools" and not self.tool_schemas:
+            self.tool_schemas = record["tools"]
+        elif kind == "setup":
+            self.setup_steps = [tuple(step) for step in unblobify(record["steps"], self.blobs)]
+        elif kind == "input":
+            self.inputs.append(record["text"])
+        elif kind == "tool":
+            self.tool_results[record["name"]].append(record)
+        elif kind == "llm":
+            self.llm_responses.append(record)
+            self._llm_by_hash[record.get("request_hash")].append(record)
+
+    def tools(self) -> list[BaseTool]:
+        """記録したスキーマを持ち、記録した結果を順に返すツール一覧"""
+        return [self._replay_tool(schema) for schema in self.tool_schemas]
+
+    def _replay_tool(self, schema: dict) -> BaseTool:
+        name = schema["name"]
+        content_and_artifact = schema.get("response_format") == "content_and_artifact"
+
+        async def coroutine(**kwargs):
+            queue = self.tool_results[name]
+            if not queue:
+                raise ToolException(f"トレースに {name} の記録がもうありません（args={kwargs}）")
+            record = queue.popleft()
+            if record.get("args") != kwargs:
+                print(Fore.YELLOW + f"[replay] {name} の引数が記録と異なります: {kwargs} != {record.get('args')}")
+            if "error" in record:
+                raise ToolException(record["error"])
+            result = unblobify(record.get("result"), self.blobs)
+            return (result, None) if content_and_artifact else result
+
+        return StructuredTool(
+            name=name,
+            description=schema.get("description", ""),
+            args_schema=schema.get("args_schema"),
+            coroutine=coroutine,
+            response_format=schema.get("response_format", "content"),
+        )
+
+    def _pop_unused(self, queue: deque[dict]) -> dict | None:
+        while queue:
+            record = queue.popleft()
+            if record["seq"] not in self._llm_used:
+                self._llm_used.add(record["seq"])
+                return record
+        return None
+
+    def next_llm_response(self, messages: list[BaseMessage]) -> BaseMessage:
+        record = self._pop_unused(self._llm_by_hash[request_hash(messages)])
+        if record is None:
+            # 同じリクエストの記録がなければ、記録順で次の応答を返す
+            record = self._pop_unused(self.llm_responses)
+            if record is None:
+                raise RuntimeError("トレースにLLM応答の記録がもうありません")
+            self.llm_mismatches += 1
+            message = f"[replay] LLMリクエストが記録と異なります (seq={record.get('seq')})"
+            if self.strict:
+                raise RuntimeError(message)
+            print(Fore.YELLOW + message)
+        if "error" in record:
+            raise RuntimeError(record["error"])
+        return messages_from_dict([unblobify(record["response"], self.blobs)])[0]
+
+    def format_report(self) -> str:
+        """再生が記録どおりだったか（記録と異なるLLMリクエスト・使われなかった記録の数）"""
+        unused_llm = sum(1 for record in self.llm_responses if record["seq"] not in self._llm_used)
+        unused_tools = sum(len(queue) for queue in self.tool_results.values())
+        status = "記録どおり" if not (self.llm_mismatches or unused_llm or unused_tools) else "記録と異なる"
+        return (f"[replay] {status}: 記録と異なるLLMリクエスト {self.llm_mismatches}, "
+                f"未使用の記録 LLM {unused_llm} / ツール {unused_tools}")
+
+    def chat_model(self, model: str = "gpt-4.1") -> "ReplayChatModel":
+        """記録したLLM応答を順に返すチャットモデル"""
+        return ReplayChatModel(model=model, api_key="replay", player=self)
+
+
+class ReplayChatModel(ChatOpenAI):
+    """記録した応答を返す ChatOpenAI 互換モデル（構造化出力・ツール呼び出しも同じパーサーを通る）"""
+    player: Any = None
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=self.player.next_llm_response(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._generate(messages, stop=stop, **kwargs)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self.player.next_llm_response(messages)
+        yield ChatGenerationChunk(message=AIMessageChunk(**message.model_dump(exclude={"type"})))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self._stream(messages, stop=stop, **kwargs):
+            yield chunk
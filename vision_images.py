@@ -0,0 +1,174 @@
+"""Vision API に送る画像の準備（変化領域の切り出し）
+
+リプランのたびに画面全体の画像を送ると、アップロードサイズと画像トークンがリプランの待ち時間の大半を占める。
+実際にはダイアログや入力欄など一部だけが変化していることが多いため、
+前回観測からの変化領域（screen_diff の changed_regions）だけを切り出して送り、
+画面全体は低解像度の縮小画像（detail=low）で添える。
+
+- full: 画面全体を1枚送る（変化が大きい場合・前回観測がない場合もこちら）
+- roi : 変化領域の切り出し + 画面全体の縮小画像を送る
+
+画像ごとにJPEG品質とサイズの目標を設定でき、max_bytes を超える場合は品質を下げて再エンコードする。
+"""
+import asyncio
+import base64
+import io
+import math
+from concurrent.futures import Executor
+from dataclasses import dataclass
+
+from PIL import Image
+
+from screen_diff import CHANGED, ScreenChange
+from screen_observation import _image_executor, JPEG_QUALITY, MAX_IMAGE_WIDTH, ScreenObservation
+
+FULL = "full"
+ROI = "roi"
+
+
+@dataclass
+class ImagePreparation:
+    """Vision API に送る画像の準備方法
+
+    Args:
+        mode: FULL（画面全体）/ ROI（変化領域の切り出し + 縮小画像）
+        max_width / quality: 画面全体を送る場合の最大横幅とJPEG品質
+        crop_max_width / crop_quality: 切り出した領域の最大横幅とJPEG品質
+        overview_size / overview_quality: 縮小画像の長辺とJPEG品質（detail=low で送る）
+        padding: 変化領域の周囲に含める余白（画面サイズに対する比率）
+        max_crop_area: 変化領域の面積の合計がこれ（画面に対する比率）を超えたら画面全体を送る
+        max_bytes: 1枚あたりのJPEGサイズの目標。超える場合は min_quality まで品質を下げる
+    """
+    mode: str = ROI
+    max_width: int = MAX_IMAGE_WIDTH
+    quality: int = JPEG_QUALITY
+    crop_max_width: int = 768
+    crop_quality: int = 80
+    overview_size: int = 512
+    overview_quality: int = 50
+    padding: float = 0.03
+    max_crop_area: float = 0.5
+    max_bytes: int = 200_000
+    min_quality: int = 35
+
+
+@dataclass
+class VisionImage:
+    """Vision API に送る1枚の画像"""
+    label: str
+    url: str
+    width: int
+    height: int
+    size: int  # JPEGのバイト数
+    detail: str = "auto"
+
+    @property
+    def tokens(self) -> int:
+        return vision_tokens(self.width, self.height, self.detail)
+
+    def content_blocks(self) -> list[dict]:
+        """HumanMessage の content に入れるブロック（説明のテキストと画像）"""
+        image_url = {"url": self.url}
+        if self.detail != "auto":
+            image_url["detail"] = self.detail
+        return [{"type": "text", "text": self.label}, {"type": "image_url", "image_url": image_url}]
+
+
+def vision_tokens(width: int, height: int, detail: str = "high") -> int:
+    """OpenAIの画像トークン数（2048px四方に収め、短辺を768pxにした後の512pxタイル数で決まる）"""
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def encode_jpeg(img: Image.Image, quality: int, max_bytes: int = 0, min_quality: int = 35) -> bytes:
+    """JPEGにエンコードする。max_bytes を超える場合は min_quality まで品質を下げる"""
+    while True:
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=quality)
+        if not max_bytes or buf.tell() <= max_bytes or quality <= min_quality:
+            return buf.getvalue()
+        quality = max(min_quality, quality - 10)
+
+
+def _fit(img: Image.Image, max_width: int = 0, max_side: int = 0) -> Image.Image:
+    scale = 1.0
+    if max_width and img.width > max_width:
+        scale = max_width / img.width
+    if max_side and max(img.size) * scale > max_side:
+        scale = max_side / max(img.size)
+    if scale >= 1.0:
+        return img
+    # reducing_gap: 整数倍の縮小を先に行い、大きく縮小する場合のLANCZOSを速くする
+    return img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS,
+                      reducing_gap=2.0)
+
+
+def _image(label: str, img: Image.Image, quality: int, config: ImagePreparation, detail: str = "auto") -> VisionImage:
+    data = encode_jpeg(img, quality, config.max_bytes, config.min_quality)
+    return VisionImage(label=label, url="data:image/jpeg;base64," + base64.b64encode(data).decode(),
+                       width=img.width, height=img.height, size=len(data), detail=detail)
+
+
+def full_image(observation: ScreenObservation, config: ImagePreparation) -> list[VisionImage]:
+    """画面全体を1枚で送る（観測時にエンコード済みの画像が設定に合えばそのまま使う）"""
+    img = observation.image
+    if img is None:
+        if not observation.image_url:
+            return []
+        size = len(observation.image_url) * 3 // 4
+        return [VisionImage("画面全体", observation.image_url, observation.width, observation.height, size)]
+    if img.width <= config.max_width and config.quality == JPEG_QUALITY:
+        size = len(observation.image_url) * 3 // 4
+        if not config.max_bytes or size <= config.max_bytes:
+            return [VisionImage("画面全体", observation.image_url, img.width, img.height, size)]
+    return [_image("画面全体", _fit(img, config.max_width), config.quality, config)]
+
+
+def prepare_images(observation: ScreenObservation, change: ScreenChange | None,
+                   config: ImagePreparation | None = None) -> list[VisionImage]:
+    """観測と前回からの変化をもとに、送る画像の一覧を作る（同期処理）"""
+    config = config or ImagePreparation()
+    img = observation.image
+    if config.mode != ROI or change is None or change.kind == CHANGED or img is None:
+        return full_image(observation, config)
+
+    boxes = []
+    for left, top, right, bottom in change.regions:
+        boxes.append((max(0.0, left - config.padding), max(0.0, top - config.padding),
+                      min(1.0, right + config.padding), min(1.0, bottom + config.padding)))
+    if sum((r - l) * (b - t) for l, t, r, b in boxes) > config.max_crop_area:
+        return full_image(observation, config)
+
+    images = []
+    for left, top, right, bottom in boxes:
+        pixels = (round(left * img.width), round(top * img.height), round(right * img.width), round(bottom * img.height))
+        crop = _fit(img.crop(pixels), config.crop_max_width)
+        images.append(_image(f"変化した領域（画面の x={pixels[0]}-{pixels[2]}, y={pixels[1]}-{pixels[3]}、"
+                             f"画面サイズ {img.width}x{img.height}）", crop, config.crop_quality, config))
+    label = "画面全体（縮小）" if images else "画面全体（縮小、前回から変化なし）"
+    images.append(_image(label, _fit(img, max_side=config.overview_size), config.overview_quality, config, detail="low"))
+    if sum(image.tokens for image in images) >= vision_tokens(img.width, img.height):
+        # 小さな領域が多いと切り出しの方が高くつく
+        return full_image(observation, config)
+    return images
+
+
+async def prepare_vision_images(observation: ScreenObservation, change: ScreenChange | None,
+                                config: ImagePreparation | None = None,
+                                executor: Executor | None = None) -> list[VisionImage]:
+    """prepare_images をワーカースレッドで実行する"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or _image_executor, prepare_images, observation, change, config)
+
+
+def format_images(images: list[VisionImage], observation: ScreenObservation) -> str:
+    """送る画像の概要（枚数・サイズ・トークン数の見積もり、画面全体を送った場合との比較）"""
+    sizes = ", ".join(f"{image.width}x{image.height}" for image in images)
+    full = vision_tokens(observation.width, observation.height) if observation.width else 0
+    return (f"Vision画像: {len(images)}枚（{sizes}）{sum(i.size for i in images) / 1024:.0f}KB, "
+            f"約{sum(i.tokens for i in images)}トークン（画面全体: 約{full}トークン）")